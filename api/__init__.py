@@ -1,9 +1,11 @@
 import logging
 import os
 import os.path as op
+import pickle
 import re
 import ssl
 import urllib.request
+import zipfile
 from datetime import date
 from typing import Optional
 
@@ -14,6 +16,12 @@ logger = logging.getLogger(__name__)
 
 CONVERSIONS_DIR = op.join(op.dirname(op.dirname(op.abspath(__file__))), "currency_conversions")
 FILENAME_PATTERN = re.compile(r"^ecb_(\d{8})\.zip$")
+DOWNLOAD_TIMEOUT_SECONDS = 10
+
+# Attributes CurrencyConverter fills in when it parses a zip. Parsing takes
+# most of a second, so we pickle them next to the zip and restore them on later
+# boots instead.
+SNAPSHOT_ATTRIBUTES = ('_rates', 'bounds', 'currencies')
 
 converter = None
 
@@ -24,7 +32,8 @@ def download_rates(filename: str) -> None:
     # which otherwise fails with CERTIFICATE_VERIFY_FAILED.
     context = ssl.create_default_context(cafile=certifi.where())
 
-    with urllib.request.urlopen(ECB_URL, context=context) as response:
+    with urllib.request.urlopen(
+            ECB_URL, context=context, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
         data = response.read()
 
     partial = f"{filename}.part"
@@ -54,7 +63,51 @@ def get_refreshed_converter() -> CurrencyConverter:
             logger.exception("Could not download ECB rates, falling back to %s", fallback)
             filename = fallback
 
-    return CurrencyConverter(filename, True, True)
+    return load_converter(filename)
+
+
+def rates_currencies(filename: str) -> set:
+    '''The currencies a converter built from the given zip would have, read from
+    the header of its CSV alone rather than by parsing all of it'''
+    with zipfile.ZipFile(filename) as archive, archive.open(archive.namelist()[0]) as rates:
+        header = rates.readline().decode().split(',')[1:]
+    # Rates are against the euro, which has no column of its own
+    return {currency.strip() for currency in header if currency.strip()} | {'EUR'}
+
+
+def snapshot_filename(filename: str) -> str:
+    return f"{op.splitext(filename)[0]}.pickle"
+
+
+def load_converter(filename: str) -> CurrencyConverter:
+    '''Build a converter for the given zip, from its snapshot when there is one,
+    writing the snapshot otherwise'''
+    snapshot = snapshot_filename(filename)
+    if op.isfile(snapshot):
+        try:
+            with open(snapshot, "rb") as file:
+                attributes = pickle.load(file)
+            converter = CurrencyConverter(None, True, True)
+            for name in SNAPSHOT_ATTRIBUTES:
+                setattr(converter, name, attributes[name])
+            return converter
+        except Exception:
+            logger.exception("Could not load rates snapshot %s, parsing %s", snapshot, filename)
+
+    converter = CurrencyConverter(filename, True, True)
+    try:
+        write_snapshot(converter, snapshot)
+    except OSError:
+        logger.exception("Could not write rates snapshot %s", snapshot)
+    return converter
+
+
+def write_snapshot(converter: CurrencyConverter, snapshot: str) -> None:
+    attributes = {name: getattr(converter, name) for name in SNAPSHOT_ATTRIBUTES}
+    partial = f"{snapshot}.part"
+    with open(partial, "wb") as file:
+        pickle.dump(attributes, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(partial, snapshot)
 
 
 def get_currencies():
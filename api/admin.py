@@ -1,7 +1,8 @@
 from django.contrib import admin
+from django.utils.html import format_html
 from modeltranslation.admin import TranslationAdmin
 from .models import (MaxImpactFundGrant, Evaluation,
-                     Allotment, Charity, Intervention, AllGrantsFundGrant)
+                     Allotment, Charity, Intervention, AllGrantsFundGrant, RequestProfile)
 from .admin_reordering import admin_site
 
 class AllotmentInline(admin.StackedInline):
@@ -73,9 +74,38 @@ class AllGrantsFundGrantAdmin(admin.ModelAdmin):
 class CharityAdmin(admin.ModelAdmin):
     search_fields = ['charity_name', 'abbreviation']
 
+class RequestProfileAdmin(admin.ModelAdmin):
+    '''Read-only: profiles are only ever written by ProfilingMiddleware'''
+    list_display = ('created_at', 'path', 'status_code', 'duration_ms', 'trigger', 'query_count')
+    list_filter = ['trigger', 'status_code']
+    search_fields = ['path']
+    fields = ('created_at', 'path', 'status_code', 'duration_ms', 'trigger', 'query_list',
+              'profile_report')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description='Queries')
+    def query_count(self, profile):
+        return len(profile.queries)
+
+    @admin.display(description='Queries')
+    def query_list(self, profile):
+        return format_html('<pre>{}</pre>', '\n\n'.join(
+            f"{query['ms']:.2f} ms  {query['sql']}" for query in profile.queries))
+
+    @admin.display(description='Profile')
+    def profile_report(self, profile):
+        return format_html('<pre>{}</pre>', profile.profile)
+
 admin_site.register(MaxImpactFundGrant, MaxImpactFundGrantAdmin)
 admin_site.register(AllGrantsFundGrant, AllGrantsFundGrantAdmin)
 admin_site.register(Evaluation, EvaluationAdmin)
 admin_site.register(Charity, CharityAdmin)
 admin_site.register(Intervention)
 admin_site.register(Allotment, AllotmentAdmin)
+admin_site.register(RequestProfile, RequestProfileAdmin)
@@ -13,7 +13,7 @@ class ReorderedSite(AdminSite):
         # List the models in the order they should appear in the admin section (including those
         # that don't appear, for simplicity)
         return ['Evaluation', 'Intervention', 'MaxImpactFundGrant', 'AllGrantsFundGrant',
-                'Allotment', 'Charity']
+                'Allotment', 'Charity', 'RequestProfile']
 
 # Instantiate the custom AdminSite
 admin_site = ReorderedSite(name='reordered_admin')
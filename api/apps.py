@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.core.signals import request_started
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from .cache_sweeper import start_sweeper
+        from .coherence import start_poller
+        from .db import check_connection_health
+        request_started.connect(check_connection_health, dispatch_uid='api_connection_health')
+        request_started.connect(start_sweeper, dispatch_uid='api_cache_sweeper')
+        request_started.connect(start_poller, dispatch_uid='api_data_version_poller')
@@ -0,0 +1,26 @@
+'''Async versions of the views in views.py, for running under an ASGI server
+(see impact_api/asgi.py). They share the sync views' cache entries, data
+versions and invalidation; only the blocking work moves off the event loop.'''
+import inspect
+from functools import update_wrapper
+from asgiref.sync import sync_to_async
+from . import views
+from .cache import conditional_get, datastore_cache
+from .edge import edge_cache
+
+
+def _async_view(sync_view):
+    compute = inspect.unwrap(sync_view)
+
+    async def view(request, *args, **kwargs):
+        # Thread-sensitive, so each request's ORM queries and serialization run
+        # in one thread of its own, as Django's database connections require
+        return await sync_to_async(compute)(request, *args, **kwargs)
+    update_wrapper(view, compute)
+    return edge_cache(conditional_get(
+        datastore_cache(timeout_days=views.CACHE_TIMEOUT_DAYS)(view)))
+
+
+evaluations = _async_view(views.evaluations)
+max_impact_fund_grants = _async_view(views.max_impact_fund_grants)
+all_grants_fund_grants = _async_view(views.all_grants_fund_grants)
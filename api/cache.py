@@ -1,45 +1,388 @@
-from google.cloud import datastore
+import asyncio
 from functools import wraps
-import json
 import hashlib
+import json
+import logging
+import math
+import threading
+import time
 from datetime import datetime, timedelta
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.translation import get_language
+from . import events, metrics, timing
+from .cache_backends import get_backend
+from .circuit_breaker import get_breaker
+from .cache_writer import get_writer, invalidation_lock
+from .compression import COMPRESSORS, compressed_variants, negotiate_encoding
+
+logger = logging.getLogger(__name__)
+
+# One JSON line per cache lookup and clear, for the log-based dashboards
+telemetry_logger = logging.getLogger('api.telemetry')
+
+# When the data behind each view last changed, as far as this process knows.
+# Bumped by clear_cache, which the receivers in models.py call on every save and
+# delete. Views not changed on their own have the version of every view, which
+# seed_data_versions takes from the cache backend, so that every instance (and
+# every restart) hands out the same ETags for the same data. Until that's
+# worked, it's a guess: the time, so that a restarted process never vouches for
+# an ETag handed out before it started.
+_base_version = time.time()
+_base_is_guess = True
+_data_versions = {}
+_seeded = False
+_seed_lock = threading.Lock()
+# Every view asked about, whose versions sync_data_versions keeps up to date
+_known_views = set()
+
+# Each bump is also recorded in the cache backend, under the view's name or this
+# for every view, for the other instances to pick up with sync_data_versions
+ALL_VIEWS = '*'
+
+def data_version(view_name) -> float:
+    if not _seeded:
+        seed_data_versions()
+    _known_views.add(view_name)
+    return _data_versions.get(view_name, _base_version)
+
+def changed_at(view_name) -> float:
+    '''When the data behind a view last changed, as far as this process knows, or
+    0 if it doesn't know yet. Unlike data_version this never depends on when the
+    process started, so cache entries are stamped with it for every instance to
+    compare with its own.'''
+    if not _seeded:
+        seed_data_versions()
+    _known_views.add(view_name)
+    return _data_versions.get(view_name, 0.0 if _base_is_guess else _base_version)
+
+def seed_data_versions() -> None:
+    '''Start from the versions recorded in the cache backend. If none has been
+    for every view yet, record the time of the latest change in the database as
+    that, which every instance booting meanwhile works out the same. Runs on
+    first use, or at boot from the WSGI entry point.'''
+    global _base_version, _base_is_guess, _seeded
+    from .models import VIEW_NAMES
+
+    with _seed_lock:
+        if _seeded:
+            return
+        try:
+            backend = get_backend()
+            shared = backend.get_versions([ALL_VIEWS, *VIEW_NAMES])
+            every_view = shared.pop(ALL_VIEWS, None)
+            if every_view is None:
+                every_view = _latest_database_change()
+                backend.set_version(ALL_VIEWS, every_view)
+        except Exception:
+            # sync_data_versions adopts the shared versions once it can
+            metrics.increment('data_version_seed_failures')
+            logger.exception('Could not seed the data versions, guessing until the next poll')
+        else:
+            _base_version, _base_is_guess = every_view, False
+            _data_versions.update({view_name: version for view_name, version in shared.items()
+                                   if version > every_view})
+        _seeded = True
+
+def _latest_database_change() -> float:
+    from django.db import DEFAULT_DB_ALIAS
+    from django.db.models import Max
+    from .models import (
+        AllGrantsFundGrant, Allotment, Charity, Evaluation, Intervention, MaxImpactFundGrant,
+        Tombstone)
+
+    # From the primary, as a replica may not have caught up
+    changes = [model.objects.using(DEFAULT_DB_ALIAS).aggregate(latest=Max(field))['latest']
+               for model, field in [
+                   (Charity, 'updated_at'), (Intervention, 'updated_at'),
+                   (Evaluation, 'updated_at'), (MaxImpactFundGrant, 'updated_at'),
+                   (AllGrantsFundGrant, 'updated_at'), (Allotment, 'updated_at'),
+                   (Tombstone, 'deleted_at')]]
+    return max((change.timestamp() for change in changes if change), default=0.0)
+
+def bump_data_version(view_name=None) -> None:
+    '''Mark the data behind a view (or, given no view, every view) as changed'''
+    if not _seeded:
+        seed_data_versions()
+    now = time.time()
+    if view_name:
+        # Never go backwards, even if the clock does
+        version = _data_versions[view_name] = max(now, data_version(view_name) + 1e-6)
+    else:
+        global _base_version, _base_is_guess
+        version = _base_version = max(now, _base_version + 1e-6)
+        _base_is_guess = False
+        _data_versions.clear()
+    try:
+        get_backend().set_version(view_name or ALL_VIEWS, version)
+    except Exception:
+        # The other instances will serve their cached responses a while longer,
+        # until they expire or the next change's bump gets through
+        metrics.increment('data_version_share_failures')
+        logger.exception('Could not share the new version of %s', view_name or 'every view')
+
+def sync_data_versions() -> None:
+    '''Adopt the data versions other instances have recorded in the cache
+    backend, where newer than this process's own, and record this process's
+    version of every view again if the backend has lost it (or never got it).
+    Run every settings.API_DATA_VERSION_POLL_SECONDS by api.coherence.'''
+    global _base_version, _base_is_guess, _seeded
+    if _base_is_guess:
+        # Seeding failed (or hasn't happened): until it works, this process's
+        # versions are its own
+        _seeded = False
+        seed_data_versions()
+    shared = get_backend().get_versions([ALL_VIEWS, *sorted(_known_views)])
+    synced = False
+    with invalidation_lock:
+        every_view = shared.pop(ALL_VIEWS, None)
+        if every_view is not None and every_view > _base_version:
+            _base_version, _base_is_guess = every_view, False
+            for view_name in [view_name for view_name, version in _data_versions.items()
+                              if version <= every_view]:
+                del _data_versions[view_name]
+            metrics.increment('data_versions_synced', view='all')
+            synced = True
+        # Missing or older (the bump never got there, or the backend lost it),
+        # instances starting meanwhile would disagree with this one. Going back
+        # to it instead could match a client's ETag from before a change again.
+        lost = not _base_is_guess and (every_view is None or every_view < _base_version)
+        for view_name, version in shared.items():
+            if version > data_version(view_name):
+                _data_versions[view_name] = version
+                metrics.increment('data_versions_synced', view=view_name)
+                synced = True
+    if lost:
+        get_backend().set_version(ALL_VIEWS, _base_version)
+    if synced:
+        events.notify()
+
+def cache_key(view_name, request) -> str:
+    '''Identify a response by view, active language and query strings. Every value
+    of a repeated query string counts, in the order given.'''
+    key_parts = [view_name, get_language() or ''] + [
+        f"{k}:{','.join(v)}" for k, v in sorted(request.GET.lists())]
+    return hashlib.md5(":".join(key_parts).encode()).hexdigest()
+
+def conditional_get(view_func):
+    '''Add ETag and Last-Modified headers from the view's data version, and answer
+    If-None-Match/If-Modified-Since with a 304 without calling the view at all.
+    Works on sync and async views.'''
+    def validators(request):
+        # Read the version before the view runs: if the data changes mid-request,
+        # the response is labelled as older than it is, which only costs a refetch
+        modified = data_version(view_func.__name__)
+        etag = '"%s"' % hashlib.md5(
+            f"{cache_key(view_func.__name__, request)}:{modified!r}:"
+            f"{negotiate_encoding(request)}".encode()).hexdigest()
+        # HTTP dates are in whole seconds: rounded down, a change later in the
+        # same second would look no newer than a copy from before it
+        return etag, math.ceil(modified)
+
+    def add_validators(response, etag, last_modified):
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            # Until that second is over, another change could still be dated
+            # within it, so until then clients can revalidate by ETag only
+            if time.time() >= last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _async_wrapped_view(request, *args, **kwargs):
+            etag, last_modified = validators(request)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = await view_func(request, *args, **kwargs)
+            elif response.status_code == 304:
+                _count_not_modified(view_func.__name__)
+            return add_validators(response, etag, last_modified)
+        return _async_wrapped_view
+
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        etag, last_modified = validators(request)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view_func(request, *args, **kwargs)
+        elif response.status_code == 304:
+            _count_not_modified(view_func.__name__)
+        return add_validators(response, etag, last_modified)
+    return _wrapped_view
+
+def _count_not_modified(view_name):
+    # The client's own copy was current: a hit without touching the backend
+    metrics.increment('cache_requests', view=view_name, tier='etag', result='hit')
 
 def datastore_cache(timeout_days=1):
+    '''Cache a view's responses in settings.API_CACHE_BACKEND (Datastore, in
+    production). A miss is answered as soon as the view returns; saving it is left
+    to the background cache writer. On async views the backend read (and
+    compression) run in worker threads so they don't block the event loop.'''
     def decorator(view_func):
+        view_name = view_func.__name__
+
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def _async_wrapped_view(request, *args, **kwargs):
+                backend = get_backend()
+                key = cache_key(view_name, request)
+                entry, result, lookup_seconds = await sync_to_async(
+                    _lookup, thread_sensitive=False)(backend, view_name, key)
+                if result == 'hit':
+                    _log_lookup(view_name, backend, result, lookup_seconds)
+                    return _cached_response(request, entry)
+
+                version = data_version(view_name)
+                start = time.perf_counter()
+                response = await view_func(request, *args, **kwargs)
+                compute_seconds = _observe_compute(view_name, start)
+                _log_lookup(view_name, backend, result, lookup_seconds, compute_seconds)
+
+                return await sync_to_async(_store, thread_sensitive=False)(
+                    request, backend, key, view_name, response, timeout_days, version)
+            return _async_wrapped_view
+
         @wraps(view_func)
         def _wrapped_view(request, *args, **kwargs):
-            client = datastore.Client()
-            
-            query_items = sorted(request.GET.items())
-            key_parts = [view_func.__name__] + [f"{k}:{v}" for k, v in query_items]
-            cache_key = hashlib.md5(":".join(key_parts).encode()).hexdigest()
+            backend = get_backend()
             
-            key = client.key('APICache', cache_key)
+            key = cache_key(view_name, request)
             
-            cache_entity = client.get(key)
+            entry, result, lookup_seconds = _lookup(backend, view_name, key)
             
-            if cache_entity:
-                expires = cache_entity.get('expires')
-                if expires and datetime.now().timestamp() < expires:
-                    return JsonResponse(json.loads(cache_entity['response']))
+            if result == 'hit':
+                _log_lookup(view_name, backend, result, lookup_seconds)
+                return _cached_response(request, entry)
             
+            version = data_version(view_name)
+            start = time.perf_counter()
             response = view_func(request, *args, **kwargs)
+            compute_seconds = _observe_compute(view_name, start)
+            _log_lookup(view_name, backend, result, lookup_seconds, compute_seconds)
             
-            # Create entity and exclude 'response' from indexes
-            cache_entity = datastore.Entity(key, exclude_from_indexes=['response'])
-            cache_entity.update({
-                'response': response.content.decode(),
-                'expires': (datetime.now() + timedelta(days=timeout_days)).timestamp(),
-                'created_at': datetime.now().timestamp(),
-                'view_name': view_func.__name__
-            })
-            client.put(cache_entity)
-            
-            return response
+            return _store(request, backend, key, view_name, response, timeout_days, version)
         return _wrapped_view
     return decorator
 
+def _lookup(backend, view_name, key) -> tuple:
+    '''Read a cache entry, returning it along with whether it was a 'hit', a
+    'miss' or 'stale' (there, but expired or computed before the view's data last
+    changed) and how many seconds that took.
+
+    If the backend failed (an 'error') or its circuit breaker is open (a
+    'bypass'), there's no entry and the view computes the response itself.'''
+    breaker = get_breaker(backend.tier)
+    if not breaker.allow():
+        metrics.increment('cache_requests', view=view_name, tier=backend.tier, result='bypass')
+        return None, 'bypass', 0.0
+    start = time.perf_counter()
+    try:
+        entry = backend.get(view_name, key)
+    except Exception:
+        seconds = time.perf_counter() - start
+        breaker.record(seconds, failed=True)
+        logger.exception('Could not read %s from the %s cache', view_name, backend.tier)
+        entry, result = None, 'error'
+    else:
+        seconds = time.perf_counter() - start
+        breaker.record(seconds)
+        result = 'miss' if not entry else 'hit' if _is_fresh(entry, view_name) else 'stale'
+    timing.record('cache', seconds)
+    metrics.observe('cache_get_seconds', seconds, view=view_name, tier=backend.tier)
+    metrics.increment('cache_requests', view=view_name, tier=backend.tier, result=result)
+    return entry, result, seconds
+
+def _observe_compute(view_name, start) -> float:
+    seconds = time.perf_counter() - start
+    timing.record('view', seconds)
+    metrics.observe('view_compute_seconds', seconds, view=view_name)
+    return seconds
+
+def _log_lookup(view_name, backend, result, lookup_seconds, compute_seconds=None):
+    fields = {'event': 'api_cache', 'view': view_name, 'tier': backend.tier, 'result': result,
+              'lookup_ms': round(lookup_seconds * 1000, 2)}
+    if compute_seconds is not None:
+        fields['compute_ms'] = round(compute_seconds * 1000, 2)
+    telemetry_logger.info(json.dumps(fields))
+
+def _is_fresh(entry, view_name) -> bool:
+    if not entry:
+        return False
+    # Clearing the cache only removes what's there: an instance yet to hear of a
+    # change elsewhere could still write back a response from before it
+    if entry.get('data_changed_at', 0) < changed_at(view_name):
+        return False
+    expires = entry.get('expires')
+    return bool(expires) and datetime.now().timestamp() < expires
+
+def _store(request, backend, key, view_name, response, timeout_days, version) -> HttpResponse:
+    '''Queue a freshly computed response to be saved, and serve it. Only the
+    encoding this client wants is compressed here; the writer adds the others.
+
+    The view's own response is served, with whatever status and headers it set.
+    Entries only keep the body and Surrogate-Key, so only 200s are cached.'''
+    if response.status_code != 200:
+        return response
+    encoding = negotiate_encoding(request)
+    encodings = [] if encoding == 'identity' else [encoding]
+    with timing.stage('compress'):
+        variants = {f'response_{name}': body
+                    for name, body in compressed_variants(response.content, encodings).items()}
+    entry = {
+        'response': response.content.decode(),
+        **variants,
+        'surrogate_key': response.get('Surrogate-Key', ''),
+        'expires': (datetime.now() + timedelta(days=timeout_days)).timestamp(),
+        'created_at': datetime.now().timestamp(),
+        'view_name': view_name
+    }
+    if encodings:
+        response.content = variants[f'response_{encoding}']
+        response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(response.content))
+    patch_vary_headers(response, ['Accept-Encoding'])
+    get_writer().submit(backend, key, entry, version)
+    return response
+
+def _cached_response(request, entry) -> HttpResponse:
+    '''Serve a cache entry as-is, in the best encoding stored for it that the
+    client accepts. Entries cached before compression have only 'response'.'''
+    available = {encoding for encoding in COMPRESSORS if entry.get(f'response_{encoding}')}
+    encoding = negotiate_encoding(request, available)
+    if encoding == 'identity':
+        response = HttpResponse(entry['response'], content_type='application/json')
+    else:
+        response = HttpResponse(entry[f'response_{encoding}'],
+                                content_type='application/json')
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if entry.get('surrogate_key'):
+        response['Surrogate-Key'] = entry['surrogate_key']
+    return response
+
+class CircuitOpen(Exception):
+    '''The backend's circuit breaker is open, so it wasn't called'''
+
+def _call_through_breaker(backend, method, *args):
+    '''Call one of backend's methods unless its circuit breaker is open, and
+    tell the breaker how it went'''
+    breaker = get_breaker(backend.tier)
+    if not breaker.allow():
+        raise CircuitOpen(backend.tier)
+    start = time.perf_counter()
+    try:
+        result = method(*args)
+    except Exception:
+        breaker.record(time.perf_counter() - start, failed=True)
+        raise
+    breaker.record(time.perf_counter() - start)
+    return result
+
 # Helper function to clear cache
 def clear_cache(view_name=None):
     """
@@ -49,15 +392,46 @@ def clear_cache(view_name=None):
         view_name (str, optional): Name of the view to clear cache for. 
                                  If None, clears all cache.
     """
-    client = datastore.Client()
-    
-    # Create query
-    query = client.query(kind='APICache')
-    if view_name:
-        query.add_filter('view_name', '=', view_name)
-    
-    # Delete matching entities
-    entities = query.fetch()
-    keys = [entity.key for entity in entities]
-    if keys:
-        client.delete_multi(keys)
\ No newline at end of file
+    backend = get_backend()
+    view_label = view_name or 'all'
+    start = time.perf_counter()
+    with invalidation_lock:
+        try:
+            cleared = _call_through_breaker(backend, backend.clear, view_name)
+        except CircuitOpen:
+            cleared = None
+            metrics.increment('cache_clears_skipped', view=view_label, tier=backend.tier)
+        except Exception:
+            cleared = None
+            metrics.increment('cache_clear_failures', view=view_label, tier=backend.tier)
+            logger.exception('Could not clear %s from the %s cache', view_label, backend.tier)
+        # Only once the old responses are gone, or a request in between could
+        # label one of them with the new version. Any still there are stamped
+        # as older than the new version, so lookups take them as stale anyway.
+        bump_data_version(view_name)
+    seconds = time.perf_counter() - start
+    metrics.observe('cache_clear_seconds', seconds, view=view_label, tier=backend.tier)
+    if cleared is not None:
+        metrics.increment('cache_entries_cleared', cleared, view=view_label, tier=backend.tier)
+    telemetry_logger.info(json.dumps({
+        'event': 'api_cache_clear', 'view': view_label, 'tier': backend.tier,
+        'entries': cleared, 'clear_ms': round(seconds * 1000, 2)}))
+
+
+def prune_cache(batch_size=500):
+    '''Delete the cached responses that have expired, batch_size at a time.
+
+    Returns how many were deleted (None if the backend expires entries itself)
+    and how many seconds that took. Raises CircuitOpen if the backend's circuit
+    breaker is open: they'll still be there next time.'''
+    backend = get_backend()
+    start = time.perf_counter()
+    pruned = _call_through_breaker(backend, backend.prune, time.time(), batch_size)
+    seconds = time.perf_counter() - start
+    metrics.observe('cache_prune_seconds', seconds, tier=backend.tier)
+    if pruned is not None:
+        metrics.increment('cache_entries_pruned', pruned, tier=backend.tier)
+    telemetry_logger.info(json.dumps({
+        'event': 'api_cache_prune', 'tier': backend.tier,
+        'entries': pruned, 'prune_ms': round(seconds * 1000, 2)}))
+    return pruned, seconds
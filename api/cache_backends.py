@@ -0,0 +1,338 @@
+'''Where datastore_cache keeps its responses. settings.API_CACHE_BACKEND picks one.
+
+Entries are dicts with 'response' (the JSON text), a 'response_<encoding>' for
+each compressed variant, 'surrogate_key', 'expires' and 'created_at' (Unix
+timestamps), 'view_name' and 'data_changed_at' (see cache.changed_at). Each is
+stored under the md5 from cache_key.
+Expired entries are only deleted by prune (see cache_sweeper.py).
+
+Backends also hold each view's data version (see cache.data_version), which
+get_versions and set_version read and write for every instance to share.'''
+import gzip
+import json
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# google.cloud.datastore takes the best part of half a second to import, so it
+# is imported on first use rather than when the models (and with them this
+# module) are loaded at boot.
+_client = None
+
+def get_client():
+    '''Return the process-wide Datastore client, creating it on first use'''
+    global _client
+    if _client is None:
+        from google.cloud import datastore
+        _client = datastore.Client()
+    return _client
+
+def forget_client():
+    '''Drop the client, so that gunicorn's workers each create their own rather
+    than sharing one (and its connections) across the fork'''
+    global _client
+    _client = None
+
+
+# The most keys Datastore deletes (or entities it writes) in one call
+DELETE_BATCH_SIZE = 500
+# Datastore also limits each write to 10 MiB
+MAX_PUT_BYTES = 8 * 1024 * 1024
+
+
+class DatastoreBackend:
+    '''One Datastore entity per response, of kind KIND, named by its cache key.
+
+    Entities can't exceed 1 MiB. The uncompressed JSON of one that would exceed
+    MAX_ENTITY_BYTES is left out, to be decompressed from its gzip variant when
+    read. If that's not enough, the compressed variants are split into entities
+    of kind KIND + 'Chunk', written before the entity that lists them. Chunks are
+    named by an id new to each write, so a reader never mixes two writes' chunks,
+    and a missing one makes the whole entry a miss.
+
+    Every call gives up after TIMEOUT seconds, rather than leaving the request
+    (or the cache writer, clear_cache or the sweeper) waiting on a struggling
+    Datastore.'''
+    # How the metrics label this backend
+    tier = 'datastore'
+
+    def __init__(self, KIND='APICache', MAX_ENTITY_BYTES=1000 * 1000, TIMEOUT=2.0, **options):
+        self.kind = KIND
+        self.timeout = TIMEOUT
+        self.version_kind = KIND + 'Version'
+        self.chunk_kind = KIND + 'Chunk'
+        self.max_entity_bytes = MAX_ENTITY_BYTES
+
+    def get(self, view_name, key):
+        client = get_client()
+        entity = client.get(client.key(self.kind, key), timeout=self.timeout)
+        if entity is None:
+            return None
+        entry = dict(entity)
+        if 'chunks' in entry and not self._join_chunks(client, key, entry):
+            return None
+        if 'response' not in entry:
+            entry['response'] = gzip.decompress(entry['response_gzip']).decode()
+        return entry
+
+    def set_many(self, entries) -> None:
+        from google.cloud import datastore
+        client = get_client()
+        entities, chunks = [], []
+        for key, entry in entries.items():
+            entry = dict(entry)
+            if _entity_size(key, entry) > self.max_entity_bytes:
+                if 'response_gzip' not in entry:
+                    entry['response_gzip'] = gzip.compress(entry['response'].encode())
+                del entry['response']
+            if _entity_size(key, entry) > self.max_entity_bytes:
+                chunks.extend(self._split_into_chunks(client, key, entry))
+            # Only view_name (for clear), expires and created_at are worth indexing
+            entity = datastore.Entity(client.key(self.kind, key), exclude_from_indexes=[
+                name for name in entry if name.startswith(('response', 'chunk'))
+                or name in ('surrogate_key', 'data_changed_at')])
+            entity.update(entry)
+            entities.append(entity)
+        # Chunks first, so no entity lists chunks that aren't there yet
+        _put_in_batches(client, chunks, self.timeout)
+        _put_in_batches(client, entities, self.timeout)
+
+    def get_versions(self, names) -> dict:
+        client = get_client()
+        entities = client.get_multi([client.key(self.version_kind, name) for name in names],
+                                    timeout=self.timeout)
+        return {entity.key.name: entity['version'] for entity in entities}
+
+    def set_version(self, name, version) -> None:
+        from google.cloud import datastore
+        client = get_client()
+        entity = datastore.Entity(client.key(self.version_kind, name))
+        entity['version'] = version
+        client.put(entity, timeout=self.timeout)
+
+    def _split_into_chunks(self, client, key, entry) -> list:
+        from google.cloud import datastore
+        chunk_id = uuid.uuid4().hex
+        # Leaving room for the chunk's name, view_name and expires
+        size = self.max_entity_bytes - 1024
+        chunks, counts = [], {}
+        for name in [name for name in entry if name.startswith('response_')]:
+            value = entry.pop(name)
+            pieces = [value[start:start + size] for start in range(0, len(value), size)]
+            counts[name] = len(pieces)
+            for number, piece in enumerate(pieces):
+                chunk = datastore.Entity(
+                    client.key(self.chunk_kind, _chunk_name(key, chunk_id, name, number)),
+                    exclude_from_indexes=['data'])
+                chunk.update({'data': piece, 'view_name': entry['view_name'],
+                              'expires': entry['expires']})
+                chunks.append(chunk)
+        entry['chunk_id'] = chunk_id
+        entry['chunks'] = json.dumps(counts)
+        return chunks
+
+    def _join_chunks(self, client, key, entry) -> bool:
+        '''Replace entry's list of chunks with the variants they hold, or return
+        False if any are missing'''
+        counts, chunk_id = json.loads(entry.pop('chunks')), entry.pop('chunk_id')
+        names = {name: [_chunk_name(key, chunk_id, name, number) for number in range(count)]
+                 for name, count in counts.items()}
+        found = {chunk.key.name: chunk['data'] for chunk in client.get_multi(
+            [client.key(self.chunk_kind, chunk_name)
+             for chunk_names in names.values() for chunk_name in chunk_names],
+            timeout=self.timeout)}
+        if any(chunk_name not in found
+               for chunk_names in names.values() for chunk_name in chunk_names):
+            return False
+        for name, chunk_names in names.items():
+            entry[name] = b''.join(found[chunk_name] for chunk_name in chunk_names)
+        return True
+
+    def clear(self, view_name=None) -> int:
+        '''Returns how many entries were cleared, not counting their chunks'''
+        client = get_client()
+        cleared = self._clear(client, self.kind, view_name)
+        self._clear(client, self.chunk_kind, view_name)
+        return cleared
+
+    def _clear(self, client, kind, view_name) -> int:
+        query = client.query(kind=kind)
+        if view_name:
+            query.add_filter('view_name', '=', view_name)
+        query.keys_only()
+        keys = [entity.key for entity in query.fetch(timeout=self.timeout)]
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            client.delete_multi(keys[start:start + DELETE_BATCH_SIZE], timeout=self.timeout)
+        return len(keys)
+
+    def prune(self, now, batch_size=DELETE_BATCH_SIZE) -> int:
+        '''Delete the entities that expired before now, batch_size at a time.
+        That includes chunks left behind when their entry was overwritten.'''
+        client = get_client()
+        batch_size = min(batch_size, DELETE_BATCH_SIZE)
+        pruned = self._prune(client, self.kind, now, batch_size)
+        self._prune(client, self.chunk_kind, now, batch_size)
+        return pruned
+
+    def _prune(self, client, kind, now, batch_size) -> int:
+        deleted = 0
+        while True:
+            query = client.query(kind=kind)
+            query.add_filter('expires', '<', now)
+            query.keys_only()
+            keys = [entity.key for entity in query.fetch(limit=batch_size, timeout=self.timeout)]
+            if keys:
+                client.delete_multi(keys, timeout=self.timeout)
+            deleted += len(keys)
+            if len(keys) < batch_size:
+                return deleted
+
+
+def _entity_size(key, entry) -> int:
+    '''Roughly what Datastore counts towards its limit: names and values'''
+    size = len(key)
+    for name, value in entry.items():
+        size += len(name) + (len(value.encode()) if isinstance(value, str)
+                             else len(value) if isinstance(value, bytes) else 8)
+    return size
+
+
+def _chunk_name(key, chunk_id, name, number) -> str:
+    return f'{key}:{chunk_id}:{name}:{number}'
+
+
+def _put_in_batches(client, entities, timeout):
+    batch, size = [], 0
+    for entity in entities:
+        entity_size = _entity_size(entity.key.name, entity)
+        if batch and (len(batch) == DELETE_BATCH_SIZE or size + entity_size > MAX_PUT_BYTES):
+            client.put_multi(batch, timeout=timeout)
+            batch, size = [], 0
+        batch.append(entity)
+        size += entity_size
+    if batch:
+        client.put_multi(batch, timeout=timeout)
+
+
+class DjangoCacheBackend:
+    '''Entries in one of settings.CACHES (file, locmem, redis...).
+
+    Django's caches can't delete by view, so clearing bumps a generation number
+    that is part of every key instead, and the old entries are left to expire.'''
+    tier = 'django_cache'
+
+    def __init__(self, ALIAS='default', KEY_PREFIX='api', **options):
+        self.alias = ALIAS
+        self.prefix = KEY_PREFIX
+
+    @property
+    def cache(self):
+        # Django's cache handles are per thread
+        return caches[self.alias]
+
+    def _generation_keys(self, view_name) -> tuple:
+        return f'{self.prefix}:generation', f'{self.prefix}:generation:{view_name}'
+
+    def _key(self, view_name, key) -> str:
+        generations = self.cache.get_many(self._generation_keys(view_name))
+        generation = '.'.join(str(generations.get(name, 0))
+                              for name in self._generation_keys(view_name))
+        return f'{self.prefix}:{view_name}:{generation}:{key}'
+
+    def get(self, view_name, key):
+        return self.cache.get(self._key(view_name, key))
+
+    def set_many(self, entries) -> None:
+        now = time.time()
+        for key, entry in entries.items():
+            self.cache.set(self._key(entry['view_name'], key), entry,
+                           timeout=max(1, int(entry['expires'] - now)))
+
+    def clear(self, view_name=None) -> None:
+        '''Returns None, as there's no telling how many entries that orphaned'''
+        name = self._generation_keys(view_name)[1 if view_name else 0]
+        # Generations never expire, or clearing could be undone. The file and
+        # database caches' incr sets the key again with the default timeout,
+        # hence the touch.
+        self.cache.add(name, 0, timeout=None)
+        self.cache.incr(name)
+        self.cache.touch(name, None)
+
+    def get_versions(self, names) -> dict:
+        found = self.cache.get_many([self._version_key(name) for name in names])
+        return {name: found[self._version_key(name)]
+                for name in names if self._version_key(name) in found}
+
+    def set_version(self, name, version) -> None:
+        self.cache.set(self._version_key(name), version, timeout=None)
+
+    def _version_key(self, name) -> str:
+        return f'{self.prefix}:version:{name}'
+
+    def prune(self, now, batch_size=None) -> None:
+        '''Nothing to do: every entry is set with its own timeout, and the
+        cache evicts it then. Returns None, as for clear.'''
+
+
+class InMemoryBackend:
+    '''A dict, for tests and local benchmarks. Never expires anything itself.'''
+    tier = 'memory'
+
+    def __init__(self, **options):
+        self.entries = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, view_name, key):
+        return self.entries.get(key)
+
+    def set_many(self, entries) -> None:
+        with self.lock:
+            self.entries.update(entries)
+
+    def clear(self, view_name=None) -> int:
+        with self.lock:
+            keys = [key for key, entry in self.entries.items()
+                    if not view_name or entry['view_name'] == view_name]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def get_versions(self, names) -> dict:
+        return {name: self.versions[name] for name in names if name in self.versions}
+
+    def set_version(self, name, version) -> None:
+        self.versions[name] = version
+
+    def prune(self, now, batch_size=None) -> int:
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if entry['expires'] < now]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    '''Return the backend settings.API_CACHE_BACKEND describes, created once'''
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                options = dict(settings.API_CACHE_BACKEND)
+                _backend = import_string(options.pop('BACKEND'))(**options)
+    return _backend
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'API_CACHE_BACKEND':
+        _backend = None
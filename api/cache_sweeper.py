@@ -0,0 +1,70 @@
+import logging
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CacheSweeper:
+    '''Prunes the expired cache entries every interval seconds, from a
+    background thread, so they don't pile up between runs of prune_api_cache.
+
+    Every instance runs its own; pruning twice at once only deletes nothing the
+    second time.'''
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        # Started on first request rather than at import: with gunicorn's
+        # --preload, a thread started in the master process wouldn't survive the fork.
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.stopped.clear()
+                    self.thread = threading.Thread(
+                        target=self._run, name='cache-sweeper', daemon=True)
+                    self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        from .cache import CircuitOpen, prune_cache
+
+        while not self.stopped.wait(self.interval):
+            try:
+                prune_cache(self.batch_size)
+            except CircuitOpen:
+                metrics.increment('cache_prunes_skipped')
+            except Exception:
+                metrics.increment('cache_prune_failures')
+                logger.exception('Could not prune the cache')
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def get_sweeper() -> CacheSweeper:
+    global _sweeper
+    if _sweeper is None:
+        with _sweeper_lock:
+            if _sweeper is None:
+                _sweeper = CacheSweeper(**{
+                    name.lower(): value for name, value in settings.API_CACHE_SWEEPER.items()})
+    return _sweeper
+
+
+def start_sweeper(**kwargs):
+    '''Runs at the start of every request, starting the sweeper if it's enabled'''
+    if settings.API_CACHE_SWEEPER['INTERVAL']:
+        get_sweeper().start()
@@ -0,0 +1,163 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .circuit_breaker import get_breaker
+from .compression import COMPRESSORS, compressed_variants
+
+logger = logging.getLogger(__name__)
+
+
+# Held by clear_cache while clearing, and by the writer while checking its
+# entries are current and stamping them, so that no entry is stamped as current
+# with data that has just been cleared. The writes themselves happen outside it.
+invalidation_lock = threading.Lock()
+
+
+class CacheWriter:
+    '''Saves cache entries from a background thread, so that a cache miss
+    doesn't wait on a second cache round trip (to Datastore, in production)
+    before responding.
+
+    Entries are queued and written in batches with the backend's set_many. If the queue is
+    full the entry is dropped (and counted): the response has already been
+    served, and the next miss will try again. So is an entry whose view's data
+    changed while it was queued, since it was computed from the old data, and
+    every entry while the backend's circuit breaker is open.'''
+    def __init__(self, queue_size, batch_size, max_batch_bytes):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, backend, key, entry, data_version) -> bool:
+        '''Queue an entry for writing to backend, unless the queue is full.
+        data_version is the version of the entry's view from before its response
+        was computed.'''
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((backend, key, entry, data_version))
+        except queue.Full:
+            metrics.increment('cache_writes_dropped', reason='queue_full')
+            return False
+        metrics.increment('cache_writes_queued')
+        return True
+
+    def flush(self, timeout=None) -> bool:
+        '''Wait until everything queued so far has been written (or dropped).
+        Returns False if that didn't happen within timeout seconds.'''
+        if self.thread is None:
+            return True
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(
+                lambda: not self.queue.unfinished_tasks, timeout)
+
+    def _ensure_started(self):
+        # Started on first use rather than at import: with gunicorn's --preload,
+        # a thread started in the master process wouldn't survive the fork.
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(
+                        target=self._run, name='cache-writer', daemon=True)
+                    self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = _entry_size(batch[0][2])
+            while len(batch) < self.batch_size and size < self.max_batch_bytes:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += _entry_size(item[2])
+            try:
+                self._write(batch)
+            except Exception:
+                metrics.increment('cache_write_failures')
+                logger.exception('Could not write %s cache entries', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        from .cache import changed_at, data_version
+
+        entries = {}
+        for backend, key, entry, version in batch:
+            _add_missing_variants(entry)
+            # A later entry for the same key replaces an earlier one
+            entries.setdefault(backend, {})[key] = (entry, version)
+        for backend, backend_entries in entries.items():
+            current = {}
+            with invalidation_lock:
+                for key, (entry, version) in backend_entries.items():
+                    if data_version(entry['view_name']) == version:
+                        # Unchanged since the response was computed, so neither has this
+                        entry['data_changed_at'] = changed_at(entry['view_name'])
+                        current[key] = (entry, version)
+                    else:
+                        metrics.increment('cache_writes_dropped', reason='stale')
+            if not current:
+                continue
+            breaker = get_breaker(backend.tier)
+            if not breaker.allow():
+                metrics.increment('cache_writes_dropped', len(current), reason='circuit_open')
+                continue
+            start = time.perf_counter()
+            try:
+                backend.set_many({key: entry for key, (entry, _) in current.items()})
+            except Exception:
+                breaker.record(time.perf_counter() - start, failed=True)
+                raise
+            finally:
+                metrics.observe('cache_set_seconds', time.perf_counter() - start,
+                                tier=backend.tier)
+            breaker.record(time.perf_counter() - start)
+            metrics.increment('cache_writes', len(current))
+            metrics.increment('cache_write_batches')
+            # Any cleared meanwhile may have landed after the clear. Their stamps
+            # are older than their views' data now, so lookups take them as stale.
+            superseded = sum(data_version(entry['view_name']) != version
+                             for entry, version in current.values())
+            if superseded:
+                metrics.increment('cache_writes_superseded', superseded)
+
+
+def _entry_size(entry) -> int:
+    return sum(len(value) for value in entry.values() if isinstance(value, (str, bytes)))
+
+
+def _add_missing_variants(entry):
+    '''The request only compressed the encoding it served; do the rest here'''
+    missing = [encoding for encoding in COMPRESSORS if f'response_{encoding}' not in entry]
+    for encoding, compressed in compressed_variants(entry['response'].encode(), missing).items():
+        entry[f'response_{encoding}'] = compressed
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> CacheWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = CacheWriter(**{
+                    name.lower(): value for name, value in settings.API_CACHE_WRITER.items()})
+    return _writer
+
+
+@atexit.register
+def _flush_at_exit():
+    if _writer is not None:
+        _writer.flush(timeout=5)
@@ -0,0 +1,91 @@
+'''What changed in the public data since a mirror last synced, for /api/changes.
+
+Every record has an updated_at, and deletions leave a Tombstone. A sync returns
+the records saved and deleted since its token, and a token for the next. As a
+save's updated_at is set before its transaction commits (and a replica may lag
+behind that), the next token reaches back settings.API_CHANGES_OVERLAP_SECONDS:
+a mirror gets the records changed in that window again, rather than missing
+any committed late. Applying a record twice does no harm.
+
+Tombstones are only kept for settings.API_CHANGES_RETENTION_DAYS (see
+prune_tombstones). A token older than that could miss deletions, so it gets
+every record instead, marked as a resync: the mirror drops any it doesn't list.'''
+import base64
+import binascii
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import (
+    AllGrantsFundGrant, Allotment, Charity, Evaluation, Intervention, MaxImpactFundGrant,
+    Tombstone)
+
+# By the name of their list in the response
+COLLECTIONS = {
+    'charities': Charity,
+    'interventions': Intervention,
+    'evaluations': Evaluation,
+    'max_impact_fund_grants': MaxImpactFundGrant,
+    'all_grants_fund_grants': AllGrantsFundGrant,
+    'allotments': Allotment,
+}
+_COLLECTION_NAMES = {model._meta.model_name: name for name, model in COLLECTIONS.items()}
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def encode_token(moment) -> str:
+    microseconds = (moment - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)) // timedelta(
+        microseconds=1)
+    return base64.urlsafe_b64encode(str(microseconds).encode()).decode().rstrip('=')
+
+
+def decode_token(token) -> datetime:
+    try:
+        microseconds = int(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(
+            microseconds=microseconds)
+    except (binascii.Error, ValueError, OverflowError):
+        raise InvalidToken(token)
+
+
+def changes_since(since=None) -> dict:
+    '''Every record saved since since (a datetime), every one deleted since, and
+    the token to ask for the changes after these. Given no since, or one from
+    before the tombstones kept, every record and whether that's a resync.'''
+    # Taken before reading anything, so that nothing saved during the reads is
+    # missed by the next sync
+    now = timezone.now()
+    resync = since is not None and since < now - retention()
+    if resync:
+        since = None
+    changes, deletions = {}, {name: [] for name in COLLECTIONS}
+    for name, model in COLLECTIONS.items():
+        records = model.objects.order_by('updated_at', 'id')
+        if since is not None:
+            records = records.filter(updated_at__gte=since)
+        changes[name] = list(records.values(
+            *[field.attname for field in model._meta.concrete_fields]))
+    if since is not None:
+        for model_name, object_id in Tombstone.objects.filter(
+                deleted_at__gte=since).order_by('deleted_at', 'id').values_list(
+                    'model_name', 'object_id'):
+            deletions[_COLLECTION_NAMES[model_name]].append(object_id)
+    next_since = now - timedelta(seconds=settings.API_CHANGES_OVERLAP_SECONDS)
+    if since is not None:
+        next_since = max(next_since, since)
+    return {'changes': changes, 'deletions': deletions, 'next': encode_token(next_since),
+            'resync': resync}
+
+
+def retention() -> timedelta:
+    return timedelta(days=settings.API_CHANGES_RETENTION_DAYS)
+
+
+def prune_tombstones() -> int:
+    '''Delete the tombstones older than the retention window, returning how many'''
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=timezone.now() - retention()).delete()
+    return deleted
@@ -0,0 +1,92 @@
+'''Stops calling a cache tier that keeps failing or being slow, so that requests
+go straight to the database (which can serve everything uncached for a while)
+rather than each waiting on a sick Datastore first.'''
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+# The cache_circuit_state gauge's value for each state
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitBreaker:
+    '''Closed, every call goes through. After failure_threshold failures in a
+    row (errors, or calls slower than slow_call_seconds) it opens, and calls are
+    skipped. After reset_seconds it lets a single probe through (half open): if
+    that succeeds it closes again, otherwise it stays open for another reset_seconds.'''
+    def __init__(self, tier, failure_threshold, slow_call_seconds, reset_seconds):
+        self.tier = tier
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+        metrics.set_gauge('cache_circuit_state', STATE_VALUES[CLOSED], tier=tier)
+
+    def allow(self) -> bool:
+        '''Whether to make the call. Each allowed call must be followed by record.'''
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._change_state(HALF_OPEN)
+                return True
+            # Open, or half open with the probe still out
+            metrics.increment('cache_circuit_rejections', tier=self.tier)
+            return False
+
+    def record(self, seconds, failed=False) -> None:
+        '''Record how an allowed call went'''
+        with self.lock:
+            if failed or seconds > self.slow_call_seconds:
+                self.failures += 1
+                if self.state == HALF_OPEN or (
+                        self.state == CLOSED and self.failures >= self.failure_threshold):
+                    self.opened_at = time.monotonic()
+                    self._change_state(OPEN)
+            else:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self._change_state(CLOSED)
+
+    def _change_state(self, state):
+        logger.warning('Cache circuit for %s went from %s to %s', self.tier, self.state, state)
+        self.state = state
+        metrics.set_gauge('cache_circuit_state', STATE_VALUES[state], tier=self.tier)
+        metrics.increment('cache_circuit_transitions', tier=self.tier, state=state)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(tier) -> CircuitBreaker:
+    '''Return the process-wide breaker for a cache tier, as configured in
+    settings.API_CACHE_CIRCUIT_BREAKER'''
+    breaker = _breakers.get(tier)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(tier)
+            if breaker is None:
+                breaker = _breakers[tier] = CircuitBreaker(tier, **{
+                    name.lower(): value
+                    for name, value in settings.API_CACHE_CIRCUIT_BREAKER.items()})
+    return breaker
+
+
+@receiver(setting_changed)
+def reset_breakers(setting, **kwargs):
+    if setting in ('API_CACHE_CIRCUIT_BREAKER', 'API_CACHE_BACKEND'):
+        with _breakers_lock:
+            _breakers.clear()
@@ -0,0 +1,72 @@
+'''Keeping each instance's data versions in step with the others'.
+
+Cloud Run runs several instances, and a save on one only bumps that one's data
+versions. Each also records its bump in the shared cache backend, and every
+instance polls the backend for newer versions every
+settings.API_DATA_VERSION_POLL_SECONDS. Whatever is keyed by data_version (ETags,
+the cache writer's staleness check, anything cached in memory) then goes stale
+on every instance within that interval, rather than on just the one edited.'''
+import logging
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class VersionPoller:
+    '''Runs sync_data_versions every interval seconds, from a background thread
+    so that no request waits on the backend for it'''
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        # Started on first request rather than at import: with gunicorn's
+        # --preload, a thread started in the master process wouldn't survive the fork.
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.stopped.clear()
+                    self.thread = threading.Thread(
+                        target=self._run, name='data-version-poller', daemon=True)
+                    self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        from .cache import sync_data_versions
+
+        while not self.stopped.wait(self.interval):
+            try:
+                sync_data_versions()
+            except Exception:
+                metrics.increment('data_version_poll_failures')
+                logger.exception('Could not poll the shared data versions')
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller() -> VersionPoller:
+    global _poller
+    if _poller is None:
+        with _poller_lock:
+            if _poller is None:
+                _poller = VersionPoller(settings.API_DATA_VERSION_POLL_SECONDS)
+    return _poller
+
+
+def start_poller(**kwargs):
+    '''Runs at the start of every request and event stream, starting the poller
+    if it's enabled'''
+    if settings.API_DATA_VERSION_POLL_SECONDS:
+        get_poller().start()
@@ -0,0 +1,56 @@
+'''Response compression, done once when a response is cached rather than on
+every request that reads it back'''
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression happens once per cache fill, so favour size over speed, but not
+# at brotli's top quality, which takes seconds on our biggest responses.
+COMPRESSORS = {'gzip': lambda body: gzip.compress(body, compresslevel=9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=9)
+
+# Most preferred first
+PREFERENCE = ('br', 'gzip')
+
+
+def accepted_encodings(request) -> dict:
+    '''The content codings the client names, each with whether it accepts it
+    (a non-zero q-value) or refuses it (q=0)'''
+    accepted = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, parameters = coding.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality > 0
+    return accepted
+
+
+def negotiate_encoding(request, available=None) -> str:
+    '''Pick the best of the available codings (by default, every one we can
+    produce) that the client accepts. Returns 'identity' if there's none.'''
+    available = COMPRESSORS if available is None else available
+    accepted = accepted_encodings(request)
+    for encoding in PREFERENCE:
+        # A coding named outright overrides *, either way
+        if encoding in available and accepted.get(encoding, accepted.get('*', False)):
+            return encoding
+    return 'identity'
+
+
+def compressed_variants(body: bytes, encodings=None) -> dict:
+    '''body compressed with each of encodings (by default, every one we can produce)'''
+    encodings = COMPRESSORS if encodings is None else encodings
+    return {encoding: COMPRESSORS[encoding](body) for encoding in encodings}
@@ -0,0 +1,72 @@
+from datetime import date
+
+from django.utils.translation import get_language
+
+from .__init__ import get_currency_converter
+from . import timing
+
+
+class CurrencyManager():
+    '''Deals with currency conversions
+
+    #converted_price converts US cents to other currency specified in a context object
+    #currency returns currency from a context object
+    '''
+    DEFAULT_LANGUAGE_CURRENCY_MAPPING = {
+        'no': 'NOK',
+        'en': 'USD',
+        'et': 'EUR',
+        'sv': 'SEK',
+    }
+
+    def converted_price(self, context, original_value, model_instance) -> float:
+        '''Get latest conversion on relevant date and return cost per
+        output in specified currency, else in USD. Fetches today's currency data
+        from the ECB website if we don't already have it'''
+        return self._converted_price_and_date(
+            context, model_instance, original_value)['converted_value']
+
+    def actual_exchange_rate_date(self, context, model_instance) -> date:
+        '''Get the actual date the currency was converted on, after
+        adjusting for days where it wasn't available. Fetches today's currency data
+        from the ECB website if we don't already have it'''
+        return self._converted_price_and_date(
+            context, model_instance)['conversion_date']
+
+    def currency(self, context) -> str:
+        '''Return specified currency code, else USD'''
+        return (context.get('currency')
+                or self.DEFAULT_LANGUAGE_CURRENCY_MAPPING[get_language()]).upper()
+
+    def _converted_price_and_date(self, context, model_instance, original_value=1) -> dict:
+
+        conversion_date = self._targeted_conversion_date(
+            context, model_instance)
+
+        currency_code = (context.get('currency')
+                         or self.DEFAULT_LANGUAGE_CURRENCY_MAPPING[get_language()]).upper()
+
+        with timing.stage('convert'):
+            converted_value = get_currency_converter().convert(
+                original_value / 100,
+                'USD',
+                currency_code,
+                conversion_date)
+
+        return {'conversion_date': conversion_date,
+                'converted_value': converted_value}
+
+    def _targeted_conversion_date(self, context, model_instance) -> date:
+        if context.get('conversion_year'):
+            attempted_conversion_date = date(
+                int(context.get('conversion_year')),
+                int(context.get('conversion_month') or 1),
+                int(context.get('conversion_day') or 1))
+        elif context.get('donation_year'):
+            attempted_conversion_date = date(
+                int(context.get('donation_year')),
+                int(context.get('donation_month') or 1),
+                int(context.get('donation_day') or 1))
+        else:
+            attempted_conversion_date = model_instance.start_date()
+        return attempted_conversion_date
@@ -0,0 +1,71 @@
+import logging
+
+import django
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def record_new_connection(sender, connection, **kwargs):
+    metrics.increment('db_connections_opened', alias=connection.alias)
+
+
+def check_connection_health(**kwargs):
+    '''Runs at the start of every request. Each persistent connection is checked
+    just before its first query of the request, as Django 4.1 does natively, so
+    that the aliases a request doesn't use cost it nothing'''
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        if not hasattr(connection, 'api_check_pending'):
+            _check_before_first_use(connection)
+        connection.api_check_pending = True
+
+
+def _check_before_first_use(connection):
+    cursor = connection._cursor
+
+    def _cursor(*args, **kwargs):
+        if connection.api_check_pending:
+            connection.api_check_pending = False
+            _check(connection)
+        return cursor(*args, **kwargs)
+    connection._cursor = _cursor
+
+
+def _check(connection):
+    '''Count a persistent connection being reused and, on Django versions without
+    native CONN_HEALTH_CHECKS support (< 4.1), close it if the database has dropped
+    it, so that the query reconnects instead of failing'''
+    if connection.connection is None:
+        return
+    if (django.VERSION < (4, 1)
+            and connection.settings_dict.get('CONN_HEALTH_CHECKS')
+            and not connection.is_usable()):
+        metrics.increment('db_connections_unusable', alias=connection.alias)
+        connection.close()
+        return
+    metrics.increment('db_connections_reused', alias=connection.alias)
+
+
+def warm_up_connections() -> None:
+    '''Open (and immediately close) a connection to every configured database.
+
+    Called from the WSGI entry point, which gunicorn imports once in the master
+    process with --preload. Connections are thread-local and must not be
+    shared across the fork, so nothing is kept open: the point is to load the
+    database driver, resolve the Cloud SQL socket and surface a misconfigured
+    database in the boot logs before the instance starts taking traffic.'''
+    for connection in connections.all():
+        try:
+            connection.ensure_connection()
+        except Exception:
+            # Serving requests that don't need the database beats failing to boot.
+            logger.exception('Could not warm up database connection %s', connection.alias)
+    connections.close_all()
+
+
+connection_created.connect(record_new_connection)
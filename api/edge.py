@@ -0,0 +1,89 @@
+'''Support for a CDN in front of the API: Cache-Control and Surrogate-Key
+response headers, and purging the CDN when the data changes'''
+import asyncio
+import json
+import logging
+import urllib.request
+from functools import wraps
+
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def surrogate_keys(view_name, records) -> list:
+    '''Tags for a response listing the given serialized records: the view itself,
+    and each grant in it. Only keys the receivers in models.py purge are worth
+    tagging with. A grant's purges it when one of its allotments changes; every
+    other change purges whole views.'''
+    keys = [view_name]
+    if view_name != 'evaluations':
+        keys.extend(f'{view_name}-{record["id"]}' for record in records)
+    return keys
+
+
+def edge_cache(view_func):
+    '''Add settings.API_CACHE_CONTROL to the view's successful responses. Works
+    on sync and async views.'''
+    def add_cache_control(response):
+        if response.status_code in (200, 304):
+            patch_cache_control(response, **settings.API_CACHE_CONTROL)
+        return response
+
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _async_wrapped_view(request, *args, **kwargs):
+            return add_cache_control(await view_func(request, *args, **kwargs))
+        return _async_wrapped_view
+
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        return add_cache_control(view_func(request, *args, **kwargs))
+    return _wrapped_view
+
+
+class NullPurgeBackend:
+    '''For when there's no CDN in front of us'''
+    def __init__(self, **options):
+        pass
+
+    def purge(self, keys) -> None:
+        pass
+
+
+class HttpPurgeBackend:
+    '''POSTs {"surrogate_keys": [...]} to a purge URL, which is the shape of
+    Fastly's batch purge API and easy to put in front of anything else'''
+    def __init__(self, URL, HEADERS=None, TIMEOUT=5, **options):
+        self.url = URL
+        self.headers = {'Content-Type': 'application/json', **(HEADERS or {})}
+        self.timeout = TIMEOUT
+
+    def purge(self, keys) -> None:
+        request = urllib.request.Request(
+            self.url, data=json.dumps({'surrogate_keys': list(keys)}).encode(),
+            headers=self.headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+def get_purge_backend():
+    options = dict(settings.EDGE_PURGE)
+    return import_string(options.pop('BACKEND'))(**options)
+
+
+def purge_edge_cache(keys) -> None:
+    '''Purge every CDN object tagged with any of keys. Failures are logged rather
+    than raised: the admin save that triggered this has already happened, and
+    the CDN copies expire by themselves after s-maxage.'''
+    try:
+        get_purge_backend().purge(keys)
+    except Exception:
+        metrics.increment('edge_purge_failures')
+        logger.exception('Could not purge surrogate keys %s', keys)
+    else:
+        metrics.increment('edge_purges')
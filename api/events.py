@@ -0,0 +1,158 @@
+'''Telling clients when the data changes, as server-sent events, so that they
+refetch only then rather than polling the views.
+
+GET /api/events is answered straight from impact_api/asgi.py, without Django's
+request handling: each connection is a coroutine waiting on one shared future,
+so an instance can hold thousands of them idle. Whenever views' data changes,
+every stream gets an event like
+
+    id: 1661248800.123
+    event: change
+    data: {"views": ["evaluations"], "version": 1661248800.123}
+
+naming the views to refetch and when (the latest of) them changed, as
+cache.changed_at has it. Unlike the data versions behind the views' ETags, that
+doesn't depend on when the instance started, so the ids mean the same on every
+instance. Changes are announced once their caches have been cleared and the
+CDN purged, so that a refetch can't get the old data. Those made on other
+instances are announced as this one picks them up (see coherence.py). A client
+reconnecting with Last-Event-ID gets one event for everything it missed.'''
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+
+from . import metrics
+from .coherence import start_poller
+
+EVENTS_PATH = '/api/events'
+
+
+class ChangeNotifier:
+    '''Wakes the streams, on the event loop serving them, from any thread'''
+    def __init__(self):
+        self.loop = None
+        self.future = None
+        self.connections = 0
+
+    def next_change(self) -> asyncio.Future:
+        '''A future resolved at the next notify. Called on the loop.'''
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # The first stream, or a new loop (in tests, say)
+            self.loop, self.future = loop, None
+        if self.future is None or self.future.done():
+            self.future = loop.create_future()
+        return self.future
+
+    def notify(self) -> None:
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        metrics.increment('event_stream_notifications')
+        loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if self.future is not None and not self.future.done():
+            self.future.set_result(None)
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier() -> ChangeNotifier:
+    global _notifier
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                _notifier = ChangeNotifier()
+    return _notifier
+
+
+def notify() -> None:
+    '''Tell the streams the data versions have changed. Thread safe, and free
+    when nothing is streaming (under WSGI, say).'''
+    if _notifier is not None:
+        _notifier.notify()
+
+
+def _versions() -> dict:
+    from .cache import changed_at
+    from .models import VIEW_NAMES
+
+    return {view_name: changed_at(view_name) for view_name in VIEW_NAMES}
+
+
+def _event(changed) -> bytes:
+    version = max(changed.values())
+    return (f'id: {version!r}\nevent: change\n'
+            f'data: {json.dumps({"views": sorted(changed), "version": version})}\n\n').encode()
+
+
+async def stream_events(scope, receive, send):
+    '''The ASGI application for EVENTS_PATH'''
+    # Streams skip request_started, which otherwise starts it, and without it
+    # they'd never hear of other instances' changes
+    start_poller()
+    notifier = get_notifier()
+    if notifier.connections >= settings.API_EVENTS['MAX_CONNECTIONS']:
+        metrics.increment('event_stream_rejections')
+        await send({'type': 'http.response.start', 'status': 503,
+                    'headers': [(b'retry-after', b'60')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    notifier.connections += 1
+    metrics.set_gauge('event_stream_connections', notifier.connections)
+    disconnected = asyncio.ensure_future(_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # Public data, like the rest of the API (see CORS_ALLOW_ALL_ORIGINS)
+            (b'access-control-allow-origin', b'*'),
+            # Or nginx-style proxies hold the events back
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send({'type': 'http.response.body', 'more_body': True,
+                    'body': f"retry: {settings.API_EVENTS['RETRY_MILLISECONDS']}\n\n".encode()})
+        seen = _versions()
+        last_event_id = dict(scope['headers']).get(b'last-event-id')
+        changed_since = last_event_id is not None
+        if changed_since:
+            try:
+                seen = dict.fromkeys(seen, float(last_event_id))
+            except ValueError:
+                changed_since = False
+        while True:
+            # Taken before sending, so that a change made meanwhile still wakes us
+            change = notifier.next_change()
+            if changed_since:
+                versions = _versions()
+                changed = {view_name: version for view_name, version in versions.items()
+                           if version > seen[view_name]}
+                if changed:
+                    await send({'type': 'http.response.body', 'body': _event(changed),
+                                'more_body': True})
+                    metrics.increment('event_stream_events')
+                    seen.update(changed)
+            done, _ = await asyncio.wait(
+                {change, disconnected}, timeout=settings.API_EVENTS['HEARTBEAT_SECONDS'],
+                return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                return
+            changed_since = change in done
+            if not changed_since:
+                # Keeps proxies and load balancers from dropping an idle stream
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n',
+                            'more_body': True})
+    finally:
+        disconnected.cancel()
+        notifier.connections -= 1
+        metrics.set_gauge('event_stream_connections', notifier.connections)
+
+
+async def _disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,88 @@
+'''Clearing the caches once the data behind them has changed.
+
+The model receivers call invalidate on every save and delete, but nothing is
+cleared until the transaction commits: clearing earlier would let a concurrent
+request cache the old data again in between. Until then the views and
+Surrogate-Keys are collected, so that a bulk delete or a grant saved with dozens
+of inline allotments clears each view and purges the CDN once.'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+
+from . import events, metrics
+from .cache import clear_cache
+from .edge import purge_edge_cache
+
+logger = logging.getLogger(__name__)
+
+# Per thread, since each has its own database connection and so transaction
+_pending = threading.local()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def invalidate(view_name=None, surrogate_keys=()) -> None:
+    '''Clear view_name's cache (or, given None, every view's) and purge
+    surrogate_keys from the CDN, once the current transaction commits, or
+    straight away outside one'''
+    metrics.increment('invalidations_requested')
+    views = getattr(_pending, 'views', None)
+    if views is None:
+        views = _pending.views = set()
+        _pending.surrogate_keys = {}
+    views.add(view_name)
+    _pending.surrogate_keys.update(dict.fromkeys(surrogate_keys))
+    # Every call registers a callback, and whichever runs first flushes everything.
+    # Had only the first call registered one, a rolled-back transaction would
+    # take it along and leave the later invalidations waiting for nothing.
+    # A rollback instead leaves its invalidations pending until the next commit:
+    # clearing too much, never too little.
+    transaction.on_commit(flush)
+
+
+def flush() -> None:
+    '''Run the pending invalidations, in the background given
+    settings.API_INVALIDATION_BACKGROUND'''
+    views = getattr(_pending, 'views', None)
+    if not views:
+        return
+    surrogate_keys = list(_pending.surrogate_keys)
+    _pending.views, _pending.surrogate_keys = set(), {}
+    if settings.API_INVALIDATION_BACKGROUND:
+        _get_executor().submit(_invalidate, views, surrogate_keys)
+    else:
+        _invalidate(views, surrogate_keys)
+
+
+def _invalidate(views, surrogate_keys):
+    # The data is already committed, so failing here would only turn the admin's
+    # successful save into an error page. The entries expire by themselves.
+    try:
+        if None in views:
+            clear_cache()
+        else:
+            for view_name in sorted(views):
+                clear_cache(view_name)
+    except Exception:
+        metrics.increment('invalidation_failures')
+        logger.exception('Could not clear the cache for %s', views)
+    metrics.increment('invalidation_flushes')
+    if surrogate_keys:
+        purge_edge_cache(surrogate_keys)
+    # Only now can a client's refetch be sure of the new data
+    events.notify()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # One worker, so invalidations still happen in the order they were committed
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='cache-invalidation')
+    return _executor
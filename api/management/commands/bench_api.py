@@ -0,0 +1,184 @@
+import json
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from api.__init__ import get_currency_converter
+from api.cache import clear_cache
+from api.cache_writer import get_writer
+from api.models import (
+    AllGrantsFundGrant, Allotment, Charity, Evaluation, Intervention, MaxImpactFundGrant)
+
+INTERVENTIONS = 20
+
+# Query strings to request each endpoint with
+SHAPES = {
+    'default': '',
+    'all_years': '?end_year=9999',
+    'currency': '?currency=NOK&language=no',
+    'donation_date': '?donation_year=2020&donation_month=6&donation_day=15',
+    'conversion_date': '?conversion_year=2020&conversion_month=6&conversion_day=15',
+}
+ENDPOINTS = ('evaluations', 'max_impact_fund_grants', 'all_grants_fund_grants')
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the API endpoints against synthetic data of several sizes, in a '
+            'throwaway test database with an in-memory response cache. For each charity count, '
+            'endpoint and query shape, reports cold (uncached) and warm latency, query count, '
+            'peak memory of a cold request and response size, as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--charities', type=int, nargs='+', default=[10, 100, 1000],
+                            help='Charity counts to benchmark, one data set each')
+        parser.add_argument('--evaluations', type=int, default=10000)
+        parser.add_argument('--grants', type=int, default=1000,
+                            help='Of each type of grant')
+        parser.add_argument('--allotments', type=int, default=50, help='Per grant')
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+        parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=list(SHAPES))
+        parser.add_argument('--cold-runs', type=int, default=3)
+        parser.add_argument('--warm-runs', type=int, default=20)
+        parser.add_argument('--output', help='Write the JSON here rather than to stdout')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(
+                    API_CACHE_BACKEND={'BACKEND': 'api.cache_backends.InMemoryBackend'},
+                    SERVER_TIMING={'ENABLED': False, 'TRACE_SAMPLE_RATE': 0},
+                    PROFILING={'TOKEN': None, 'SAMPLE_RATE': 0, 'KEEP': 0}):
+                # Load the rates now rather than in the first cold request
+                get_currency_converter()
+                results = [result for charities in options['charities']
+                           for result in self._bench_data_set(charities, options)]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps({
+            'meta': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'evaluations': options['evaluations'],
+                'grants': options['grants'],
+                'allotments_per_grant': options['allotments'],
+                'cold_runs': options['cold_runs'],
+                'warm_runs': options['warm_runs'],
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def _bench_data_set(self, charities, options) -> list:
+        results = []
+        with transaction.atomic():
+            self._create_data(charities, options)
+            for endpoint in options['endpoints']:
+                for shape in options['shapes']:
+                    self.stderr.write(f'{charities} charities: {endpoint} {shape}')
+                    result = self._bench(f'/api/{endpoint}{SHAPES[shape]}', options)
+                    results.append({'charities': charities, 'endpoint': endpoint,
+                                    'shape': shape, **result})
+            transaction.set_rollback(True)
+        return results
+
+    def _create_data(self, charities, options):
+        '''Bulk creation skips the save signals, so this doesn't clear the cache
+        once per object'''
+        rng = random.Random(charities)
+        charity_objects = Charity.objects.bulk_create(
+            Charity(charity_name=f'Charity {number}', abbreviation=f'C{number}')
+            for number in range(charities))
+        interventions = Intervention.objects.bulk_create(
+            Intervention(short_description=f'Intervention {number}',
+                         long_description=f'Doing good, method {number}')
+            for number in range(INTERVENTIONS))
+        # Evaluations are unique by charity and month, and grants by month, so with
+        # few charities these run on past the present day
+        Evaluation.objects.bulk_create((
+            Evaluation(charity=charity_objects[number % charities],
+                       intervention=rng.choice(interventions),
+                       start_year=2000 + number // charities // 12,
+                       start_month=number // charities % 12 + 1,
+                       cents_per_output=rng.randint(100, 100000), source_name='Benchmark')
+            for number in range(options['evaluations'])), batch_size=1000)
+
+        for grant_model, field in ((MaxImpactFundGrant, 'max_impact_fund_grant'),
+                                   (AllGrantsFundGrant, 'all_grants_fund_grant')):
+            grants = grant_model.objects.bulk_create(
+                grant_model(start_year=2000 + number // 12, start_month=number % 12 + 1)
+                for number in range(options['grants']))
+            Allotment.objects.bulk_create((
+                Allotment(**{field: grant}, charity=rng.choice(charity_objects),
+                          intervention=rng.choice(interventions),
+                          sum_in_cents=rng.randint(10000, 10 ** 9),
+                          number_outputs_purchased=rng.randint(1, 10 ** 6))
+                for grant in grants for _ in range(options['allotments'])), batch_size=1000)
+
+    def _bench(self, url, options) -> dict:
+        client = Client()
+        cold, queries = [], None
+        for _ in range(options['cold_runs']):
+            self._empty_cache()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = client.get(url)
+                cold.append(time.perf_counter() - start)
+            queries = len(captured)
+
+        # Separately, as tracing allocations slows everything down
+        self._empty_cache()
+        tracemalloc.start()
+        try:
+            client.get(url)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        get_writer().flush()
+        warm = []
+        for _ in range(options['warm_runs']):
+            start = time.perf_counter()
+            client.get(url)
+            warm.append(time.perf_counter() - start)
+
+        return {
+            'status': response.status_code,
+            'response_bytes': len(response.content),
+            'queries': queries,
+            'peak_memory_kb': round(peak_memory / 1024),
+            'cold_ms': _summary(cold),
+            'warm_ms': _summary(warm),
+        }
+
+    def _empty_cache(self):
+        get_writer().flush()
+        clear_cache()
+
+
+def _summary(seconds) -> dict:
+    milliseconds = sorted(value * 1000 for value in seconds)
+    if not milliseconds:
+        return {}
+    return {
+        'min': round(milliseconds[0], 2),
+        'mean': round(statistics.mean(milliseconds), 2),
+        'p50': round(milliseconds[len(milliseconds) // 2], 2),
+        'p95': round(milliseconds[min(len(milliseconds) - 1, int(len(milliseconds) * 0.95))], 2),
+        'max': round(milliseconds[-1], 2),
+    }
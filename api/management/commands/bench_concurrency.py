@@ -0,0 +1,114 @@
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Load test a running server with many concurrent keep-alive connections. Run it '
+            'once against the WSGI server (gunicorn impact_api.wsgi, as in the Dockerfile) '
+            'and once against the ASGI one (gunicorn -k uvicorn.workers.UvicornWorker '
+            'impact_api.asgi) to compare them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='e.g. http://127.0.0.1:8000/api/evaluations')
+        parser.add_argument('--connections', type=int, default=500)
+        parser.add_argument('--requests', type=int, default=5000,
+                            help='Total requests, shared between the connections')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Seconds to wait for any one response')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON rather than text')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError('Only plain http:// URLs are supported')
+        results = asyncio.run(self._run(
+            url, options['connections'], options['requests'], options['timeout']))
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for name, value in results.items():
+            self.stdout.write(f'{name:<24}{value}')
+
+    async def _run(self, url, connections, requests, timeout) -> dict:
+        remaining = [requests]
+        latencies, statuses, errors = [], {}, []
+
+        async def connection():
+            reader = writer = None
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(url.hostname, url.port or 80), timeout)
+                    start = time.perf_counter()
+                    status, keep_alive = await asyncio.wait_for(
+                        self._request(reader, writer, url), timeout)
+                    latencies.append(time.perf_counter() - start)
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if not keep_alive:
+                        writer.close()
+                        writer = None
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        ValueError) as error:
+                    errors.append(type(error).__name__)
+                    if writer is not None:
+                        writer.close()
+                    writer = None
+            if writer is not None:
+                writer.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(connection() for _ in range(connections)))
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 2)
+        return {
+            'connections': connections,
+            'requests': len(latencies),
+            'errors': len(errors),
+            'statuses': statuses,
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+        }
+
+    async def _request(self, reader, writer, url) -> tuple:
+        '''Send one GET and read its response, returning (status, keep_alive)'''
+        target = url.path + (f'?{url.query}' if url.query else '')
+        writer.write((f'GET {target or "/"} HTTP/1.1\r\nHost: {url.netloc}\r\n'
+                      'Accept-Encoding: gzip\r\nConnection: keep-alive\r\n\r\n').encode())
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        status = int(status_line.split()[1])
+        headers = {}
+        for line in header_lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, headers.get('connection', '').lower() != 'close'
@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import path
+
+
+def _view(request):
+    return HttpResponse()
+
+
+# Used as ROOT_URLCONF while benchmarking, so that only middleware is measured
+urlpatterns = [
+    path('api/bench', _view),
+    path('admin/bench', _view),
+]
+
+PATHS = {'api': '/api/bench', 'admin': '/admin/bench'}
+
+
+class Command(BaseCommand):
+    help = ('Report the per-request overhead of each layer of settings.MIDDLEWARE on the '
+            'api/ and admin/ routes, by timing the stack with and without each layer.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs per measurement; the fastest is reported')
+
+    def handle(self, *args, **options):
+        iterations, repeat = options['iterations'], options['repeat']
+        layers = list(settings.MIDDLEWARE)
+        with override_settings(ROOT_URLCONF=__name__, ALLOWED_HOSTS=['*']):
+            timings = {route: [min(self._time(layers[:depth], path, iterations)
+                                   for _ in range(repeat))
+                               for depth in range(len(layers) + 1)]
+                       for route, path in PATHS.items()}
+
+        self.stdout.write(f'{"layer":<55}{"api/ µs":>10}{"admin/ µs":>12}')
+        for depth, layer in enumerate(layers, start=1):
+            self.stdout.write(f'{layer:<55}' + ''.join(
+                f'{(timings[route][depth] - timings[route][depth - 1]) * 1e6:>{width}.1f}'
+                for route, width in (('api', 10), ('admin', 12))))
+        self.stdout.write(f'{"total":<55}' + ''.join(
+            f'{(timings[route][-1] - timings[route][0]) * 1e6:>{width}.1f}'
+            for route, width in (('api', 10), ('admin', 12))))
+
+    def _time(self, middleware, path, iterations) -> float:
+        '''Mean seconds per request through the given middleware'''
+        with override_settings(MIDDLEWARE=middleware):
+            handler = BaseHandler()
+            handler.load_middleware()
+            factory = RequestFactory()
+            requests = [factory.get(path) for _ in range(iterations)]
+            start = time.perf_counter()
+            for request in requests:
+                handler.get_response(request)
+            return (time.perf_counter() - start) / iterations
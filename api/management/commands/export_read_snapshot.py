@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from api.read_snapshot import export
+
+
+class Command(BaseCommand):
+    help = ('Write the public data to a read-only SQLite file for the API to read from '
+            'instead of MySQL. Run it before building the image, so that the file is '
+            'copied in with the code.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.API_READ_SNAPSHOT,
+                            help='Where to write the file (default: settings.API_READ_SNAPSHOT)')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to export from')
+
+    def handle(self, *args, **options):
+        rows = export(options['output'], using=options['database'])
+        for table, count in rows.items():
+            self.stdout.write(f'{table}: {count} rows')
+        self.stdout.write(f"Wrote {options['output']}")
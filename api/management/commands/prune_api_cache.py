@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.cache import prune_cache
+from api.changes import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = ('Delete the expired API responses from the cache backend, in batches, and the '
+            'deletions older than API_CHANGES_RETENTION_DAYS. Schedule it (with Cloud '
+            'Scheduler, say) or set API_CACHE_SWEEPER_INTERVAL for the responses instead.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.API_CACHE_SWEEPER['BATCH_SIZE'],
+                            help='Entities per query and delete')
+
+    def handle(self, *args, **options):
+        pruned, seconds = prune_cache(options['batch_size'])
+        if pruned is None:
+            self.stdout.write('This cache backend expires entries itself, nothing to prune')
+        else:
+            self.stdout.write(f'Deleted {pruned} expired entries in {seconds * 1000:.0f} ms')
+        self.stdout.write(f'Deleted {prune_tombstones()} tombstones past their retention')
@@ -0,0 +1,146 @@
+import threading
+from collections import defaultdict
+
+# Process-local counters, gauges and histograms. Each gunicorn worker keeps its own, so
+# these describe a single instance rather than the whole deployment.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_histograms = {}
+
+# Upper bounds, in seconds, of the latency histograms' buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Prepended to every name in the Prometheus export
+PROMETHEUS_PREFIX = 'impact_api_'
+
+
+def _metric_key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def increment(name: str, amount: int = 1, **labels) -> None:
+    '''Add amount to the counter identified by name and labels'''
+    key = _metric_key(name, labels)
+    with _lock:
+        _counters[key] += amount
+
+
+def counter(name: str, **labels) -> int:
+    '''Return the current value of a single counter'''
+    with _lock:
+        return _counters.get(_metric_key(name, labels), 0)
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    '''Set the gauge identified by name and labels to value'''
+    key = _metric_key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def gauge(name: str, **labels) -> float:
+    '''Return the current value of a single gauge'''
+    with _lock:
+        return _gauges.get(_metric_key(name, labels), 0)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    '''Record value (a duration in seconds) in the histogram identified by name
+    and labels'''
+    key = _metric_key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+def histogram(name: str, **labels) -> dict:
+    '''Return a copy of a single histogram: its count, sum and (non-cumulative)
+    bucket counts'''
+    with _lock:
+        histogram = _histograms.get(_metric_key(name, labels))
+        if histogram is None:
+            return {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+        return {**histogram, 'buckets': list(histogram['buckets'])}
+
+
+def snapshot() -> dict:
+    '''Return a copy of every counter, keyed by (name, labels)'''
+    with _lock:
+        return dict(_counters)
+
+
+def gauge_snapshot() -> dict:
+    '''Return a copy of every gauge, keyed by (name, labels)'''
+    with _lock:
+        return dict(_gauges)
+
+
+def histogram_snapshot() -> dict:
+    '''Return a copy of every histogram, keyed by (name, labels)'''
+    with _lock:
+        return {key: {**histogram, 'buckets': list(histogram['buckets'])}
+                for key, histogram in _histograms.items()}
+
+
+def _prometheus_labels(labels, **extra) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{%s}' % ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped))
+
+
+def prometheus_text() -> str:
+    '''Every metric in Prometheus' text exposition format'''
+    lines = []
+    counters = defaultdict(list)
+    for (name, labels), value in sorted(snapshot().items()):
+        counters[name].append((labels, value))
+    for name, series in counters.items():
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name}_total counter')
+        lines.extend(f'{PROMETHEUS_PREFIX}{name}_total{_prometheus_labels(labels)} {value}'
+                     for labels, value in series)
+
+    gauges = defaultdict(list)
+    for (name, labels), value in sorted(gauge_snapshot().items()):
+        gauges[name].append((labels, value))
+    for name, series in gauges.items():
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} gauge')
+        lines.extend(f'{PROMETHEUS_PREFIX}{name}{_prometheus_labels(labels)} {value}'
+                     for labels, value in series)
+
+    histograms = defaultdict(list)
+    for (name, labels), histogram in sorted(histogram_snapshot().items()):
+        histograms[name].append((labels, histogram))
+    for name, series in histograms.items():
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} histogram')
+        for labels, histogram in series:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{PROMETHEUS_PREFIX}{name}_bucket'
+                             f'{_prometheus_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{PROMETHEUS_PREFIX}{name}_bucket'
+                         f'{_prometheus_labels(labels, le="+Inf")} {histogram["count"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}{name}_sum{_prometheus_labels(labels)} '
+                         f'{histogram["sum"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}{name}_count{_prometheus_labels(labels)} '
+                         f'{histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
@@ -1,22 +1,386 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import json
+import logging
+import pstats
+import random
+import time
+from datetime import date
+from asgiref.sync import sync_to_async
+from django.core.exceptions import MiddlewareNotUsed
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.module_loading import import_string
 from django.http import JsonResponse
 from django.conf import settings
 from django.utils.translation import activate
-from .__init__ import get_currencies
+from .__init__ import get_currencies, latest_local_rates, rates_currencies
+from . import metrics, replica, sparse_fields, timing
+
+telemetry_logger = logging.getLogger('api.telemetry')
+
+API_PATH_PREFIX = '/api/'
+# Internal endpoints for staff, such as /api/_stats, which need the admin's
+# sessions and auth rather than the public API's treatment
+INTERNAL_API_PATH_PREFIX = '/api/_'
+
+SUPPORTED_LANGUAGES = frozenset(language[0] for language in settings.LANGUAGES)
+
+# Integer query strings the views rely on, and the range each must fall in
+NUMERIC_QUERY_RANGES = {
+    'start_year': (1, 9999),
+    'start_month': (1, 12),
+    'end_year': (1, 9999),
+    'end_month': (1, 12),
+    'donation_year': (1, 9999),
+    'donation_month': (1, 12),
+    'donation_day': (1, 31),
+    'conversion_year': (1, 9999),
+    'conversion_month': (1, 12),
+    'conversion_day': (1, 31),
+}
+
+# Query strings that are combined into a date, keyed by the one that triggers it
+DATE_QUERIES = {
+    'donation_year': ('donation_year', 'donation_month', 'donation_day'),
+    'conversion_year': ('conversion_year', 'conversion_month', 'conversion_day'),
+}
+
+
+def _supported_currencies() -> frozenset:
+    # From the latest rates' header, so that startup doesn't wait on (and the
+    # first request with a currency doesn't pay for) building the converter
+    filename = latest_local_rates()
+    return frozenset(rates_currencies(filename) if filename else get_currencies())
+
+
+SUPPORTED_CURRENCIES = _supported_currencies()
+
+
+def is_api_request(request) -> bool:
+    '''Whether this is a request for the public API'''
+    path = request.path_info
+    return path.startswith(API_PATH_PREFIX) and not path.startswith(INTERNAL_API_PATH_PREFIX)
+
+
+class AdminMiddleware:
+    '''Runs settings.ADMIN_MIDDLEWARE (sessions, CSRF, auth, messages...) for
+    everything except the api/ routes, which are anonymous GETs and need none of
+    it.
+
+    Django only collects process_view hooks from settings.MIDDLEWARE, so this
+    forwards them to the wrapped middleware itself. None of those define
+    process_exception or process_template_response.'''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.view_hooks = []
+        handler = get_response
+        for middleware_path in reversed(settings.ADMIN_MIDDLEWARE):
+            middleware = import_string(middleware_path)(handler)
+            if hasattr(middleware, 'process_view'):
+                self.view_hooks.insert(0, middleware.process_view)
+            handler = middleware
+        self.admin_handler = handler
+
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark ourselves as async so Django doesn't give each API request
+            # its own thread hop, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            self.process_view = self._aprocess_view
+        else:
+            self.process_view = self._process_view
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if is_api_request(request):
+            return self.get_response(request)
+        return self.admin_handler(request)
+
+    async def __acall__(self, request):
+        if is_api_request(request):
+            return await self.get_response(request)
+        return await self.admin_handler(request)
+
+    def _process_view(self, request, view_func, view_args, view_kwargs):
+        if is_api_request(request):
+            return None
+        for hook in self.view_hooks:
+            response = hook(request, view_func, view_args, view_kwargs)
+            if response:
+                return response
+        return None
+
+    async def _aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if is_api_request(request):
+            return None
+        return await sync_to_async(self._process_view, thread_sensitive=True)(
+            request, view_func, view_args, view_kwargs)
+
+
+class ServerTimingMiddleware:
+    '''Times the stages of each API request (see timing.py) and reports them in
+    a Server-Timing header. A sample of requests, settings.SERVER_TIMING's
+    TRACE_SAMPLE_RATE, also get a JSON trace line in the api.telemetry log.'''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not settings.SERVER_TIMING['ENABLED'] or not is_api_request(request):
+            return self.get_response(request)
+        timings, token = timing.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.finish(token)
+        return self._report(request, response, timings)
+
+    async def __acall__(self, request):
+        if not settings.SERVER_TIMING['ENABLED'] or not is_api_request(request):
+            return await self.get_response(request)
+        timings, token = timing.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timing.finish(token)
+        return self._report(request, response, timings)
+
+    def _report(self, request, response, timings):
+        response['Server-Timing'] = timings.header()
+        if random.random() < settings.SERVER_TIMING['TRACE_SAMPLE_RATE']:
+            telemetry_logger.info(json.dumps({
+                'event': 'api_trace', 'path': request.get_full_path(),
+                'status': response.status_code, **timings.as_dict()}))
+        return response
+
+
+class ReplicaMiddleware:
+    '''Read-your-writes for the admin, with a replica configured (see
+    replica.py). A response to a request that changed the public data gets a
+    cookie, and for settings.API_DB_REPLICA's STICKY_SECONDS the API answers
+    requests carrying it from the primary, on whichever instance they land.
+    A forged cookie only moves that client's reads to the primary.'''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not replica.replica_alias():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = replica.start_request(self._sticky(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = replica.finish_request(token)
+        return self._stick(response, wrote)
+
+    async def __acall__(self, request):
+        token = replica.start_request(self._sticky(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrote = replica.finish_request(token)
+        return self._stick(response, wrote)
+
+    def _sticky(self, request) -> bool:
+        try:
+            return float(request.COOKIES.get(replica.COOKIE_NAME, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def _stick(self, response, wrote):
+        if wrote:
+            sticky_seconds = settings.API_DB_REPLICA['STICKY_SECONDS']
+            # The deadline is checked here too, in case a client keeps it longer
+            response.set_cookie(
+                replica.COOKIE_NAME, repr(time.time() + sticky_seconds),
+                max_age=sticky_seconds, secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True, samesite='Lax')
+            metrics.increment('replica_sticky_sessions')
+        return response
+
+
+class ProfilingMiddleware:
+    '''Profiles API requests that send settings.PROFILING's TOKEN in an
+    X-Profile-Token header, and a random SAMPLE_RATE of the others, saving the
+    cProfile report and the SQL queries as a RequestProfile for the admin site.
+    The response's X-Profile-Id header names the RequestProfile.
+
+    Under ASGI the profile covers only the event loop's thread, so work the async
+    views hand to worker threads shows up as time spent awaiting (the queries are
+    still all listed).'''
+    sync_capable = True
+    async_capable = True
+
+    # How many lines of each section of the cProfile report to keep
+    REPORT_LINES = 60
+    CALLEE_LINES = 15
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        trigger = self._trigger(request)
+        if not trigger:
+            return self.get_response(request)
+        profiler, timings, token, start = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+            if token:
+                timing.finish(token)
+        profile = self._save(request, response, trigger, profiler, timings, start)
+        response['X-Profile-Id'] = profile.pk
+        return response
+
+    async def __acall__(self, request):
+        trigger = self._trigger(request)
+        if not trigger:
+            return await self.get_response(request)
+        profiler, timings, token, start = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+            if token:
+                timing.finish(token)
+        profile = await sync_to_async(self._save, thread_sensitive=True)(
+            request, response, trigger, profiler, timings, start)
+        response['X-Profile-Id'] = profile.pk
+        return response
+
+    def _trigger(self, request):
+        if not is_api_request(request):
+            return None
+        token = settings.PROFILING['TOKEN']
+        sent = request.headers.get('X-Profile-Token')
+        if token and sent and hmac.compare_digest(sent.encode(), token.encode()):
+            return 'header'
+        if random.random() < settings.PROFILING['SAMPLE_RATE']:
+            return 'sample'
+        return None
+
+    def _start(self) -> tuple:
+        # Collect the queries in the request's timings, as the 'db' stage does.
+        # ServerTimingMiddleware will usually have started them.
+        timings, token = timing.current(), None
+        if timings is None:
+            timings, token = timing.start()
+        timings.queries = []
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        return profiler, timings, token, start
+
+    def _save(self, request, response, trigger, profiler, timings, start):
+        from .models import RequestProfile
+        duration = time.perf_counter() - start
+        report = io.StringIO()
+        stats = pstats.Stats(profiler, stream=report).sort_stats('cumulative')
+        stats.print_stats(self.REPORT_LINES)
+        stats.print_callees(self.CALLEE_LINES)
+        profile = RequestProfile.objects.create(
+            path=request.get_full_path(), status_code=response.status_code,
+            duration_ms=round(duration * 1000, 2), trigger=trigger,
+            profile=report.getvalue(), queries=timings.queries)
+        # Only keep the latest, oldest first out
+        stale = list(RequestProfile.objects.values_list('pk', flat=True)[
+            settings.PROFILING['KEEP']:])
+        if stale:
+            RequestProfile.objects.filter(pk__in=stale).delete()
+        return profile
 
 
 class QueriesMiddleware(MiddlewareMixin):
     def process_view(self, request, view_func, view_args, view_kwargs):
         # This code is executed just before a view is called
+        if not is_api_request(request):
+            return None
+        with timing.stage('validate'):
+            return self._validate(request, getattr(view_func, '__name__', None))
+
+    def _validate(self, request, view_name):
         queries = request.GET
         language = queries.get('language')
         currency = queries.get('currency')
         errors = []
-        if currency and currency.upper() not in get_currencies():
+        if currency and currency.upper() not in SUPPORTED_CURRENCIES:
             errors.append(f'Currency {currency.upper()} not supported')
-        if language and language.lower() not in [language[0] for language in settings.LANGUAGES]:
+        if language and language.lower() not in SUPPORTED_LANGUAGES:
             errors.append(f'Language code {language.lower()} not supported')
+        numbers = self._coerced_numbers(queries, errors)
+        fields = self._parsed_fields(queries, view_name, errors)
         if errors:
             return JsonResponse({'errors': errors})
-        if language and language.lower() in [language[0] for language in settings.LANGUAGES]:
+        if numbers or 'fields' in queries:
+            # Replace the query strings with their canonical form, so that the views
+            # (and the cache key) see '6' rather than '06' or ' 6', and the same
+            # fields however they were listed
+            normalized = queries.copy()
+            for name, value in numbers.items():
+                normalized[name] = str(value)
+            if fields:
+                normalized['fields'] = sparse_fields.canonical(fields)
+            else:
+                normalized.pop('fields', None)
+            normalized._mutable = False
+            request.GET = normalized
+        if language:
             activate(language.lower())
+
+    def _coerced_numbers(self, queries, errors) -> dict:
+        numbers = {}
+        for name, (lowest, highest) in NUMERIC_QUERY_RANGES.items():
+            if not queries.get(name):
+                # Empty values fall back to the view's defaults
+                continue
+            try:
+                value = int(queries[name])
+            except ValueError:
+                errors.append(f'{name} must be an integer')
+                continue
+            if not lowest <= value <= highest:
+                errors.append(f'{name} must be between {lowest} and {highest}')
+                continue
+            numbers[name] = value
+
+        for trigger, names in DATE_QUERIES.items():
+            if trigger not in numbers or any(
+                    queries.get(name) and name not in numbers for name in names):
+                continue
+            year, month, day = names
+            try:
+                date(numbers[year], numbers.get(month, 1), numbers.get(day, 1))
+            except ValueError:
+                errors.append(f'{year}, {month} and {day} must form a valid date')
+        return numbers
+
+    def _parsed_fields(self, queries, view_name, errors):
+        if 'fields' not in queries or view_name not in sparse_fields.FIELDS:
+            return None
+        try:
+            return sparse_fields.parse(queries.getlist('fields'), view_name)
+        except sparse_fields.InvalidField as error:
+            errors.append(f'Field {error} not supported')
@@ -7,7 +7,7 @@ from django.template.defaultfilters import slugify
 from django.utils.translation import gettext_lazy as _
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .cache import clear_cache
+from .invalidation import invalidate
 
 def validate_year(value):
     '''Validate year between 2000 and now'''
@@ -35,6 +35,7 @@ class Charity(models.Model):
         return True
     charity_name = models.CharField(max_length=200)
     abbreviation = models.CharField(max_length=10)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     class Meta:
         verbose_name_plural = 'Charities'
 
@@ -52,6 +53,7 @@ class MaxImpactFundGrant(models.Model):
         return False
     start_year = models.PositiveIntegerField(validators=[validate_year])
     start_month = models.PositiveIntegerField(validators=[validate_month])
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -67,6 +69,7 @@ class AllGrantsFundGrant(models.Model):
         return False
     start_year = models.PositiveIntegerField(validators=[validate_year])
     start_month = models.PositiveIntegerField(validators=[validate_month])
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -82,6 +85,7 @@ class Intervention(models.Model):
         return False
     short_description = models.CharField(max_length=100)
     long_description = models.CharField(max_length=1000)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     class Meta:
         constraints = [models.UniqueConstraint(
             fields=['short_description'], name='unique_short_description')]
@@ -112,6 +116,7 @@ class Allotment(models.Model):
     source_name = models.TextField(blank=True)
     source_url = models.TextField(blank=True)
     comment = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     def clean(self):
         # Ensure that exactly one of all_grants_fund or max_impact_fund_grant is not null
         if (self.all_grants_fund_grant is None and self.max_impact_fund_grant is None) or \
@@ -142,6 +147,18 @@ class Allotment(models.Model):
         return True
     def cents_per_output(self) -> str:
         return self.sum_in_cents / self.number_outputs_purchased
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        allotment = super().from_db(db, field_names, values)
+        if {'max_impact_fund_grant_id', 'all_grants_fund_grant_id'} <= set(field_names):
+            # A save may move it to another grant, whose old one changes too
+            allotment._saved_grant = allotment.grant()
+        return allotment
+    def grant(self) -> tuple:
+        '''The view listing its grant, and the grant's id'''
+        if self.max_impact_fund_grant_id:
+            return 'max_impact_fund_grants', self.max_impact_fund_grant_id
+        return 'all_grants_fund_grants', self.all_grants_fund_grant_id
     def start_date(self) -> date:
         if self.max_impact_fund_grant:
             return date(
@@ -163,6 +180,7 @@ class Evaluation(models.Model):
     source_name = models.TextField(blank=True)
     source_url = models.TextField(blank=True)
     comment = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     def __str__(self):
         return f'{self.charity.charity_name} as of {self.start_year}-{self.start_month}'
     @classmethod
@@ -193,26 +211,82 @@ class Evaluation(models.Model):
         constraints = [models.UniqueConstraint(
             fields=['charity', 'start_month', 'start_year'], name='unique_date_and_charity')]
 
+class RequestProfile(models.Model):
+    '''An API request profiled by api.middleware.ProfilingMiddleware'''
+    def __str__(self):
+        return f'{self.path} ({self.duration_ms:.0f} ms)'
+    @classmethod
+    def is_hidden_from_admin_sidebar(cls):
+        return False
+    TRIGGERS = [('header', 'Requested by header'), ('sample', 'Randomly sampled')]
+    created_at = models.DateTimeField(auto_now_add=True)
+    path = models.TextField()
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    trigger = models.CharField(max_length=10, choices=TRIGGERS)
+    # cProfile's report, sorted by cumulative time, followed by the top callers' callees
+    profile = models.TextField()
+    # [{'sql': ..., 'ms': ...}, ...], in the order they ran
+    queries = models.JSONField(default=list)
+    class Meta:
+        ordering = ['-created_at', '-id']
+
+class Tombstone(models.Model):
+    '''A deleted Charity, Intervention, Evaluation, grant or Allotment, for
+    /api/changes to report to mirrors. Recorded by the cache invalidation
+    receivers below, and deleted by prune_api_cache once older than
+    settings.API_CHANGES_RETENTION_DAYS.'''
+    model_name = models.CharField(max_length=100)
+    object_id = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
 '''
 Handling cache invalidation
+
+Each receiver clears our own cache of the affected views first, and only then
+purges the CDN, so that the CDN can't refetch a stale copy from us.
 '''
 
+def record_deletion(instance, signal):
+    if signal is post_delete:
+        Tombstone.objects.create(model_name=instance._meta.model_name, object_id=instance.pk)
+
+VIEW_NAMES = ['evaluations', 'max_impact_fund_grants', 'all_grants_fund_grants']
+
+# Each receiver invalidates once the transaction commits (see invalidation.py).
 # For evaluations
 @receiver([post_save, post_delete], sender=Evaluation)
-def clear_evaluation_cache(sender, **kwargs):
-    clear_cache('evaluations')
+def clear_evaluation_cache(sender, instance, signal, **kwargs):
+    record_deletion(instance, signal)
+    invalidate('evaluations', ['evaluations'])
 
 # For MaxImpactFundGrant
 @receiver([post_save, post_delete], sender=MaxImpactFundGrant)
-def clear_mif_cache(sender, **kwargs):
-    clear_cache('max_impact_fund_grants')
+def clear_mif_cache(sender, instance, signal, **kwargs):
+    record_deletion(instance, signal)
+    invalidate('max_impact_fund_grants', ['max_impact_fund_grants'])
 
 # For AllGrantsFundGrant
 @receiver([post_save, post_delete], sender=AllGrantsFundGrant)
-def clear_agf_cache(sender, **kwargs):
-    clear_cache('all_grants_fund_grants')
+def clear_agf_cache(sender, instance, signal, **kwargs):
+    record_deletion(instance, signal)
+    invalidate('all_grants_fund_grants', ['all_grants_fund_grants'])
+
+# Allotments are saved after their grant (as admin inlines), so need their own receiver.
+# Only responses containing the allotment's grant change, or both its grants'
+# when it's been moved from one to another (of either kind).
+@receiver([post_save, post_delete], sender=Allotment)
+def clear_allotment_cache(sender, instance, signal, **kwargs):
+    record_deletion(instance, signal)
+    grant = instance.grant()
+    for view_name, grant_id in dict.fromkeys([getattr(instance, '_saved_grant', grant), grant]):
+        invalidate(view_name, [f'{view_name}-{grant_id}'])
+    instance._saved_grant = grant
 
-# Since Charity changes could affect evaluation responses
+# Charities and interventions are nested in the evaluations and in the grants'
+# allotments, so every view changes with them.
 @receiver([post_save, post_delete], sender=Charity)
-def clear_charity_related_cache(sender, **kwargs):
-    clear_cache('evaluations')  # Clear evaluations since they include charity data
\ No newline at end of file
+@receiver([post_save, post_delete], sender=Intervention)
+def clear_charity_related_cache(sender, instance, signal, **kwargs):
+    record_deletion(instance, signal)
+    invalidate(None, VIEW_NAMES)
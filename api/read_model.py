@@ -0,0 +1,405 @@
+'''The whole dataset, held in memory as an immutable snapshot that the views
+answer every query from without the ORM or REST framework.
+
+A snapshot is stamped with the data versions of every view (see
+cache.data_version) from before it read the database, which it reads from the
+primary or a current read snapshot, never a replica. get_snapshot rebuilds it
+whenever they've moved on, which clear_cache makes them do on every committed
+change, here or (see coherence.py) on another instance. Requests already using
+the old snapshot finish with it; the new one replaces it in a single assignment.'''
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+from datetime import date
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import connections
+from django.http import QueryDict
+from django.utils.translation import get_language, override
+from modeltranslation.utils import get_language as get_translation_language
+
+from . import metrics, replica, sparse_fields, timing
+from .cache import data_version
+from .currency import CurrencyManager
+from .models import (
+    VIEW_NAMES, AllGrantsFundGrant, Allotment, Charity, Evaluation, Intervention,
+    MaxImpactFundGrant)
+from .read_snapshot import api_reads
+
+logger = logging.getLogger(__name__)
+
+# View name: the grant model, and Allotment's foreign key to it
+GRANT_MODELS = {
+    'max_impact_fund_grants': (MaxImpactFundGrant, 'max_impact_fund_grant_id'),
+    'all_grants_fund_grants': (AllGrantsFundGrant, 'all_grants_fund_grant_id'),
+}
+
+
+class CharityRecord(NamedTuple):
+    id: int
+    charity_name: str
+    abbreviation: str
+
+    def as_dict(self) -> dict:
+        return {'id': self.id, 'charity_name': self.charity_name,
+                'abbreviation': self.abbreviation}
+
+
+class InterventionRecord(NamedTuple):
+    id: int
+    # Language code: (short_description, long_description), after modeltranslation's fallbacks
+    descriptions: dict
+
+    def as_dict(self, language) -> dict:
+        short_description, long_description = self.descriptions[language]
+        return {'long_description': long_description, 'short_description': short_description,
+                'id': self.id}
+
+
+class EvaluationRecord(NamedTuple):
+    id: int
+    charity: CharityRecord
+    intervention: InterventionRecord
+    start_year: int
+    start_month: int
+    cents_per_output: int
+    cents_per_output_upper_bound: Optional[int]
+    cents_per_output_lower_bound: int
+    source_name: str
+    source_url: str
+    comment: str
+
+    def start_date(self) -> date:
+        return date(self.start_year, self.start_month, 1)
+
+
+class AllotmentRecord(NamedTuple):
+    id: int
+    charity: CharityRecord
+    intervention: InterventionRecord
+    sum_in_cents: int
+    number_outputs_purchased: int
+    number_outputs_purchased_lower_bound: int
+    number_outputs_purchased_upper_bound: Optional[int]
+    source_name: str
+    source_url: str
+    comment: str
+    # The grant's
+    start_year: int
+    start_month: int
+
+    def start_date(self) -> date:
+        return date(self.start_year, self.start_month, 1)
+
+    def cents_per_output(self) -> float:
+        return self.sum_in_cents / self.number_outputs_purchased
+
+
+class GrantRecord(NamedTuple):
+    id: int
+    start_year: int
+    start_month: int
+    allotments: tuple
+
+
+class Periods:
+    '''Records sorted by (start_year, start_month, id), for finding those in a
+    range of years, or the latest as of a date, by bisection'''
+    __slots__ = ('records', 'keys')
+
+    def __init__(self, records):
+        self.records = sorted(records, key=_period_key)
+        self.keys = [_period_key(record) for record in self.records]
+
+    def in_years(self, start_year, end_year) -> list:
+        return self.records[bisect_left(self.keys, (start_year,)):
+                            bisect_left(self.keys, (end_year + 1,))]
+
+    def latest_as_of(self, year, month):
+        '''The record starting last, no later than the given month'''
+        index = bisect_right(self.keys, (year, month, float('inf')))
+        return self.records[index - 1] if index else None
+
+
+def _period_key(record) -> tuple:
+    return (record.start_year, record.start_month, record.id)
+
+
+class Snapshot:
+    __slots__ = ('versions', 'charity_abbreviations', 'evaluations', 'evaluations_by_charity',
+                 'grants')
+
+    def __init__(self, versions, charities, evaluations, grants):
+        self.versions = versions
+        # In the order _charity_abbreviations lists every charity
+        self.charity_abbreviations = tuple(charity.abbreviation for charity in charities)
+        self.evaluations = Periods(evaluations)
+        by_charity = {}
+        for evaluation in evaluations:
+            by_charity.setdefault(evaluation.charity.abbreviation, []).append(evaluation)
+        self.evaluations_by_charity = {
+            abbreviation: Periods(records) for abbreviation, records in by_charity.items()}
+        # View name: Periods of GrantRecords
+        self.grants = {view_name: Periods(records) for view_name, records in grants.items()}
+
+    @classmethod
+    def build(cls, versions) -> 'Snapshot':
+        '''Read everything from the database. versions must be read beforehand,
+        so that a change committed meanwhile leaves the snapshot outdated.'''
+        charities = {charity.id: CharityRecord(charity.id, charity.charity_name,
+                                               charity.abbreviation)
+                     for charity in Charity.objects.order_by('id')}
+        interventions = {}
+        for intervention in Intervention.objects.order_by('id'):
+            descriptions = {}
+            for language, _ in settings.LANGUAGES:
+                with override(language):
+                    descriptions[language] = (intervention.short_description,
+                                              intervention.long_description)
+            interventions[intervention.id] = InterventionRecord(intervention.id, descriptions)
+
+        evaluations = [
+            EvaluationRecord(
+                values['id'], charities[values['charity_id']],
+                interventions[values['intervention_id']], values['start_year'],
+                values['start_month'], values['cents_per_output'],
+                values['cents_per_output_upper_bound'], values['cents_per_output_lower_bound'],
+                values['source_name'], values['source_url'], values['comment'])
+            for values in Evaluation.objects.order_by('id').values()]
+
+        grants = {}
+        for view_name, (model, grant_field) in GRANT_MODELS.items():
+            starts = {grant_id: (start_year, start_month) for grant_id, start_year, start_month
+                      in model.objects.values_list('id', 'start_year', 'start_month')}
+            allotments = {}
+            for values in Allotment.objects.filter(**{f'{grant_field}__isnull': False}).order_by(
+                    'id').values(grant_field, *_ALLOTMENT_FIELDS):
+                allotments.setdefault(values[grant_field], []).append(AllotmentRecord(
+                    values['id'], charities[values['charity_id']],
+                    interventions[values['intervention_id']],
+                    *(values[name] for name in _ALLOTMENT_FIELDS[3:]),
+                    *starts[values[grant_field]]))
+            grants[view_name] = [
+                GrantRecord(grant_id, start_year, start_month, tuple(allotments.get(grant_id, ())))
+                for grant_id, (start_year, start_month) in sorted(starts.items())]
+        return cls(versions, charities.values(), evaluations, grants)
+
+    def evaluations_in(self, dates, abbreviations) -> list:
+        '''As views._records: each of the year and month falls in its range'''
+        abbreviations = set(abbreviations)
+        return sorted((
+            evaluation for evaluation in self.evaluations.in_years(dates.start_year,
+                                                                   dates.end_year)
+            if dates.start_month <= evaluation.start_month <= dates.end_month
+            and evaluation.charity.abbreviation in abbreviations), key=_id)
+
+    def evaluations_as_of(self, dates, abbreviations) -> list:
+        '''As views._evaluations_by_donation_date: each charity's latest'''
+        records = []
+        for abbreviation in abbreviations:
+            periods = self.evaluations_by_charity.get(abbreviation)
+            record = periods and periods.latest_as_of(dates.donation_year, dates.donation_month)
+            if record:
+                records.append(record)
+        return records
+
+    def grants_in(self, view_name, dates) -> list:
+        return sorted((
+            grant for grant in self.grants[view_name].in_years(dates.start_year, dates.end_year)
+            if dates.start_month <= grant.start_month <= dates.end_month), key=_id)
+
+    def grants_as_of(self, view_name, dates) -> list:
+        record = self.grants[view_name].latest_as_of(dates.donation_year, dates.donation_month)
+        return [record] if record else []
+
+
+_ALLOTMENT_FIELDS = (
+    'id', 'charity_id', 'intervention_id', 'sum_in_cents', 'number_outputs_purchased',
+    'number_outputs_purchased_lower_bound', 'number_outputs_purchased_upper_bound',
+    'source_name', 'source_url', 'comment')
+
+
+def _id(record) -> int:
+    return record.id
+
+
+_snapshot = None
+_build_lock = threading.Lock()
+
+
+def _current_versions() -> tuple:
+    return tuple(data_version(view_name) for view_name in VIEW_NAMES)
+
+
+def get_snapshot() -> Snapshot:
+    '''Return the current snapshot, building it first if the data has changed
+    since the last was built (or none has been)'''
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.versions == _current_versions():
+        return snapshot
+    with _build_lock:
+        # Another thread may have just built it
+        versions = _current_versions()
+        if _snapshot is None or _snapshot.versions != versions:
+            start = time.perf_counter()
+            # Never from the replica: this process may only just have heard of a
+            # change (see coherence.py) that the replica still lacks, and then
+            # would keep its rows until the next. The read snapshot is only
+            # read while it's current.
+            with timing.stage('snapshot'), timing.database_queries(), api_reads(), \
+                    replica.primary_reads():
+                _snapshot = Snapshot.build(versions)
+            metrics.observe('read_model_build_seconds', time.perf_counter() - start)
+            metrics.increment('read_model_builds')
+        return _snapshot
+
+
+def warm_up() -> None:
+    '''Build the first snapshot at boot. Called from the WSGI entry point, so
+    with gunicorn's --preload the workers inherit it rather than each building
+    their own on their first request.'''
+    if not settings.API_READ_MODEL:
+        return
+    try:
+        get_snapshot()
+    except Exception:
+        # Before the first migration, say. The first request will try again.
+        logger.exception('Could not build the read model at boot')
+    finally:
+        # Connections mustn't be shared with the forked workers
+        connections.close_all()
+
+
+_currency_manager = CurrencyManager()
+
+
+class _Context(NamedTuple):
+    '''What the records' fields are computed with'''
+    query_strings: QueryDict
+    language: str
+    # modeltranslation's name for the language: 'en' for 'en-us', for example
+    translation_language: str
+
+
+def construct_response(view_name, dates, query_strings) -> dict:
+    '''The equivalent of views._construct_response, from the snapshot.
+    dates come from views._get_lookup_dates.'''
+    snapshot = get_snapshot()
+    if view_name == 'evaluations':
+        abbreviations = [abbreviation.upper() for abbreviation
+                         in query_strings.getlist('charity_abbreviation')
+                         ] or snapshot.charity_abbreviations
+        if dates.donation_year:
+            records = snapshot.evaluations_as_of(dates, abbreviations)
+        else:
+            records = snapshot.evaluations_in(dates, abbreviations)
+        getters = _EVALUATION_GETTERS
+    else:
+        if dates.donation_year:
+            records = snapshot.grants_as_of(view_name, dates)
+        else:
+            records = snapshot.grants_in(view_name, dates)
+        getters = _GRANT_GETTERS
+
+    with timing.stage('serialize'):
+        context = _Context(query_strings, get_language(), get_translation_language())
+        fields = sparse_fields.requested(query_strings, view_name)
+        response = {view_name: [_as_dict(getters, record, context, fields)
+                                for record in records]}
+    if not records:
+        response['warnings'] = [f'No {view_name} found with those parameters']
+    return response
+
+
+def _as_dict(getters, record, context, fields) -> dict:
+    '''The record's fields, or those given (see sparse_fields.py), in a new dict'''
+    if fields is None:
+        return {name: get(record, context, None) for name, get in getters.items()}
+    return {name: get(record, context, fields[name]) for name, get in getters.items()
+            if name in fields}
+
+
+# Each field of the records' dicts has a getter, taking the record, the _Context
+# and the fields wanted of the record nested in that field (None for all of them)
+def _attribute(name):
+    get = attrgetter(name)
+    return lambda record, context, fields: get(record)
+
+
+def _intervention(record, context, fields) -> dict:
+    return sparse_fields.select(record.intervention.as_dict(context.translation_language),
+                                fields)
+
+
+def _charity(record, context, fields) -> dict:
+    return sparse_fields.select(record.charity.as_dict(), fields)
+
+
+def _exchange_rate_date(record, context, fields) -> date:
+    return _currency_manager.actual_exchange_rate_date(context.query_strings, record)
+
+
+def _currency(record, context, fields) -> str:
+    return _currency_manager.currency(context.query_strings)
+
+
+def _language(record, context, fields) -> str:
+    return context.language
+
+
+# Matches EvaluationSerializer's output, key for key
+_EVALUATION_GETTERS = {
+    'id': _attribute('id'),
+    'intervention': _intervention,
+    'converted_cost_per_output': lambda evaluation, context, fields: (
+        _currency_manager.converted_price(
+            context.query_strings, evaluation.cents_per_output, evaluation)),
+    'exchange_rate_date': _exchange_rate_date,
+    'currency': _currency,
+    'language': _language,
+    'start_year': _attribute('start_year'),
+    'start_month': _attribute('start_month'),
+    'cents_per_output': _attribute('cents_per_output'),
+    'cents_per_output_upper_bound': _attribute('cents_per_output_upper_bound'),
+    'cents_per_output_lower_bound': _attribute('cents_per_output_lower_bound'),
+    'source_name': _attribute('source_name'),
+    'source_url': _attribute('source_url'),
+    'comment': _attribute('comment'),
+    'charity': _charity,
+}
+
+# Matches AllotmentSerializer's output, key for key
+_ALLOTMENT_GETTERS = {
+    'id': _attribute('id'),
+    'intervention': _intervention,
+    'converted_sum': lambda allotment, context, fields: _currency_manager.converted_price(
+        context.query_strings, allotment.sum_in_cents, allotment),
+    'currency': _currency,
+    'converted_cost_per_output': lambda allotment, context, fields: (
+        _currency_manager.converted_price(
+            context.query_strings, allotment.cents_per_output(), allotment)),
+    'exchange_rate_date': _exchange_rate_date,
+    'sum_in_cents': _attribute('sum_in_cents'),
+    'number_outputs_purchased': _attribute('number_outputs_purchased'),
+    'number_outputs_purchased_lower_bound': _attribute('number_outputs_purchased_lower_bound'),
+    'number_outputs_purchased_upper_bound': _attribute('number_outputs_purchased_upper_bound'),
+    'source_name': _attribute('source_name'),
+    'source_url': _attribute('source_url'),
+    'comment': _attribute('comment'),
+    'charity': _charity,
+}
+
+# Matches MaxImpactFundGrantSerializer's and AllGrantsFundGrantSerializer's output
+_GRANT_GETTERS = {
+    'id': _attribute('id'),
+    'allotment_set': lambda grant, context, fields: [
+        _as_dict(_ALLOTMENT_GETTERS, allotment, context, fields)
+        for allotment in grant.allotments],
+    'language': _language,
+    'start_year': _attribute('start_year'),
+    'start_month': _attribute('start_month'),
+}
@@ -0,0 +1,200 @@
+'''A read-only SQLite copy of the public data, for the API to read from instead of
+Cloud SQL.
+
+The data changes a few times a month, so export_read_snapshot writes it to a
+file that ships with the image, and instances started from that image answer
+the API's reads without going over the network. Once an instance learns of a
+change made after the export (from its own admin or, through the shared data
+versions, anyone else's), its reads go back to MySQL until the next export.'''
+import contextlib
+import contextvars
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from django.db.backends.signals import connection_created
+from django.db.utils import ConnectionHandler
+from django.dispatch import receiver
+
+from . import metrics
+from .models import (
+    VIEW_NAMES, AllGrantsFundGrant, Allotment, Charity, Evaluation, Intervention,
+    MaxImpactFundGrant, Tombstone)
+
+logger = logging.getLogger(__name__)
+
+ALIAS = 'read_snapshot'
+# In dependency order, for the foreign keys
+MODELS = (Charity, Intervention, MaxImpactFundGrant, AllGrantsFundGrant, Evaluation, Allotment,
+          Tombstone)
+# Beyond those the models bring (foreign keys and unique constraints), for the
+# views' date range queries
+INDEXES = {
+    Evaluation: [models.Index(fields=['start_year', 'start_month'],
+                              name='snapshot_evaluation_date')],
+}
+META_TABLE = 'read_snapshot_meta'
+# The whole file, for a dataset this size
+MMAP_BYTES = 256 * 1024 * 1024
+INSERT_BATCH_SIZE = 1000
+
+_api_reads = contextvars.ContextVar('api_reads', default=False)
+
+
+@contextlib.contextmanager
+def api_reads():
+    '''Mark the queries run inside as the API's, for the routers (see routers.py)
+    to send to the snapshot or a replica. The admin's reads stay on the primary,
+    where its writes go.'''
+    token = _api_reads.set(True)
+    try:
+        yield
+    finally:
+        _api_reads.reset(token)
+
+
+def in_api_reads() -> bool:
+    return _api_reads.get()
+
+
+def export(path, using=DEFAULT_DB_ALIAS) -> dict:
+    '''Write the public tables from the using database to a new SQLite file at
+    path, replacing any there once it's complete. Returns the rows per table.'''
+    # Taken before reading anything, so that a change saved mid-export counts as newer
+    started = time.time()
+    fd, temporary = tempfile.mkstemp(
+        suffix='.sqlite3', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        handler = ConnectionHandler({DEFAULT_DB_ALIAS: {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': temporary}})
+        connection = handler[DEFAULT_DB_ALIAS]
+        try:
+            # Not atomic: that would open a transaction on the global connection
+            # of the same alias
+            with connection.schema_editor(atomic=False) as editor:
+                for model in MODELS:
+                    editor.create_model(model)
+                    for index in INDEXES.get(model, ()):
+                        editor.add_index(model, index)
+            rows = {model._meta.db_table: _copy_rows(model, using, connection)
+                    for model in MODELS}
+            with connection.cursor() as cursor:
+                cursor.execute(f'CREATE TABLE {META_TABLE} (name TEXT PRIMARY KEY, value TEXT)')
+                cursor.execute(f'INSERT INTO {META_TABLE} VALUES (%s, %s)',
+                               ['exported_at', repr(started)])
+                cursor.execute('ANALYZE')
+                cursor.execute('VACUUM')
+        finally:
+            connection.close()
+        os.chmod(temporary, 0o444)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return rows
+
+
+def _copy_rows(model, using, connection) -> int:
+    fields = model._meta.concrete_fields
+    quote_name = connection.ops.quote_name
+    insert = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)))
+    values = model._base_manager.using(using).order_by('pk').values_list(
+        *[field.attname for field in fields]).iterator(chunk_size=INSERT_BATCH_SIZE)
+    count = 0
+    with connection.cursor() as cursor:
+        batch = []
+        for row in values:
+            batch.append([field.get_db_prep_save(value, connection)
+                          for field, value in zip(fields, row)])
+            if len(batch) == INSERT_BATCH_SIZE:
+                cursor.executemany(insert, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(insert, batch)
+            count += len(batch)
+    return count
+
+
+def exported_at() -> float:
+    with connections[ALIAS].cursor() as cursor:
+        cursor.execute(f'SELECT value FROM {META_TABLE} WHERE name = %s', ['exported_at'])
+        return float(cursor.fetchone()[0])
+
+
+def _current_versions() -> tuple:
+    from .cache import data_version
+
+    return tuple(data_version(view_name) for view_name in VIEW_NAMES)
+
+
+# The data versions the snapshot was found to be current at, or False if it
+# wasn't. None until it's been checked.
+_current_at = None
+_check_lock = threading.Lock()
+
+
+def is_current() -> bool:
+    '''Whether there is a snapshot, and no change has been made since it was
+    exported. Checked against the shared data versions once, on first use, and
+    after that against this process's: any change makes it stale for good.'''
+    global _current_at
+    if ALIAS not in connections.settings:
+        return False
+    if _current_at is None:
+        with _check_lock:
+            if _current_at is None:
+                _current_at = _check()
+    if _current_at is False:
+        return False
+    if _current_at != _current_versions():
+        with _check_lock:
+            if _current_at is not False:
+                _current_at = False
+                metrics.increment('read_snapshot_stale')
+                logger.info('The data has changed since the read snapshot was exported, '
+                            'reading from %s instead', DEFAULT_DB_ALIAS)
+        return False
+    return True
+
+
+def _check():
+    from .cache import ALL_VIEWS, get_backend
+
+    versions = _current_versions()
+    try:
+        exported = exported_at()
+        shared = get_backend().get_versions([ALL_VIEWS, *VIEW_NAMES])
+    except Exception:
+        # Reading MySQL is always right, if slower
+        metrics.increment('read_snapshot_check_failures')
+        logger.exception('Could not check whether the read snapshot is current')
+        return False
+    changed = [name for name, version in shared.items() if version > exported]
+    if changed:
+        logger.info('Not using the read snapshot, exported before changes to %s', changed)
+        return False
+    return versions
+
+
+def set_mmap_size(sender, connection, **kwargs):
+    if connection.alias == ALIAS:
+        connection.connection.execute(f'PRAGMA mmap_size = {MMAP_BYTES}')
+
+
+@receiver(setting_changed)
+def reset_check(setting, **kwargs):
+    global _current_at
+    if setting == 'API_READ_SNAPSHOT':
+        _current_at = None
+
+
+connection_created.connect(set_mmap_size)
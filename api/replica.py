@@ -0,0 +1,69 @@
+'''Sending the API's reads to a read replica, when settings.API_DB_REPLICA's
+ALIAS is configured, while the admin's reads and every write stay on the primary.
+
+A replica lags its primary a little, so for STICKY_SECONDS after a change the
+API reads the primary instead:
+- in every process that knows of the change, going by the data versions (which
+  are the times of the changes). This keeps the caches rebuilt on an
+  invalidation from being filled from a replica that hasn't caught up.
+- for the admin who made it, wherever their requests land, going by a cookie
+  that ReplicaMiddleware sets on the response to the write.'''
+import contextlib
+import contextvars
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from .models import VIEW_NAMES
+
+COOKIE_NAME = 'api_primary_reads_until'
+
+# A dict for the current request, shared with the threads it runs its sync
+# code in: 'primary' if the API should read the primary, 'wrote' once it's
+# written any public data
+_request_state = contextvars.ContextVar('replica_request_state', default=None)
+
+
+def replica_alias():
+    '''The replica's alias, if there is one'''
+    alias = settings.API_DB_REPLICA['ALIAS']
+    return alias if alias in connections.settings else None
+
+
+def start_request(read_primary) -> contextvars.Token:
+    return _request_state.set({'primary': read_primary, 'wrote': False})
+
+
+def finish_request(token) -> bool:
+    '''Whether the request wrote any public data'''
+    wrote = _request_state.get()['wrote']
+    _request_state.reset(token)
+    return wrote
+
+
+@contextlib.contextmanager
+def primary_reads():
+    '''Read the primary inside, whatever the request would otherwise'''
+    token = _request_state.set({'primary': True, 'wrote': False})
+    try:
+        yield
+    finally:
+        _request_state.reset(token)
+
+
+def record_write() -> None:
+    state = _request_state.get()
+    if state is not None:
+        state['wrote'] = True
+
+
+def reads_primary() -> bool:
+    '''Whether the API should read the primary rather than the replica just now'''
+    state = _request_state.get()
+    if state is not None and state['primary']:
+        return True
+    from .cache import data_version
+
+    latest_change = max(data_version(view_name) for view_name in VIEW_NAMES)
+    return time.time() - latest_change < settings.API_DB_REPLICA['STICKY_SECONDS']
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from . import read_snapshot, replica
+
+
+class ReadSnapshotRouter:
+    '''Sends the API's reads of the public data to the read snapshot while it's
+    current (see read_snapshot.py). Everything else, the admin included, uses
+    the default database.'''
+    def db_for_read(self, model, **hints):
+        if (read_snapshot.in_api_reads() and model in read_snapshot.MODELS
+                and read_snapshot.is_current()):
+            return read_snapshot.ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The snapshot is a copy of the default database's rows
+        if {obj1._state.db, obj2._state.db} <= {None, DEFAULT_DB_ALIAS, read_snapshot.ALIAS}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Its tables come from export_read_snapshot, not migrations
+        if db == read_snapshot.ALIAS:
+            return False
+        return None
+
+
+class ReplicaRouter:
+    '''Sends the API's reads to the replica, if there is one, unless they need
+    to see a recent change (see replica.py). Writes, and the admin's reads, go
+    to the primary (the default database).'''
+    def db_for_read(self, model, **hints):
+        if read_snapshot.in_api_reads():
+            alias = replica.replica_alias()
+            if alias and not replica.reads_primary():
+                return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model in read_snapshot.MODELS:
+            replica.record_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._state.db, obj2._state.db} <= {
+                None, DEFAULT_DB_ALIAS, settings.API_DB_REPLICA['ALIAS']}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # It gets its tables from the primary
+        if db == settings.API_DB_REPLICA['ALIAS']:
+            return False
+        return None
@@ -1,83 +1,48 @@
 from django.utils.translation import get_language
 from rest_framework import serializers
-from currency_converter import RateNotFoundError
+from rest_framework.utils.field_mapping import get_nested_relation_kwargs
 from .models import Evaluation, MaxImpactFundGrant, Allotment, Intervention, AllGrantsFundGrant
-from .__init__ import get_currency_converter
-from datetime import date, timedelta
-
-
-class CurrencyManager():
-    '''Deals with currency conversions
-
-    #converted_price converts US cents to other currency specified in a context object
-    #currency returns currency from a context object
-    '''
-    DEFAULT_LANGUAGE_CURRENCY_MAPPING = {
-        'no': 'NOK',
-        'en': 'USD',
-        'et': 'EUR',
-        'sv': 'SEK',
-    }
-
-    def converted_price(self, context, original_value, model_instance) -> float:
-        '''Get latest conversion on relevant date and return cost per
-        output in specified currency, else in USD. Fetches today's currency data
-        from the ECB website if we don't already have it'''
-        return self._converted_price_and_date(
-            context, model_instance, original_value)['converted_value']
-
-    def actual_exchange_rate_date(self, context, model_instance) -> date:
-        '''Get the actual date the currency was converted on, after
-        adjusting for days where it wasn't available. Fetches today's currency data
-        from the ECB website if we don't already have it'''
-        return self._converted_price_and_date(
-            context, model_instance)['conversion_date']
-
-    def currency(self, context) -> str:
-        '''Return specified currency code, else USD'''
-        return (context.get('currency')
-                or self.DEFAULT_LANGUAGE_CURRENCY_MAPPING[get_language()]).upper()
-
-    def _converted_price_and_date(self, context, model_instance, original_value=1) -> dict:
-
-        conversion_date = self._targeted_conversion_date(
-            context, model_instance)
-
-        currency_code = (context.get('currency')
-                         or self.DEFAULT_LANGUAGE_CURRENCY_MAPPING[get_language()]).upper()
-
-        converted_value = get_currency_converter().convert(
-            original_value / 100,
-            'USD',
-            currency_code,
-            conversion_date)
-
-        return {'conversion_date': conversion_date,
-                'converted_value': converted_value}
-
-    def _targeted_conversion_date(self, context, model_instance) -> date:
-        if context.get('conversion_year'):
-            attempted_conversion_date = date(
-                int(context.get('conversion_year')),
-                int(context.get('conversion_month', 1)),
-                int(context.get('conversion_day', 1)))
-        elif context.get('donation_year'):
-            attempted_conversion_date = date(
-                int(context.get('donation_year')),
-                int(context.get('donation_month', 1)),
-                int(context.get('donation_day', 1)))
-        else:
-            attempted_conversion_date = model_instance.start_date()
-        return attempted_conversion_date
-
-
-class InterventionSerializer(serializers.ModelSerializer):
+# Shared with the read model (see read_model.py), which mustn't import REST framework
+from .currency import CurrencyManager
+
+
+class RecordSerializer(serializers.ModelSerializer):
+    '''Leaves updated_at, which is for /api/changes, out of the record and the
+    records nested in it (with depth). Given sparse_fields (see sparse_fields.py),
+    serializes only those fields, of it and of the records nested in it.'''
+    def __init__(self, *args, sparse_fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sparse_fields = sparse_fields
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.sparse_fields is None:
+            return fields
+        fields = {name: field for name, field in fields.items() if name in self.sparse_fields}
+        for name, nested_fields in self.sparse_fields.items():
+            if nested_fields is not None:
+                # A nested serializer, or a list of them with one child serializer
+                nested = fields[name]
+                getattr(nested, 'child', nested).sparse_fields = nested_fields
+        return fields
+
+    def build_nested_field(self, field_name, relation_info, nested_depth):
+        class NestedSerializer(RecordSerializer):
+            class Meta:
+                model = relation_info.related_model
+                depth = nested_depth - 1
+                exclude = ['updated_at']
+
+        return NestedSerializer, get_nested_relation_kwargs(relation_info)
+
+
+class InterventionSerializer(RecordSerializer):
     class Meta:
         model = Intervention
         fields = ['long_description', 'short_description', 'id']
 
 
-class AllotmentSerializer(serializers.ModelSerializer):
+class AllotmentSerializer(RecordSerializer):
     intervention = InterventionSerializer(read_only=True)
     converted_sum = serializers.SerializerMethodField()
     currency = serializers.SerializerMethodField()
@@ -106,11 +71,11 @@ class AllotmentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Allotment
-        exclude = ['max_impact_fund_grant', 'all_grants_fund_grant']
+        exclude = ['max_impact_fund_grant', 'all_grants_fund_grant', 'updated_at']
         depth = 1
 
 
-class EvaluationSerializer(serializers.ModelSerializer):
+class EvaluationSerializer(RecordSerializer):
     intervention = InterventionSerializer(read_only=True)
     converted_cost_per_output = serializers.SerializerMethodField()
     exchange_rate_date = serializers.SerializerMethodField()
@@ -138,11 +103,11 @@ class EvaluationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Evaluation
-        fields = '__all__'
+        exclude = ['updated_at']
         depth = 1
 
 
-class MaxImpactFundGrantSerializer(serializers.ModelSerializer):
+class MaxImpactFundGrantSerializer(RecordSerializer):
     allotment_set = AllotmentSerializer(many=True)
     language = serializers.SerializerMethodField()
 
@@ -152,9 +117,9 @@ class MaxImpactFundGrantSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = MaxImpactFundGrant
-        fields = '__all__'
+        exclude = ['updated_at']
 
-class AllGrantsFundGrantSerializer(serializers.ModelSerializer):
+class AllGrantsFundGrantSerializer(RecordSerializer):
     allotment_set = AllotmentSerializer(many=True)
     language = serializers.SerializerMethodField()
 
@@ -164,4 +129,4 @@ class AllGrantsFundGrantSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = AllGrantsFundGrant
-        fields = '__all__'
+        exclude = ['updated_at']
@@ -0,0 +1,141 @@
+'''Sparse fieldsets: a fields query string naming the fields of each record to
+return, for clients that need only a few of them, e.g.
+
+    fields=converted_cost_per_output,currency,charity.abbreviation
+
+A nested record's fields are named by their path, and naming the nested record
+itself (charity) returns all of its fields. Every record keeps its id, and the
+views compute nothing else. Only the ORM path (settings.API_READ_MODEL off) also
+reads just the columns those fields need: the read model holds every record in
+full, built once and shared by every request. QueriesMiddleware checks the paths
+and rewrites them in a canonical order, so that requests for the same fields
+share a cache entry.'''
+from typing import Optional
+
+CHARITY_FIELDS = {'id': None, 'charity_name': None, 'abbreviation': None}
+INTERVENTION_FIELDS = {'long_description': None, 'short_description': None, 'id': None}
+ALLOTMENT_FIELDS = {
+    'id': None, 'intervention': INTERVENTION_FIELDS, 'converted_sum': None, 'currency': None,
+    'converted_cost_per_output': None, 'exchange_rate_date': None, 'sum_in_cents': None,
+    'number_outputs_purchased': None, 'number_outputs_purchased_lower_bound': None,
+    'number_outputs_purchased_upper_bound': None, 'source_name': None, 'source_url': None,
+    'comment': None, 'charity': CHARITY_FIELDS,
+}
+GRANT_FIELDS = {
+    'id': None, 'allotment_set': ALLOTMENT_FIELDS, 'language': None, 'start_year': None,
+    'start_month': None,
+}
+
+# Each view's records' fields, with those of nested records, in the order the
+# serializers output them
+FIELDS = {
+    'evaluations': {
+        'id': None, 'intervention': INTERVENTION_FIELDS, 'converted_cost_per_output': None,
+        'exchange_rate_date': None, 'currency': None, 'language': None, 'start_year': None,
+        'start_month': None, 'cents_per_output': None, 'cents_per_output_upper_bound': None,
+        'cents_per_output_lower_bound': None, 'source_name': None, 'source_url': None,
+        'comment': None, 'charity': CHARITY_FIELDS,
+    },
+    'max_impact_fund_grants': GRANT_FIELDS,
+    'all_grants_fund_grants': GRANT_FIELDS,
+}
+
+# The columns a field is computed from, where they aren't just its own
+_EVALUATION_COLUMNS = {
+    'converted_cost_per_output': ('cents_per_output', 'start_year', 'start_month'),
+    'exchange_rate_date': ('start_year', 'start_month'),
+    'currency': (),
+    'language': (),
+}
+_ALLOTMENT_COLUMNS = {
+    'converted_sum': ('sum_in_cents',),
+    'converted_cost_per_output': ('sum_in_cents', 'number_outputs_purchased'),
+    'exchange_rate_date': (),
+    'currency': (),
+}
+# An allotment's conversions are as of its grant's start
+_GRANT_COLUMNS = {'allotment_set': ('start_year', 'start_month'), 'language': ()}
+# Allotments are matched to their grant by these, which start_date also reads
+ALLOTMENT_GRANT_COLUMNS = ('max_impact_fund_grant', 'all_grants_fund_grant')
+
+
+class InvalidField(ValueError):
+    pass
+
+
+def parse(values, view_name) -> Optional[dict]:
+    '''The fields named in the values of the fields query string, as a dict like
+    FIELDS[view_name] with None for each field wanted whole, or None if no field
+    is named. Raises InvalidField for a path the view's records don't have.'''
+    wanted = {}
+    for value in values:
+        for path in value.split(','):
+            path = path.strip()
+            if path:
+                _add(wanted, path.split('.'), FIELDS[view_name], path)
+    if not wanted:
+        return None
+    wanted['id'] = None
+    return wanted
+
+
+def _add(wanted, names, available, path):
+    name, *rest = names
+    if name not in available:
+        raise InvalidField(path)
+    if not rest or available[name] is None:
+        if rest:
+            raise InvalidField(path)
+        wanted[name] = None
+    elif name not in wanted:
+        wanted[name] = {}
+        _add(wanted[name], rest, available[name], path)
+    elif wanted[name] is not None:
+        # Unless the whole record is already wanted
+        _add(wanted[name], rest, available[name], path)
+
+
+def canonical(fields) -> str:
+    '''The value of the fields query string naming just these fields'''
+    return ','.join(sorted(_paths(fields)))
+
+
+def _paths(fields, prefix=''):
+    for name, nested in fields.items():
+        if nested is None:
+            yield prefix + name
+        else:
+            yield from _paths(nested, f'{prefix}{name}.')
+
+
+def requested(query_strings, view_name) -> Optional[dict]:
+    '''The fields a request asks for, as parse returns them. The query strings
+    must have been checked by QueriesMiddleware.'''
+    return parse(query_strings.getlist('fields'), view_name)
+
+
+def select(record, fields):
+    '''A copy of record (a dict, or a list of them) with only the given fields,
+    or record itself given None'''
+    if fields is None:
+        return record
+    if isinstance(record, list):
+        return [select(item, fields) for item in record]
+    return {name: select(value, fields[name]) for name, value in record.items()
+            if name in fields}
+
+
+def columns(view_name, fields) -> list:
+    '''The columns of the view's model to read for the fields, for only()'''
+    overrides = _EVALUATION_COLUMNS if view_name == 'evaluations' else _GRANT_COLUMNS
+    return _columns(fields, overrides)
+
+
+def allotment_columns(fields) -> list:
+    return [*ALLOTMENT_GRANT_COLUMNS, *_columns(fields, _ALLOTMENT_COLUMNS)]
+
+
+def _columns(fields, overrides) -> list:
+    # A nested record is read through its foreign key, named as the field
+    return list(dict.fromkeys(column for name in fields
+                              for column in overrides.get(name, (name,))))
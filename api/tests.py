@@ -1,14 +1,59 @@
-from datetime import date
+import asyncio
+import contextlib
+from collections import namedtuple
+from datetime import date, timedelta
+import gzip
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
-from django.test import TestCase
+import operator
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
+from asgiref.sync import async_to_sync, sync_to_async
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.http import HttpResponse, JsonResponse
+from django.db import connections, transaction
+from django.test import AsyncRequestFactory, Client, RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+import django.test
 from django.urls import reverse
+from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.contrib.admin.sites import AdminSite
 from currency_converter import CurrencyConverter
 from api.admin import EvaluationAdmin, AllotmentAdmin
-from api import serializers
+import api.cache_backends
+from api.cache import (
+    CircuitOpen, bump_data_version, cache_key, changed_at, clear_cache, conditional_get,
+    data_version, datastore_cache, prune_cache, sync_data_versions)
+from api.cache_backends import DatastoreBackend, DjangoCacheBackend, InMemoryBackend, get_backend
+from api.cache_sweeper import CacheSweeper
+from api.cache_writer import CacheWriter, get_writer
+from api.circuit_breaker import get_breaker
+from api.coherence import VersionPoller
+from api.compression import brotli, negotiate_encoding
+from api.edge import edge_cache, purge_edge_cache, surrogate_keys
+from api.middleware import AdminMiddleware, QueriesMiddleware, ServerTimingMiddleware
+from api import (
+    CONVERSIONS_DIR, async_views, db, events, invalidation, latest_local_rates, load_converter,
+    metrics, middleware, read_model, read_snapshot, replica, serializers, snapshot_filename,
+    sparse_fields, timing, views)
 from api.models import (
-    Allotment, Evaluation, MaxImpactFundGrant, Charity, Intervention, AllGrantsFundGrant)
+    Allotment, Evaluation, MaxImpactFundGrant, Charity, Intervention, AllGrantsFundGrant,
+    RequestProfile, Tombstone, VIEW_NAMES)
 from freezegun import freeze_time
 # Freeze time on tests that hit the currency converter so that the tests
 # don't grab external ECB data
@@ -80,6 +125,15 @@ def create_allotment(
     elif type(grant) == AllGrantsFundGrant:
         return Allotment.objects.create(all_grants_fund_grant=grant, **params)
 
+class TestCase(django.test.TestCase):
+    '''Each test's transaction is rolled back rather than committed, so its saves
+    never clear the cache. Start every test with an empty one instead.'''
+    def _pre_setup(self):
+        super()._pre_setup()
+        invalidation.flush()
+        get_writer().flush()
+        clear_cache()
+
 class CharityModelTests(TestCase):
     def test_string_representation(self):
         charity = Charity(charity_name="Evil Henchperson's Union")
@@ -241,6 +295,41 @@ class MiddlewareIntegrationTests(TestCase):
         self.assertEqual(content_2['errors'][0], 'Currency ZZZ not supported')
         self.assertEqual(content_2['errors'][1], 'Language code zz not supported')
 
+    def test_supported_currencies_are_the_converters(self):
+        converter = CurrencyConverter(latest_local_rates(), True, True)
+        self.assertEqual(middleware.SUPPORTED_CURRENCIES, converter.currencies)
+
+    def test_non_numeric_and_out_of_range_queries_error(self):
+        query = reverse('evaluations') + '?start_year=twenty&end_month=13&donation_day=0'
+        content = json.loads(self.client.get(query).content)
+        self.assertEqual(content['errors'], [
+            'start_year must be an integer',
+            'end_month must be between 1 and 12',
+            'donation_day must be between 1 and 31'])
+
+    def test_impossible_dates_error(self):
+        query = reverse('max_impact_fund_grants') + (
+            '?conversion_year=2021&conversion_month=2&conversion_day=30')
+        content = json.loads(self.client.get(query).content)
+        self.assertEqual(content['errors'], [
+            'conversion_year, conversion_month and conversion_day must form a valid date'])
+
+    def test_numeric_queries_are_normalized(self):
+        request = RequestFactory().get(
+            reverse('evaluations'), {'start_year': ' 2011', 'end_month': '06', 'donation_day': ''})
+        response = QueriesMiddleware(lambda request: None).process_view(
+            request, None, (), {})
+        self.assertIsNone(response)
+        self.assertEqual(request.GET['start_year'], '2011')
+        self.assertEqual(request.GET['end_month'], '6')
+        self.assertEqual(request.GET['donation_day'], '')
+
+    def test_only_validates_api_routes(self):
+        request = RequestFactory().get('/admin/login/', {'currency': 'zzz', 'start_year': 'x'})
+        response = QueriesMiddleware(lambda request: None).process_view(
+            request, None, (), {})
+        self.assertIsNone(response)
+
 @freeze_time("2022-08-23")
 class EvaluationViewTests(TestCase):
     def setUp(self):
@@ -834,3 +923,1918 @@ class AllGrantsFundGrantModelTests(TestCase):
             grant.clean_fields()
         except ValidationError as e:
             self.assertIn('month must be a number from 1-12', e.message_dict['start_month'])
+
+class FakeConnection:
+    def __init__(self, usable=True, health_checks=True):
+        self.alias = 'default'
+        self.connection = object()
+        self.settings_dict = {'CONN_HEALTH_CHECKS': health_checks}
+        self.usable = usable
+        self.checks = 0
+
+    def is_usable(self):
+        self.checks += 1
+        return self.usable
+
+    def close(self):
+        self.connection = None
+
+    def _cursor(self):
+        return self.connection
+
+class ConnectionHealthTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def start_request(self, connection):
+        with mock.patch.object(db.connections, 'all', return_value=[connection]):
+            db.check_connection_health()
+
+    def test_reused_connections_are_counted(self):
+        connection = FakeConnection()
+        for _ in range(2):
+            self.start_request(connection)
+            connection._cursor()
+            connection._cursor()
+        self.assertIsNotNone(connection.connection)
+        self.assertEqual(metrics.counter('db_connections_reused', alias='default'), 2)
+
+    def test_connections_are_only_checked_when_used(self):
+        connection = FakeConnection()
+        self.start_request(connection)
+        self.assertEqual(connection.checks, 0)
+        self.assertEqual(metrics.counter('db_connections_reused', alias='default'), 0)
+
+    @skipIf(django.VERSION >= (4, 1), 'Django checks connection health natively')
+    def test_unusable_connections_are_closed(self):
+        connection = FakeConnection(usable=False)
+        self.start_request(connection)
+        self.assertIsNone(connection._cursor())
+        self.assertEqual(connection.checks, 1)
+        self.assertEqual(metrics.counter('db_connections_unusable', alias='default'), 1)
+        self.assertEqual(metrics.counter('db_connections_reused', alias='default'), 0)
+
+    def test_health_checks_can_be_disabled(self):
+        connection = FakeConnection(usable=False, health_checks=False)
+        self.start_request(connection)
+        self.assertIsNotNone(connection._cursor())
+
+FIRST_CACHE_HIT_SCRIPT = '''
+import json, os, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'impact_api.settings')
+os.environ['API_CACHE_BACKEND'] = 'api.cache_backends.DatastoreBackend'
+import django
+django.setup()
+from unittest import mock
+from django.test import Client
+from django.test.utils import setup_test_environment
+import api.cache_backends
+
+class FakeClient:
+    def key(self, *path):
+        return path
+    def get(self, key, timeout=None):
+        return {'expires': time.time() + 60, 'response': json.dumps({'evaluations': []})}
+
+setup_test_environment()
+with mock.patch.object(api.cache_backends, 'get_client', FakeClient):
+    response = Client().get('/api/evaluations')
+elapsed = time.perf_counter() - start
+assert response.status_code == 200, response.status_code
+converter_built = any(getattr(sys.modules.get(name), 'converter', None) is not None
+                      for name in ('api', 'api.__init__'))
+print(json.dumps({'seconds': elapsed, 'modules': sorted(sys.modules),
+                  'converter_built': converter_built}))
+'''
+
+class StartupProfileTests(SimpleTestCase):
+    '''Cold start costs. These run fresh interpreters, since this one has long
+    since imported everything'''
+    # Generous enough for a loaded CI runner; override to tighten locally
+    FIRST_CACHE_HIT_BUDGET_SECONDS = float(os.getenv('FIRST_CACHE_HIT_BUDGET_SECONDS', 2))
+
+    def run_python(self, *args) -> subprocess.CompletedProcess:
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='impact_api.settings')
+        return subprocess.run([sys.executable, *args], cwd=settings.BASE_DIR, env=env,
+                              capture_output=True, text=True, check=True)
+
+    def test_boot_defers_heavy_imports(self):
+        '''Booting Django and loading the views shouldn't import the Datastore
+        client or REST framework'''
+        result = self.run_python('-X', 'importtime', '-c', (
+            'import django; django.setup(); import impact_api.urls'))
+        timings = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative_us, module = line.split('|')
+            timings.append((int(cumulative_us), module.strip()))
+        modules = {module for _, module in timings}
+        report = '\n'.join(f'{us / 1000:8.1f}ms {module}' for us, module in sorted(timings)[-15:])
+        self.assertNotIn('google.cloud.datastore', modules, report)
+        self.assertNotIn('rest_framework', modules, report)
+
+    def test_first_cache_hit_is_within_budget(self):
+        result = json.loads(self.run_python('-c', FIRST_CACHE_HIT_SCRIPT).stdout)
+        self.assertNotIn('rest_framework', result['modules'])
+        self.assertFalse(result['converter_built'])
+        self.assertLess(result['seconds'], self.FIRST_CACHE_HIT_BUDGET_SECONDS)
+
+class ConverterSnapshotTests(SimpleTestCase):
+    def test_converter_is_restored_from_snapshot(self):
+        source = os.path.join(CONVERSIONS_DIR, 'ecb_20220823.zip')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'ecb_20220823.zip')
+            shutil.copy(source, filename)
+            parsed = load_converter(filename)
+            self.assertTrue(os.path.isfile(snapshot_filename(filename)))
+            with mock.patch.object(CurrencyConverter, 'load_file') as load_file:
+                restored = load_converter(filename)
+            load_file.assert_not_called()
+        self.assertEqual(restored.currencies, parsed.currencies)
+        self.assertEqual(restored.convert(100, 'USD', 'NOK', date(2021, 2, 13)),
+                         parsed.convert(100, 'USD', 'NOK', date(2021, 2, 13)))
+
+    def test_unreadable_snapshot_falls_back_to_zip(self):
+        source = os.path.join(CONVERSIONS_DIR, 'ecb_20220823.zip')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'ecb_20220823.zip')
+            shutil.copy(source, filename)
+            with open(snapshot_filename(filename), 'wb') as file:
+                file.write(b'not a pickle')
+            with self.assertLogs('api', 'ERROR'):
+                converter = load_converter(filename)
+        self.assertIn('NOK', converter.currencies)
+
+class AdminMiddlewareTests(SimpleTestCase):
+    def test_api_routes_skip_admin_middleware(self):
+        request = RequestFactory().get('/api/evaluations')
+        AdminMiddleware(lambda request: HttpResponse())(request)
+        self.assertFalse(hasattr(request, 'session'))
+        self.assertFalse(hasattr(request, 'user'))
+
+    def test_admin_routes_run_admin_middleware(self):
+        request = RequestFactory().get('/admin/')
+        response = AdminMiddleware(lambda request: HttpResponse())(request)
+        self.assertTrue(hasattr(request, 'session'))
+        self.assertTrue(hasattr(request, 'user'))
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+    def test_admin_still_enforces_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post('/admin/login/', {'username': 'a', 'password': 'b'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_async_api_routes_skip_admin_middleware(self):
+        async def get_response(request):
+            return HttpResponse()
+        middleware = AdminMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = RequestFactory().get('/api/evaluations')
+        asyncio.run(middleware(request))
+        self.assertIsNone(asyncio.run(middleware.process_view(request, None, (), {})))
+        self.assertFalse(hasattr(request, 'session'))
+
+class ConditionalGetTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = 0
+        # Start every view's data from 2022-08-23 12:00:00.3, whatever other tests did
+        for patcher in (mock.patch('api.cache._base_version', 1661256000.3),
+                        mock.patch('api.cache._seeded', True),
+                        mock.patch.dict('api.cache._data_versions', clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        @conditional_get
+        def evaluations(request):
+            self.calls += 1
+            return JsonResponse({'evaluations': []})
+        self.view = evaluations
+
+    def get(self, query='', **headers):
+        return self.view(RequestFactory().get('/api/evaluations' + query, **headers))
+
+    def test_unchanged_data_gets_304_without_calling_view(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+        not_modified = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(self.calls, 1)
+
+    def test_changed_data_gets_full_response(self):
+        etag = self.get()['ETag']
+        bump_data_version('evaluations')
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.calls, 2)
+
+    def test_other_views_changing_keeps_etag(self):
+        etag = self.get()['ETag']
+        bump_data_version('max_impact_fund_grants')
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_changes_within_a_second_are_not_taken_as_older(self):
+        with freeze_time('2022-08-23 12:00:00.3') as frozen:
+            bump_data_version('evaluations')
+            frozen.tick(0.2)
+            # The second isn't over, so another change could still fall in it
+            self.assertNotIn('Last-Modified', self.get())
+            frozen.tick(0.2)
+            bump_data_version('evaluations')
+            response = self.get(HTTP_IF_MODIFIED_SINCE='Tue, 23 Aug 2022 12:00:00 GMT')
+            self.assertEqual(response.status_code, 200)
+            frozen.tick(1)
+            self.assertEqual(self.get()['Last-Modified'], 'Tue, 23 Aug 2022 12:00:01 GMT')
+            self.assertEqual(self.get(
+                HTTP_IF_MODIFIED_SINCE='Tue, 23 Aug 2022 12:00:01 GMT').status_code, 304)
+
+    def test_etag_depends_on_every_query_value(self):
+        first = self.get('?charity_abbreviation=AMF&charity_abbreviation=SCI')['ETag']
+        second = self.get('?charity_abbreviation=AMF&charity_abbreviation=GD')['ETag']
+        self.assertNotEqual(first, second)
+        self.assertEqual(
+            self.get('?charity_abbreviation=AMF&charity_abbreviation=SCI')['ETag'], first)
+
+class PurgeRecorder(BaseHTTPRequestHandler):
+    '''Stands in for a CDN's purge API'''
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.purges.append((dict(self.headers), json.loads(body)))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class EdgeCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PurgeRecorder)
+        self.server.purges = []
+        self.server.status = 200
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.purge_settings = {
+            'BACKEND': 'api.edge.HttpPurgeBackend',
+            'URL': f'http://127.0.0.1:{self.server.server_port}/purge',
+            'HEADERS': {'Authorization': 'Bearer sesame'}}
+        metrics.reset()
+
+    def test_surrogate_keys(self):
+        grants = [{'id': 3, 'allotment_set': [
+            {'charity': {'abbreviation': 'AMF'}}, {'charity': {'abbreviation': 'SCI'}},
+            {'charity': {'abbreviation': 'AMF'}}]}]
+        self.assertEqual(surrogate_keys('max_impact_fund_grants', grants),
+                         ['max_impact_fund_grants', 'max_impact_fund_grants-3'])
+        # Charities' changes purge every view, so they aren't worth a key of their own
+        evaluations = [{'charity': {'abbreviation': 'GD'}}]
+        self.assertEqual(surrogate_keys('evaluations', evaluations), ['evaluations'])
+
+    @override_settings(API_CACHE_CONTROL={
+        'public': True, 's_maxage': 600, 'stale_while_revalidate': 30})
+    def test_cache_control(self):
+        view = edge_cache(lambda request: JsonResponse({}))
+        response = view(RequestFactory().get('/api/evaluations'))
+        self.assertEqual(set(response['Cache-Control'].split(', ')),
+                         {'public', 's-maxage=600', 'stale-while-revalidate=30'})
+
+    def test_purge_is_posted(self):
+        with self.settings(EDGE_PURGE=self.purge_settings):
+            purge_edge_cache(['evaluations', 'max_impact_fund_grants-3'])
+        headers, body = self.server.purges[0]
+        self.assertEqual(body, {'surrogate_keys': ['evaluations', 'max_impact_fund_grants-3']})
+        self.assertEqual(headers['Authorization'], 'Bearer sesame')
+        self.assertEqual(metrics.counter('edge_purges'), 1)
+
+    def test_failed_purge_is_logged_not_raised(self):
+        self.server.status = 503
+        with self.settings(EDGE_PURGE=self.purge_settings):
+            with self.assertLogs('api.edge', 'ERROR'):
+                purge_edge_cache(['evaluations'])
+        self.assertEqual(metrics.counter('edge_purge_failures'), 1)
+
+IN_MEMORY_CACHE = {'BACKEND': 'api.cache_backends.InMemoryBackend'}
+
+FakeKey = namedtuple('FakeKey', 'kind name')
+
+class FakeDatastoreClient:
+    '''Just enough of google.cloud.datastore.Client for DatastoreBackend'''
+    OPERATORS = {'=': operator.eq, '<': operator.lt}
+
+    def __init__(self):
+        self.entities = {}
+        self.puts = []
+        self.deletes = []
+        # Those given to each query and delete
+        self.timeouts = []
+
+    def key(self, kind, name):
+        return FakeKey(kind, name)
+
+    def get(self, key, timeout=None):
+        return self.entities.get(key)
+
+    def get_multi(self, keys, timeout=None):
+        return [self.entities[key] for key in keys if key in self.entities]
+
+    def put(self, entity, timeout=None):
+        self.entities[entity.key] = entity
+
+    def put_multi(self, entities, timeout=None):
+        self.puts.append(len(entities))
+        for entity in entities:
+            self.put(entity)
+
+    def query(self, kind):
+        client = self
+
+        class Query:
+            def __init__(self):
+                self.filters = []
+
+            def add_filter(self, name, operator, value):
+                self.filters.append((name, FakeDatastoreClient.OPERATORS[operator], value))
+
+            def keys_only(self):
+                pass
+
+            def fetch(self, limit=None, timeout=None):
+                client.timeouts.append(timeout)
+                return [entity for key, entity in client.entities.items() if key[0] == kind
+                        and all(operator(entity.get(name), value)
+                                for name, operator, value in self.filters)][:limit]
+        return Query()
+
+    def delete_multi(self, keys, timeout=None):
+        self.timeouts.append(timeout)
+        self.deletes.append(len(keys))
+        for key in keys:
+            self.entities.pop(key, None)
+
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class CompressionTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = 0
+        self.body = {'evaluations': [{'long_description': 'Bednets. ' * 500}]}
+
+        @datastore_cache()
+        def evaluations(request):
+            self.calls += 1
+            return JsonResponse(self.body)
+        self.view = evaluations
+        get_writer().flush()
+        get_backend().clear()
+
+    def get(self, accept_encoding=None):
+        headers = {'HTTP_ACCEPT_ENCODING': accept_encoding} if accept_encoding else {}
+        return self.view(RequestFactory().get('/api/evaluations', **headers))
+
+    def test_negotiation(self):
+        def negotiate(header, available=('gzip', 'br')):
+            return negotiate_encoding(
+                RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header), available)
+        self.assertEqual(negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(negotiate('gzip, br;q=0'), 'gzip')
+        self.assertEqual(negotiate('GZIP;q=0.5'), 'gzip')
+        self.assertEqual(negotiate('*'), 'br')
+        self.assertEqual(negotiate('gzip;q=0, *'), 'br')
+        self.assertEqual(negotiate('br;q=0, *'), 'gzip')
+        self.assertEqual(negotiate('gzip, *;q=0'), 'gzip')
+        self.assertEqual(negotiate('*', available=('gzip',)), 'gzip')
+        self.assertEqual(negotiate('gzip;q=0, *', available=('gzip',)), 'identity')
+        self.assertEqual(negotiate('gzip;q=0'), 'identity')
+        self.assertEqual(negotiate('br', available=('gzip',)), 'identity')
+
+    def test_variants_are_compressed_once_and_served_per_encoding(self):
+        miss = self.get('gzip')
+        self.assertEqual(miss['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(miss.content)), self.body)
+        self.assertIn('Accept-Encoding', miss['Vary'])
+        get_writer().flush()
+
+        identity = self.get()
+        self.assertNotIn('Content-Encoding', identity)
+        self.assertEqual(json.loads(identity.content), self.body)
+        self.assertEqual(self.calls, 1)
+        self.assertLess(len(miss.content) * 10, len(identity.content))
+
+    def test_the_views_own_response_is_served_on_a_miss(self):
+        @datastore_cache()
+        def evaluations(request):
+            self.calls += 1
+            response = JsonResponse(self.body, status=404 if 'missing' in request.GET else 200)
+            response['Content-Language'] = 'nb'
+            return response
+        miss = evaluations(RequestFactory().get('/api/evaluations', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(miss['Content-Language'], 'nb')
+        self.assertEqual(miss['Content-Encoding'], 'gzip')
+        self.assertEqual(miss['Content-Length'], str(len(miss.content)))
+        self.assertEqual(json.loads(gzip.decompress(miss.content)), self.body)
+
+        # Only 200s are cached, as entries don't keep the status
+        for _ in range(2):
+            response = evaluations(RequestFactory().get('/api/evaluations?missing'))
+            get_writer().flush()
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.calls, 3)
+
+    @skipIf(brotli is None, 'Brotli is not installed')
+    def test_brotli_variant(self):
+        response = self.get('gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.content)), self.body)
+
+@freeze_time("2022-08-23")
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        create_allotment(create_grant('max_impact_fund_grant'))
+        create_allotment(create_grant('all_grants_fund_grant'), charity=Charity.objects.first(),
+                         intervention=Intervention.objects.first())
+        create_evaluation(charity=Charity.objects.first(),
+                          intervention=Intervention.objects.first())
+
+    def test_async_views_match_sync_views(self):
+        for name in ('evaluations', 'max_impact_fund_grants', 'all_grants_fund_grants'):
+            async_view = getattr(async_views, name)
+            self.assertTrue(asyncio.iscoroutinefunction(async_view))
+            get_backend().entries.clear()
+            expected = getattr(views, name)(RequestFactory().get(f'/api/{name}?currency=EUR'))
+            get_writer().flush()
+            get_backend().entries.clear()
+            response = async_to_sync(async_view)(
+                AsyncRequestFactory().get(f'/api/{name}?currency=EUR'))
+            self.assertEqual(response.content, expected.content)
+            self.assertEqual(response['ETag'], expected['ETag'])
+
+    def test_async_views_share_the_sync_cache(self):
+        views.evaluations(RequestFactory().get('/api/evaluations?currency=EUR'))
+        get_writer().flush()
+        with mock.patch.object(views, '_construct_response') as construct_response:
+            response = async_to_sync(async_views.evaluations)(
+                AsyncRequestFactory().get('/api/evaluations?currency=EUR'))
+        construct_response.assert_not_called()
+        self.assertEqual(json.loads(response.content)['evaluations'][0]['currency'], 'EUR')
+
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class CacheWriterTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.backend = InMemoryBackend()
+        self.writer = CacheWriter(queue_size=2, batch_size=25, max_batch_bytes=1024 * 1024)
+
+    def submit(self, key, version=None):
+        entry = {'response': '{"evaluations": []}', 'view_name': 'evaluations'}
+        return self.writer.submit(self.backend, key, entry,
+                                  version or data_version('evaluations'))
+
+    def test_misses_are_written_in_the_background_with_every_variant(self):
+        calls = []
+
+        @datastore_cache()
+        def evaluations(request):
+            calls.append(request)
+            return JsonResponse({'evaluations': []})
+
+        evaluations(RequestFactory().get('/api/evaluations', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertTrue(get_writer().flush(timeout=5))
+        entries = get_backend().entries
+        self.assertEqual(len(entries), 1)
+        entry = next(iter(entries.values()))
+        self.assertIn('response_gzip', entry)
+        if brotli is not None:
+            self.assertIn('response_br', entry)
+        evaluations(RequestFactory().get('/api/evaluations'))
+        self.assertEqual(len(calls), 1)
+
+    def test_queued_entries_are_written_in_one_batch(self):
+        writing, blocker = threading.Event(), threading.Event()
+
+        def set_many(entries):
+            writing.set()
+            blocker.wait(5)
+        with mock.patch.object(self.backend, 'set_many', side_effect=set_many):
+            self.submit('first')
+            self.assertTrue(writing.wait(5))
+            self.submit('a')
+            self.submit('b')
+            self.assertFalse(self.submit('c'))
+            blocker.set()
+            self.assertTrue(self.writer.flush(timeout=5))
+        self.assertEqual(metrics.counter('cache_writes_dropped', reason='queue_full'), 1)
+        self.assertEqual(metrics.counter('cache_write_batches'), 2)
+        self.assertEqual(metrics.counter('cache_writes'), 3)
+
+    def test_entries_computed_before_a_data_change_are_dropped(self):
+        version = data_version('evaluations')
+        bump_data_version('evaluations')
+        self.submit('stale', version)
+        self.assertTrue(self.writer.flush(timeout=5))
+        self.assertEqual(self.backend.entries, {})
+        self.assertEqual(metrics.counter('cache_writes_dropped', reason='stale'), 1)
+
+    def test_clearing_doesnt_wait_on_a_write(self):
+        writing, blocker = threading.Event(), threading.Event()
+        set_many = self.backend.set_many
+
+        def slow_set_many(entries):
+            writing.set()
+            blocker.wait(5)
+            set_many(entries)
+        with mock.patch.object(self.backend, 'set_many', side_effect=slow_set_many):
+            self.submit('a')
+            self.assertTrue(writing.wait(5))
+            clearing = threading.Thread(target=clear_cache, args=['evaluations'])
+            clearing.start()
+            clearing.join(5)
+            self.assertFalse(clearing.is_alive())
+            blocker.set()
+            self.assertTrue(self.writer.flush(timeout=5))
+        # It landed after the clear, but as older than the data
+        self.assertLess(self.backend.entries['a']['data_changed_at'], changed_at('evaluations'))
+        self.assertEqual(metrics.counter('cache_writes_superseded'), 1)
+
+    def test_failed_writes_are_logged_and_counted(self):
+        with mock.patch.object(self.backend, 'set_many', side_effect=OSError):
+            with self.assertLogs('api.cache_writer', 'ERROR'):
+                self.submit('a')
+                self.assertTrue(self.writer.flush(timeout=5))
+        self.assertEqual(metrics.counter('cache_write_failures'), 1)
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'api-tests'}})
+class CacheBackendTests(SimpleTestCase):
+    def entry(self, view_name, response='[]'):
+        return {'response': response, 'response_gzip': gzip.compress(response.encode()),
+                'surrogate_key': view_name, 'expires': time.time() + 60,
+                'created_at': time.time(), 'view_name': view_name}
+
+    def backends(self):
+        datastore_client = FakeDatastoreClient()
+        patcher = mock.patch.object(api.cache_backends, 'get_client', return_value=datastore_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return [DatastoreBackend(), DjangoCacheBackend(), InMemoryBackend()]
+
+    def test_backends_store_and_clear_by_view(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                evaluation = self.entry('evaluations', '{"evaluations": []}')
+                grant = self.entry('max_impact_fund_grants')
+                backend.set_many({'a': evaluation, 'b': grant})
+                self.assertEqual(backend.get('evaluations', 'a'), evaluation)
+                self.assertIsNone(backend.get('evaluations', 'missing'))
+
+                backend.clear('evaluations')
+                self.assertIsNone(backend.get('evaluations', 'a'))
+                self.assertEqual(backend.get('max_impact_fund_grants', 'b'), grant)
+
+                backend.set_many({'a': evaluation})
+                backend.clear()
+                self.assertIsNone(backend.get('evaluations', 'a'))
+                self.assertIsNone(backend.get('max_impact_fund_grants', 'b'))
+
+    def test_django_cache_generations_never_expire(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with self.settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': directory.name}}):
+            backend = DjangoCacheBackend()
+            for _ in range(2):
+                backend.clear('evaluations')
+                backend.clear()
+            for name in backend._generation_keys('evaluations'):
+                self.assertEqual(caches['default'].get(name), 2)
+                # The file cache's entries start with their expiry time
+                with open(caches['default']._key_to_file(name), 'rb') as entry:
+                    self.assertIsNone(pickle.load(entry))
+
+    def test_backends_prune_expired_entries(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                expired = self.entry('evaluations')
+                expired['expires'] = time.time() - 1
+                current = self.entry('evaluations')
+                backend.set_many({'a': expired, 'b': current})
+                pruned = backend.prune(time.time())
+                if isinstance(backend, DjangoCacheBackend):
+                    self.assertIsNone(pruned)
+                    continue
+                self.assertEqual(pruned, 1)
+                self.assertIsNone(backend.get('evaluations', 'a'))
+                self.assertEqual(backend.get('evaluations', 'b'), current)
+
+    def test_backends_store_versions(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.set_version('evaluations', 1.5)
+                backend.set_version('*', 2.5)
+                self.assertEqual(backend.get_versions(['evaluations', '*', 'other']),
+                                 {'evaluations': 1.5, '*': 2.5})
+
+    def test_datastore_compresses_and_chunks_large_entries(self):
+        backend = self.backends()[0]
+        backend.max_entity_bytes = 3000
+        client = api.cache_backends.get_client()
+        small = self.entry('evaluations', '{"evaluations": []}')
+        # Compresses to below the limit
+        repetitive = self.entry('evaluations', json.dumps({'evaluations': ['robots'] * 1000}))
+        # Random enough that it doesn't
+        rng = random.Random(0)
+        noisy = self.entry('max_impact_fund_grants', json.dumps(
+            {'max_impact_fund_grants': [rng.random() for _ in range(1000)]}))
+        backend.set_many({'small': small, 'repetitive': repetitive, 'noisy': noisy})
+
+        self.assertIn('response', client.entities[FakeKey('APICache', 'small')])
+        self.assertNotIn('response', client.entities[FakeKey('APICache', 'repetitive')])
+        self.assertIn('chunks', client.entities[FakeKey('APICache', 'noisy')])
+        self.assertTrue(all(len(chunk['data']) < 3000 for key, chunk in client.entities.items()
+                            if key.kind == 'APICacheChunk'))
+        for key, entry in (('small', small), ('repetitive', repetitive), ('noisy', noisy)):
+            self.assertEqual(backend.get(entry['view_name'], key), entry)
+
+        # Overwriting leaves the old chunks to expire; clearing deletes them too
+        backend.set_many({'noisy': noisy})
+        self.assertEqual(backend.get('max_impact_fund_grants', 'noisy'), noisy)
+        self.assertEqual(backend.clear('max_impact_fund_grants'), 1)
+        self.assertEqual([key.name for key in client.entities], ['small', 'repetitive'])
+
+    def test_datastore_entry_missing_a_chunk_is_a_miss(self):
+        backend = self.backends()[0]
+        backend.max_entity_bytes = 3000
+        client = api.cache_backends.get_client()
+        rng = random.Random(0)
+        backend.set_many({'noisy': self.entry('evaluations', json.dumps(
+            [rng.random() for _ in range(1000)]))})
+        chunk_key = next(key for key in client.entities if key.kind == 'APICacheChunk')
+        del client.entities[chunk_key]
+        self.assertIsNone(backend.get('evaluations', 'noisy'))
+
+    def test_datastore_prunes_and_clears_in_batches(self):
+        backend = self.backends()[0]
+        client = api.cache_backends.get_client()
+        expired = self.entry('evaluations')
+        expired['expires'] = time.time() - 1
+        backend.set_many({str(number): expired for number in range(7)})
+        self.assertEqual(backend.prune(time.time(), batch_size=3), 7)
+        self.assertEqual(client.deletes, [3, 3, 1])
+
+        client.deletes.clear()
+        backend.set_many({str(number): self.entry('evaluations') for number in range(1201)})
+        self.assertEqual(backend.clear(), 1201)
+        self.assertEqual(client.deletes, [500, 500, 201])
+        self.assertEqual(set(client.timeouts), {backend.timeout})
+
+    @override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+    def test_prune_command(self):
+        expired = self.entry('evaluations')
+        expired['expires'] = time.time() - 1
+        get_backend().set_many({'a': expired, 'b': self.entry('evaluations')})
+        output = io.StringIO()
+        # Tombstones are pruned too, in ChangesTests
+        with mock.patch('api.management.commands.prune_api_cache.prune_tombstones',
+                        return_value=0):
+            call_command('prune_api_cache', stdout=output)
+        self.assertIn('Deleted 1 expired entries', output.getvalue())
+        self.assertEqual(list(get_backend().entries), ['b'])
+
+    @override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+    def test_sweeper_prunes_periodically(self):
+        metrics.reset()
+        expired = self.entry('evaluations')
+        expired['expires'] = time.time() - 1
+        get_backend().set_many({'a': expired})
+        sweeper = CacheSweeper(interval=0.01, batch_size=500)
+        sweeper.start()
+        try:
+            for _ in range(500):
+                if not get_backend().entries:
+                    break
+                time.sleep(0.01)
+        finally:
+            sweeper.stop()
+        self.assertEqual(get_backend().entries, {})
+        self.assertEqual(metrics.counter('cache_entries_pruned', tier='memory'), 1)
+
+    def test_backend_is_chosen_in_settings(self):
+        with self.settings(API_CACHE_BACKEND=IN_MEMORY_CACHE):
+            self.assertIsInstance(get_backend(), InMemoryBackend)
+            self.assertIs(get_backend(), get_backend())
+        with self.settings(API_CACHE_BACKEND={
+                'BACKEND': 'api.cache_backends.DjangoCacheBackend', 'KEY_PREFIX': 'other'}):
+            self.assertEqual(get_backend().prefix, 'other')
+
+class InvalidationTests(TestCase):
+    def setUp(self):
+        clear_patcher = mock.patch.object(invalidation, 'clear_cache')
+        purge_patcher = mock.patch.object(invalidation, 'purge_edge_cache')
+        self.clear_cache = clear_patcher.start()
+        self.purge_edge_cache = purge_patcher.start()
+        self.addCleanup(clear_patcher.stop)
+        self.addCleanup(purge_patcher.stop)
+        self.charity = create_charity()
+        self.intervention = create_intervention()
+        invalidation.flush()
+        self.clear_cache.reset_mock()
+        self.purge_edge_cache.reset_mock()
+        metrics.reset()
+
+    def test_nothing_is_cleared_before_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_evaluation(charity=self.charity, intervention=self.intervention)
+            self.clear_cache.assert_not_called()
+        self.clear_cache.assert_called_once_with('evaluations')
+        self.purge_edge_cache.assert_called_once_with(['evaluations'])
+
+    def test_bulk_changes_clear_each_view_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            grant = create_grant()
+            for _ in range(5):
+                create_allotment(grant, charity=self.charity, intervention=self.intervention)
+            for year in range(2010, 2015):
+                create_evaluation(start_year=year, charity=self.charity,
+                                  intervention=self.intervention)
+            Evaluation.objects.all().delete()
+        self.assertEqual(self.clear_cache.call_args_list,
+                         [mock.call('evaluations'), mock.call('max_impact_fund_grants')])
+        self.purge_edge_cache.assert_called_once_with(
+            ['max_impact_fund_grants', f'max_impact_fund_grants-{grant.id}', 'evaluations'])
+        self.assertEqual(metrics.counter('invalidation_flushes'), 1)
+
+    def test_moving_an_allotment_clears_both_grants(self):
+        old_grant, new_grant = create_grant(), create_grant('all_grants_fund_grant')
+        allotment = create_allotment(old_grant, charity=self.charity,
+                                     intervention=self.intervention)
+        invalidation.flush()
+        self.clear_cache.reset_mock()
+        self.purge_edge_cache.reset_mock()
+        # As the admin does, from a fresh copy
+        allotment = Allotment.objects.get(id=allotment.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            allotment.max_impact_fund_grant = None
+            allotment.all_grants_fund_grant = new_grant
+            allotment.save()
+        self.assertEqual(self.clear_cache.call_args_list,
+                         [mock.call('all_grants_fund_grants'), mock.call('max_impact_fund_grants')])
+        self.purge_edge_cache.assert_called_once_with(
+            [f'max_impact_fund_grants-{old_grant.id}', f'all_grants_fund_grants-{new_grant.id}'])
+
+    def test_clearing_everything_subsumes_single_views(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_evaluation(charity=self.charity, intervention=self.intervention)
+            create_charity('Impossible Meat', 'IM')
+        self.clear_cache.assert_called_once_with()
+
+    def test_rolled_back_invalidations_wait_for_the_next_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    create_evaluation(charity=self.charity, intervention=self.intervention)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+        with self.captureOnCommitCallbacks(execute=True):
+            create_grant()
+        self.assertEqual(self.clear_cache.call_args_list,
+                         [mock.call('evaluations'), mock.call('max_impact_fund_grants')])
+
+    def test_failed_clear_is_logged_not_raised(self):
+        self.clear_cache.side_effect = RuntimeError('Datastore is down')
+        with self.assertLogs('api.invalidation', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                create_grant()
+        self.assertEqual(metrics.counter('invalidation_failures'), 1)
+        self.purge_edge_cache.assert_called_once_with(['max_impact_fund_grants'])
+
+    @override_settings(API_INVALIDATION_BACKGROUND=True)
+    def test_invalidation_can_run_in_the_background(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_grant()
+        invalidation._get_executor().submit(lambda: None).result(timeout=5)
+        self.clear_cache.assert_called_once_with('max_impact_fund_grants')
+
+@freeze_time("2022-08-23")
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class ReadModelTests(TestCase):
+    QUERIES = [
+        '', '?start_year=2012', '?end_year=2013&end_month=6', '?start_month=3&end_month=9',
+        '?donation_year=2013&donation_month=5', '?donation_year=2011&donation_month=1',
+        '?donation_year=2000', '?charity_abbreviation=im', '?charity_abbreviation=zz',
+        '?charity_abbreviation=sn&charity_abbreviation=IM&donation_year=2014',
+        '?language=no&currency=EUR', '?language=dk&currency=DKK',
+        '?conversion_year=2015&currency=gbp', '?start_year=2030',
+    ]
+
+    def setUp(self):
+        skynet = create_charity()
+        impossible = create_charity('Impossible Meat', 'IM')
+        robots = create_intervention()
+        media = create_intervention('Media training', 'Talking to the dead',
+                                    short_description_no='Medietrening', long_description_no='')
+        for year, month, charity, intervention in (
+                (2010, 12, skynet, robots), (2012, 6, skynet, media), (2013, 3, skynet, robots),
+                (2011, 6, impossible, media), (2014, 9, impossible, robots)):
+            create_evaluation(start_year=year, start_month=month, charity=charity,
+                              intervention=intervention, cents_per_output=year)
+        for grant_type in ('max_impact_fund_grant', 'all_grants_fund_grant'):
+            for year, month in ((2012, 3), (2013, 11), (2015, 6)):
+                grant = create_grant(grant_type, start_year=year, start_month=month)
+                for charity, intervention in ((skynet, robots), (impossible, media)):
+                    create_allotment(grant, charity=charity, intervention=intervention,
+                                     sum_in_cents=year * month,
+                                     number_outputs_purchased_upper_bound=9 ** 9)
+            create_grant(grant_type, start_year=2016, start_month=1)
+
+    def get(self, url, read_model):
+        get_writer().flush()
+        get_backend().clear()
+        with self.settings(API_READ_MODEL=read_model):
+            return self.client.get(url)
+
+    def test_responses_match_the_orm(self):
+        for view_name in ('evaluations', 'max_impact_fund_grants', 'all_grants_fund_grants'):
+            for query in self.QUERIES:
+                with self.subTest(view=view_name, query=query):
+                    url = reverse(view_name) + query
+                    from_orm = self.get(url, read_model=False)
+                    from_snapshot = self.get(url, read_model=True)
+                    self.assertEqual(from_snapshot.status_code, from_orm.status_code)
+                    self.assertEqual(from_snapshot.content, from_orm.content)
+                    self.assertEqual(from_snapshot['Surrogate-Key'], from_orm['Surrogate-Key'])
+
+    def test_snapshot_needs_no_queries_until_the_data_changes(self):
+        metrics.reset()
+        self.get(reverse('evaluations'), read_model=True)
+        snapshot = read_model.get_snapshot()
+        with self.assertNumQueries(0):
+            self.get(reverse('max_impact_fund_grants'), read_model=True)
+            self.assertIs(read_model.get_snapshot(), snapshot)
+        self.assertEqual(metrics.counter('read_model_builds'), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_evaluation(start_year=2016, charity=Charity.objects.first(),
+                              intervention=Intervention.objects.first())
+        evaluations = json.loads(self.get(
+            reverse('evaluations') + '?start_year=2016', read_model=True).content)['evaluations']
+        self.assertEqual(len(evaluations), 1)
+        self.assertIsNot(read_model.get_snapshot(), snapshot)
+        self.assertEqual(read_model.get_snapshot().versions[0], data_version('evaluations'))
+
+@freeze_time("2022-08-23")
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class SparseFieldsTests(TestCase):
+    FIELDS = {
+        'evaluations': [
+            'converted_cost_per_output,currency,charity.abbreviation',
+            'charity,intervention.short_description,start_year',
+            'id',
+        ],
+        'max_impact_fund_grants': [
+            'start_year,allotment_set.converted_sum,allotment_set.charity.abbreviation',
+            'allotment_set,language',
+            'start_year',
+        ],
+    }
+
+    def setUp(self):
+        skynet = create_charity()
+        robots = create_intervention()
+        for year in (2010, 2012):
+            create_evaluation(start_year=year, charity=skynet, intervention=robots)
+        for grant_type in ('max_impact_fund_grant', 'all_grants_fund_grant'):
+            for year in (2012, 2013):
+                grant = create_grant(grant_type, start_year=year)
+                create_allotment(grant, charity=skynet, intervention=robots)
+
+    def get(self, url, read_model):
+        get_writer().flush()
+        get_backend().clear()
+        with self.settings(API_READ_MODEL=read_model):
+            return self.client.get(url)
+
+    def test_fields_match_the_serializers(self):
+        for view_name, fields in sparse_fields.FIELDS.items():
+            with self.subTest(view=view_name):
+                record = json.loads(self.get(reverse(view_name), read_model=False).content)[
+                    view_name][0]
+                self.assertEqual(list(record), list(fields))
+                for name, nested_fields in fields.items():
+                    if nested_fields is not None:
+                        nested = record[name][0] if isinstance(record[name], list) else record[name]
+                        self.assertEqual(list(nested), list(nested_fields))
+
+    def test_responses_have_only_the_fields_asked_for(self):
+        for view_name, field_lists in self.FIELDS.items():
+            for query in ('', '?donation_year=2013', '?language=no&currency=EUR'):
+                full = json.loads(self.get(reverse(view_name) + query, read_model=False).content)
+                for fields in field_lists:
+                    for read_model_enabled in (False, True):
+                        with self.subTest(view=view_name, query=query, fields=fields,
+                                          read_model=read_model_enabled):
+                            url = reverse(view_name) + (query or '?') + f'&fields={fields}'
+                            response = json.loads(self.get(url, read_model_enabled).content)
+                            wanted = sparse_fields.parse([fields], view_name)
+                            self.assertEqual(response[view_name], [
+                                sparse_fields.select(record, wanted)
+                                for record in full[view_name]])
+        # Each record keeps its id
+        self.assertEqual(response[view_name][0], {'id': response[view_name][0]['id'],
+                                                  'start_year': 2012})
+
+    def test_the_snapshot_is_not_changed(self):
+        url = reverse('evaluations')
+        full = self.get(url, read_model=True).content
+        self.get(url + '?fields=charity.id,intervention.id', read_model=True)
+        self.assertEqual(self.get(url, read_model=True).content, full)
+
+    def test_only_the_columns_needed_are_read(self):
+        for view_name, fields, table in (
+                ('evaluations', 'converted_cost_per_output', 'api_evaluation'),
+                ('max_impact_fund_grants', 'allotment_set.converted_sum', 'api_allotment')):
+            with self.subTest(view=view_name), \
+                    CaptureQueriesContext(connections['default']) as queries:
+                self.get(reverse(view_name) + f'?fields={fields}', read_model=False)
+            sql = ' '.join(query['sql'] for query in queries)
+            for column in (f'"{table}"."comment"', f'"{table}"."source_url"',
+                           '"api_charity"."charity_name"'):
+                self.assertNotIn(column, sql)
+        # The allotments are read in one query
+        self.assertEqual(len(queries), 2)
+
+    def test_fields_are_normalized(self):
+        requests = [RequestFactory().get(reverse('evaluations'), {'fields': fields}) for fields in (
+            'currency, charity.abbreviation,id', ['charity.abbreviation', 'currency'],
+            'charity.abbreviation,currency,currency')]
+        for request in requests:
+            self.assertIsNone(QueriesMiddleware(lambda request: None).process_view(
+                request, views.evaluations, (), {}))
+            self.assertEqual(request.GET['fields'], 'charity.abbreviation,currency,id')
+        # Naming a whole record takes in any of its fields
+        request = RequestFactory().get(reverse('evaluations'),
+                                       {'fields': 'charity.abbreviation,charity'})
+        QueriesMiddleware(lambda request: None).process_view(request, views.evaluations, (), {})
+        self.assertEqual(request.GET['fields'], 'charity,id')
+        request = RequestFactory().get(reverse('evaluations'), {'fields': ''})
+        QueriesMiddleware(lambda request: None).process_view(request, views.evaluations, (), {})
+        self.assertNotIn('fields', request.GET)
+
+    def test_unknown_fields_error(self):
+        for view_name, fields, unknown in (('evaluations', 'currency,cost', 'cost'),
+                                           ('evaluations', 'charity.cost', 'charity.cost'),
+                                           ('evaluations', 'currency.code', 'currency.code'),
+                                           ('max_impact_fund_grants', 'charity', 'charity')):
+            with self.subTest(view=view_name, fields=fields):
+                content = json.loads(self.client.get(
+                    reverse(view_name) + f'?fields={fields}').content)
+                self.assertEqual(content['errors'], [f'Field {unknown} not supported'])
+
+    def test_grants_keep_their_surrogate_keys(self):
+        for read_model_enabled in (False, True):
+            with self.subTest(read_model=read_model_enabled):
+                response = self.get(reverse('max_impact_fund_grants') + '?fields=start_year',
+                                    read_model_enabled)
+                self.assertEqual(response['Surrogate-Key'], ' '.join(
+                    ['max_impact_fund_grants'] + [
+                        f'max_impact_fund_grants-{grant.id}'
+                        for grant in MaxImpactFundGrant.objects.order_by('id')]))
+
+def add_database(test, alias, name):
+    '''Configure a SQLite database for the rest of the test, which the test
+    runner won't have set up or guarded'''
+    connections.settings[alias] = connections.configure_settings({
+        'default': dict(connections.settings['default']),
+        alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name},
+    })[alias]
+    test.addCleanup(connections.settings.pop, alias)
+    test.addCleanup(connections.__delitem__, alias)
+    test.addCleanup(lambda: connections[alias].close())
+
+@skipIf(read_snapshot.ALIAS in settings.DATABASES,
+        'Configures its own read snapshot, and settings.py has configured one already')
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class ReadSnapshotTests(TestCase):
+    def setUp(self):
+        skynet = create_charity()
+        robots = create_intervention()
+        for year in (2010, 2012):
+            create_evaluation(start_year=year, charity=skynet, intervention=robots)
+        grant = create_grant('max_impact_fund_grant', start_year=2012)
+        create_allotment(grant, charity=skynet, intervention=robots)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'read_snapshot.sqlite3')
+        call_command('export_read_snapshot', output=self.path, stdout=io.StringIO())
+
+    def use_snapshot(self):
+        '''Configure the read_snapshot database as settings.py does when the file exists'''
+        add_database(self, read_snapshot.ALIAS, f'file:{self.path}?mode=ro&immutable=1')
+        override = override_settings(API_READ_SNAPSHOT=self.path)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get(self, url, read_model):
+        get_writer().flush()
+        get_backend().clear()
+        with self.settings(API_READ_MODEL=read_model):
+            return self.client.get(url)
+
+    def get_from_snapshot(self, url, read_model):
+        '''The response, and whether it read the data from the snapshot and from MySQL'''
+        with CaptureQueriesContext(connections[read_snapshot.ALIAS]) as snapshot_queries, \
+                CaptureQueriesContext(connections['default']) as default_queries:
+            response = self.get(url, read_model)
+        return response, *(any('api_evaluation' in query['sql'] for query in queries)
+                           for queries in (snapshot_queries, default_queries))
+
+    def test_export_writes_the_public_tables(self):
+        self.assertFalse(os.stat(self.path).st_mode & 0o222)
+        snapshot = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        self.addCleanup(snapshot.close)
+        tables = {name for name, in snapshot.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")}
+        self.assertEqual(tables, {model._meta.db_table for model in read_snapshot.MODELS}
+                         | {read_snapshot.META_TABLE})
+        self.assertEqual(snapshot.execute('SELECT COUNT(*) FROM api_evaluation').fetchone(), (2,))
+        self.assertEqual(snapshot.execute('SELECT COUNT(*) FROM api_allotment').fetchone(), (1,))
+        self.assertIn(('snapshot_evaluation_date',), snapshot.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'").fetchall())
+
+    def test_api_reads_come_from_the_snapshot(self):
+        url = reverse('evaluations') + '?start_year=2011'
+        expected = {read_model_enabled: self.get(url, read_model_enabled).content
+                    for read_model_enabled in (False, True)}
+        self.use_snapshot()
+        for read_model_enabled in (False, True):
+            with self.subTest(read_model=read_model_enabled), \
+                    mock.patch.object(read_model, '_snapshot', None):
+                response, from_snapshot, from_default = self.get_from_snapshot(
+                    url, read_model_enabled)
+                self.assertEqual(response.content, expected[read_model_enabled])
+                self.assertTrue(from_snapshot)
+                self.assertFalse(from_default)
+        self.assertEqual(connections[read_snapshot.ALIAS].cursor().execute(
+            'PRAGMA mmap_size').fetchone(), (read_snapshot.MMAP_BYTES,))
+        # The admin's reads stay on MySQL
+        self.assertEqual(Evaluation.objects.db, 'default')
+
+    def test_changes_after_the_export_send_reads_back_to_mysql(self):
+        self.use_snapshot()
+        self.assertTrue(self.get_from_snapshot(reverse('evaluations'), read_model=False)[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            create_evaluation(start_year=2014, charity=Charity.objects.get(),
+                              intervention=Intervention.objects.get())
+        for read_model_enabled in (False, True):
+            response, from_snapshot, from_default = self.get_from_snapshot(
+                reverse('evaluations') + '?start_year=2014', read_model_enabled)
+            self.assertEqual((from_snapshot, from_default), (False, True))
+            self.assertEqual(len(json.loads(response.content)['evaluations']), 1)
+        self.assertEqual(metrics.counter('read_snapshot_stale'), 1)
+
+    def test_snapshot_is_not_used_after_a_change_elsewhere(self):
+        get_backend().set_version('evaluations', time.time() + 1)
+        self.use_snapshot()
+        _, from_snapshot, from_default = self.get_from_snapshot(
+            reverse('evaluations'), read_model=False)
+        self.assertEqual((from_snapshot, from_default), (False, True))
+
+@skipIf(settings.API_DB_REPLICA['ALIAS'] in settings.DATABASES,
+        'Configures its own replica, and settings.py has configured one already')
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class ReplicaTests(TestCase):
+    def setUp(self):
+        skynet = create_charity()
+        robots = create_intervention()
+        create_evaluation(start_year=2010, charity=skynet, intervention=robots)
+        # The replica is a second SQLite file, which never catches up with the
+        # primary after this
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'replica.sqlite3')
+        read_snapshot.export(path)
+        os.chmod(path, 0o644)
+        add_database(self, 'replica', path)
+        create_evaluation(start_year=2012, charity=skynet, intervention=robots)
+
+    def evaluations(self, client=None, read_model_enabled=True):
+        '''How many evaluations the API returns, and whether it read the replica'''
+        get_writer().flush()
+        get_backend().clear()
+        with self.settings(API_READ_MODEL=read_model_enabled), \
+                mock.patch.object(read_model, '_snapshot', None), \
+                CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = (client or self.client).get(reverse('evaluations'))
+        return len(json.loads(response.content)['evaluations']), bool(replica_queries)
+
+    def test_api_reads_go_to_the_replica(self):
+        with self.settings(API_DB_REPLICA={'ALIAS': 'replica', 'STICKY_SECONDS': 0}):
+            self.assertEqual(self.evaluations(read_model_enabled=False), (1, True))
+        # Everything else reads the primary
+        self.assertEqual(Evaluation.objects.count(), 2)
+
+    def test_the_read_model_is_built_from_the_primary(self):
+        # Hearing of another instance's change only once the replica is taken
+        # to have caught up with it, which it may not have
+        with self.settings(API_DB_REPLICA={'ALIAS': 'replica', 'STICKY_SECONDS': 0}):
+            get_backend().set_version('evaluations', time.time())
+            sync_data_versions()
+            self.assertEqual(self.evaluations(), (2, False))
+
+    def test_admin_reads_its_writes(self):
+        self.client.force_login(User.objects.create_superuser('admin'))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/admin/api/charity/add/',
+                                        {'charity_name': 'Impossible Meat', 'abbreviation': 'im'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(replica.COOKIE_NAME, response.cookies)
+        # The admin's session reads the primary, and so, for a moment, does anyone
+        # else's on this instance, which knows of the change
+        self.assertEqual(self.evaluations(read_model_enabled=False), (2, False))
+        self.assertEqual(self.evaluations(Client(), read_model_enabled=False), (2, False))
+        # On an instance yet to hear of it, only the admin's session does
+        with mock.patch('api.cache.data_version', return_value=0.0):
+            self.assertEqual(self.evaluations(read_model_enabled=False), (2, False))
+            self.assertEqual(self.evaluations(Client(), read_model_enabled=False), (1, True))
+        with freeze_time(timedelta(seconds=settings.API_DB_REPLICA['STICKY_SECONDS'] + 1),
+                         tick=True):
+            self.assertEqual(self.evaluations(read_model_enabled=False), (1, True))
+
+    def test_other_requests_set_no_cookie(self):
+        self.client.force_login(User.objects.create_superuser('admin'))
+        self.assertNotIn(replica.COOKIE_NAME, self.client.get('/admin/').cookies)
+        self.assertNotIn(replica.COOKIE_NAME, self.client.get(reverse('evaluations')).cookies)
+
+class ChangesTests(TestCase):
+    def setUp(self):
+        with freeze_time('2022-08-23 12:00'):
+            self.charity = create_charity()
+            self.intervention = create_intervention()
+            self.evaluation = create_evaluation(
+                charity=self.charity, intervention=self.intervention)
+            self.grant = create_grant()
+            self.allotment = create_allotment(
+                self.grant, charity=self.charity, intervention=self.intervention)
+
+    def changes(self, since=None):
+        return json.loads(self.client.get(
+            reverse('changes'), {'since': since} if since else {}).content)
+
+    def ids(self, response):
+        return ({name: [record['id'] for record in records]
+                 for name, records in response['changes'].items()},
+                response['deletions'])
+
+    def test_without_a_token_every_record_is_returned(self):
+        with freeze_time('2022-08-23 12:10'):
+            response = self.changes()
+        self.assertEqual(self.ids(response)[0], {
+            'charities': [self.charity.id], 'interventions': [self.intervention.id],
+            'evaluations': [self.evaluation.id], 'max_impact_fund_grants': [self.grant.id],
+            'all_grants_fund_grants': [], 'allotments': [self.allotment.id]})
+        evaluation = response['changes']['evaluations'][0]
+        self.assertEqual(evaluation['charity_id'], self.charity.id)
+        self.assertEqual(evaluation['updated_at'], '2022-08-23T12:00:00Z')
+
+    def test_a_token_returns_what_changed_since(self):
+        with freeze_time('2022-08-23 12:10'):
+            token = self.changes()['next']
+        with freeze_time('2022-08-23 12:20'):
+            self.evaluation.cents_per_output = 200
+            self.evaluation.save()
+            other_charity = create_charity('Impossible Meat', 'IM')
+            grant_id = self.grant.id
+            self.grant.delete()
+            response = self.changes(token)
+        changed, deleted = self.ids(response)
+        self.assertEqual(changed, {
+            'charities': [other_charity.id], 'interventions': [], 'evaluations': [
+                self.evaluation.id], 'max_impact_fund_grants': [], 'all_grants_fund_grants': [],
+            'allotments': []})
+        self.assertEqual(response['changes']['evaluations'][0]['cents_per_output'], 200)
+        # The grant's allotments went with it
+        self.assertEqual(deleted, {
+            'charities': [], 'interventions': [], 'evaluations': [],
+            'max_impact_fund_grants': [grant_id], 'all_grants_fund_grants': [],
+            'allotments': [self.allotment.id]})
+        self.assertEqual(Tombstone.objects.count(), 2)
+
+        # Once the overlap has passed, the changes aren't returned again
+        with freeze_time('2022-08-23 12:25'):
+            token = self.changes(response['next'])['next']
+        with freeze_time('2022-08-23 12:30'):
+            self.assertEqual(self.ids(self.changes(token)), (
+                {name: [] for name in deleted}, {name: [] for name in deleted}))
+
+    def test_tokens_overlap_to_cover_late_commits(self):
+        with freeze_time('2022-08-23 12:00:30'):
+            token = self.changes()['next']
+        # Saved (in a transaction yet to commit, say) before the response
+        with freeze_time('2022-08-23 12:01'):
+            self.assertEqual(self.ids(self.changes(token))[0]['evaluations'],
+                             [self.evaluation.id])
+
+    @override_settings(API_CHANGES_RETENTION_DAYS=30)
+    def test_tokens_older_than_the_retention_resync(self):
+        with freeze_time('2022-08-23 12:10'):
+            token = self.changes()['next']
+        evaluation_id = self.evaluation.id
+        with freeze_time('2022-08-23 12:20'):
+            self.evaluation.delete()
+        with freeze_time('2022-09-22 12:00'):
+            response = self.changes(token)
+        self.assertFalse(response['resync'])
+        self.assertEqual(self.ids(response)[1]['evaluations'], [evaluation_id])
+
+        with freeze_time('2022-09-22 12:30'):
+            call_command('prune_api_cache', stdout=io.StringIO())
+            self.assertEqual(Tombstone.objects.count(), 0)
+            response = self.changes(token)
+        # Every record, for the mirror to drop the evaluation it still has
+        self.assertTrue(response['resync'])
+        self.assertEqual(self.ids(response)[0]['charities'], [self.charity.id])
+        self.assertEqual(self.ids(response)[0]['evaluations'], [])
+        with freeze_time('2022-09-22 12:40'):
+            self.assertFalse(self.changes(response['next'])['resync'])
+
+    def test_invalid_tokens_are_rejected(self):
+        for token in ('not a token', 'bm9wZQ'):
+            self.assertEqual(self.changes(token), {
+                'errors': ['since must be a token from a previous response']})
+
+class EventStreamTests(SimpleTestCase):
+    def setUp(self):
+        overridden = override_settings(
+            API_CACHE_BACKEND=IN_MEMORY_CACHE,
+            API_EVENTS={'HEARTBEAT_SECONDS': 10, 'RETRY_MILLISECONDS': 5000,
+                        'MAX_CONNECTIONS': 10})
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        metrics.reset()
+
+    def stream(self, body, headers=()):
+        '''Run body(next_message) against a stream, then disconnect'''
+        async def run():
+            received, sent = asyncio.Queue(), asyncio.Queue()
+            scope = {'type': 'http', 'method': 'GET', 'path': events.EVENTS_PATH,
+                     'headers': list(headers)}
+            stream = asyncio.ensure_future(events.stream_events(scope, received.get, sent.put))
+
+            async def next_message():
+                return await asyncio.wait_for(sent.get(), 2)
+            try:
+                return await body(next_message)
+            finally:
+                await received.put({'type': 'http.disconnect'})
+                await asyncio.wait_for(stream, 2)
+        return async_to_sync(run)()
+
+    async def start(self, next_message):
+        start = await next_message()
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertEqual((await next_message())['body'], b'retry: 5000\n\n')
+
+    def parse(self, message) -> dict:
+        fields = dict(line.split(': ', 1)
+                      for line in message['body'].decode().splitlines() if line)
+        self.assertEqual(fields['event'], 'change')
+        data = json.loads(fields['data'])
+        self.assertEqual(float(fields['id']), data['version'])
+        return data
+
+    def test_invalidations_are_announced(self):
+        async def body(next_message):
+            await self.start(next_message)
+            await sync_to_async(invalidation._invalidate)({'max_impact_fund_grants'}, [])
+            return self.parse(await next_message())
+        self.assertEqual(self.stream(body), {
+            'views': ['max_impact_fund_grants'],
+            'version': data_version('max_impact_fund_grants')})
+        self.assertEqual(metrics.counter('event_stream_events'), 1)
+        self.assertEqual(metrics.gauge('event_stream_connections'), 0)
+
+    def test_other_instances_changes_are_announced(self):
+        async def body(next_message):
+            await self.start(next_message)
+            get_backend().set_version('all_grants_fund_grants', time.time() + 1)
+            await sync_to_async(sync_data_versions)()
+            return self.parse(await next_message())['views']
+        self.assertEqual(self.stream(body), ['all_grants_fund_grants'])
+
+    def test_reconnecting_clients_get_what_they_missed(self):
+        # Another instance's change, made since the client's last event
+        last_seen = max(changed_at(view_name) for view_name in VIEW_NAMES)
+        get_backend().set_version('evaluations', last_seen + 1)
+        sync_data_versions()
+
+        async def body(next_message):
+            await self.start(next_message)
+            return self.parse(await next_message())
+        self.assertEqual(self.stream(body, [(b'last-event-id', repr(last_seen).encode())]), {
+            'views': ['evaluations'], 'version': data_version('evaluations')})
+
+    def test_reconnecting_to_a_newer_instance_is_no_change(self):
+        last_seen = max(changed_at(view_name) for view_name in VIEW_NAMES)
+
+        async def body(next_message):
+            await self.start(next_message)
+            return (await next_message())['body']
+        # Started since, and yet to learn the shared versions
+        with mock.patch('api.cache._base_version', time.time() + 60), \
+                mock.patch('api.cache._base_is_guess', True), \
+                mock.patch('api.cache._seeded', True), \
+                mock.patch.dict('api.cache._data_versions', clear=True), \
+                self.settings(API_EVENTS=dict(settings.API_EVENTS, HEARTBEAT_SECONDS=0.01)):
+            self.assertEqual(self.stream(body, [(b'last-event-id', repr(last_seen).encode())]),
+                             b': keepalive\n\n')
+
+    def test_idle_streams_get_a_heartbeat(self):
+        async def body(next_message):
+            await self.start(next_message)
+            return (await next_message())['body']
+        with self.settings(API_EVENTS=dict(settings.API_EVENTS, HEARTBEAT_SECONDS=0.01)):
+            self.assertEqual(self.stream(body), b': keepalive\n\n')
+
+    def test_streams_start_the_version_poller(self):
+        async def body(next_message):
+            await self.start(next_message)
+        with mock.patch('api.coherence.VersionPoller.start') as start, \
+                self.settings(API_DATA_VERSION_POLL_SECONDS=5):
+            self.stream(body)
+        start.assert_called_once_with()
+
+    def test_connections_beyond_the_limit_are_turned_away(self):
+        async def body(next_message):
+            return (await next_message())['status']
+        with self.settings(API_EVENTS=dict(settings.API_EVENTS, MAX_CONNECTIONS=0)):
+            self.assertEqual(self.stream(body), 503)
+
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class SeedDataVersionTests(TestCase):
+    '''A process that has just started, with no versions of its own yet'''
+    def setUp(self):
+        metrics.reset()
+        get_backend().versions.clear()
+        for patcher in (mock.patch('api.cache._base_version', time.time()),
+                        mock.patch('api.cache._base_is_guess', True),
+                        mock.patch('api.cache._seeded', False),
+                        mock.patch.dict('api.cache._data_versions', clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        @conditional_get
+        def evaluations(request):
+            return JsonResponse({'evaluations': []})
+        self.view = evaluations
+
+    def test_versions_are_the_shared_ones_rather_than_the_boot_time(self):
+        get_backend().set_version('*', 1661256000.0)
+        get_backend().set_version('evaluations', 1661256060.0)
+        get_backend().set_version('all_grants_fund_grants', 1661255000.0)
+        response = self.view(RequestFactory().get('/api/evaluations'))
+        self.assertEqual(response['Last-Modified'], 'Tue, 23 Aug 2022 12:01:00 GMT')
+        self.assertEqual(data_version('all_grants_fund_grants'), 1661256000.0)
+        self.assertEqual(changed_at('max_impact_fund_grants'), 1661256000.0)
+
+    def test_without_shared_versions_the_latest_change_is_recorded(self):
+        with freeze_time('2022-08-23 12:00:00'):
+            create_charity()
+        with freeze_time('2022-08-23 12:05:00'):
+            Tombstone.objects.create(model_name='charity', object_id=2)
+        response = self.view(RequestFactory().get('/api/evaluations'))
+        self.assertEqual(response['Last-Modified'], 'Tue, 23 Aug 2022 12:05:00 GMT')
+        self.assertEqual(get_backend().get_versions(['*']), {'*': 1661256300.0})
+
+    def test_versions_are_guessed_while_the_backend_is_down(self):
+        with mock.patch.object(get_backend(), 'get_versions', side_effect=OSError), \
+                self.assertLogs('api.cache', 'ERROR'):
+            self.assertGreater(data_version('evaluations'), time.time() - 60)
+        self.assertEqual(changed_at('evaluations'), 0)
+        self.assertEqual(metrics.counter('data_version_seed_failures'), 1)
+
+class CoherenceTests(SimpleTestCase):
+    '''Another instance's changes are simulated by writing to the shared backend,
+    as its bump_data_version would'''
+    def setUp(self):
+        overridden = override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        metrics.reset()
+        # As if seeded, whether or not an earlier test did
+        patcher = mock.patch('api.cache._seeded', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        bump_data_version()
+
+    def test_bumps_are_shared(self):
+        bump_data_version('evaluations')
+        self.assertEqual(get_backend().get_versions(['evaluations']),
+                         {'evaluations': data_version('evaluations')})
+        bump_data_version()
+        self.assertEqual(get_backend().get_versions(['*']), {'*': data_version('evaluations')})
+
+    def test_newer_versions_from_other_instances_are_adopted(self):
+        bump_data_version('evaluations')
+        bump_data_version('max_impact_fund_grants')
+        before = data_version('max_impact_fund_grants')
+        elsewhere = time.time() + 1
+        get_backend().set_version('evaluations', elsewhere)
+        get_backend().set_version('max_impact_fund_grants', before - 10)
+        sync_data_versions()
+        self.assertEqual(data_version('evaluations'), elsewhere)
+        self.assertEqual(data_version('max_impact_fund_grants'), before)
+        self.assertEqual(metrics.counter('data_versions_synced', view='evaluations'), 1)
+
+        everything = elsewhere + 1
+        get_backend().set_version('*', everything)
+        sync_data_versions()
+        self.assertEqual(data_version('evaluations'), everything)
+        self.assertEqual(data_version('all_grants_fund_grants'), everything)
+
+    def process(self, boot_time) -> contextlib.ExitStack:
+        '''Patch in a process started at boot_time, yet to seed its versions'''
+        stack = contextlib.ExitStack()
+        for patcher in (mock.patch('api.cache._base_version', boot_time),
+                        mock.patch('api.cache._base_is_guess', True),
+                        mock.patch('api.cache._seeded', False),
+                        mock.patch('api.cache._data_versions', {}),
+                        mock.patch('api.cache._known_views', set())):
+            stack.enter_context(patcher)
+        return stack
+
+    def test_processes_started_at_different_times_agree_on_etags(self):
+        @conditional_get
+        def evaluations(request):
+            return JsonResponse({'evaluations': []})
+        last_change = time.time() - 3600
+        get_backend().set_version('*', last_change)
+        with self.process(time.time() - 60):
+            etag = evaluations(RequestFactory().get('/api/evaluations'))['ETag']
+        with self.process(time.time()):
+            self.assertEqual(evaluations(RequestFactory().get('/api/evaluations'))['ETag'], etag)
+
+        # One that couldn't read the backend when it started comes round at its next poll
+        with self.process(time.time()):
+            with mock.patch.object(get_backend(), 'get_versions', side_effect=OSError), \
+                    self.assertLogs('api.cache', 'ERROR'):
+                self.assertNotEqual(
+                    evaluations(RequestFactory().get('/api/evaluations'))['ETag'], etag)
+            sync_data_versions()
+            self.assertEqual(evaluations(RequestFactory().get('/api/evaluations'))['ETag'], etag)
+            self.assertEqual(data_version('evaluations'), last_change)
+
+    def test_a_lost_version_of_every_view_is_recorded_again(self):
+        bump_data_version()
+        version = data_version('evaluations')
+        get_backend().versions.clear()
+        sync_data_versions()
+        self.assertEqual(get_backend().get_versions(['*']), {'*': version})
+        get_backend().set_version('*', version - 60)
+        sync_data_versions()
+        self.assertEqual(get_backend().get_versions(['*']), {'*': version})
+        self.assertEqual(data_version('evaluations'), version)
+
+    def test_etags_change_with_another_instances_edit(self):
+        @conditional_get
+        def evaluations(request):
+            return JsonResponse({'evaluations': []})
+        etag = evaluations(RequestFactory().get('/api/evaluations'))['ETag']
+        get_backend().set_version('evaluations', time.time() + 1)
+        sync_data_versions()
+        response = evaluations(RequestFactory().get('/api/evaluations', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+
+    def test_responses_from_before_another_instances_edit_are_not_served(self):
+        # This instance's (say, its read model's) idea of the data
+        served = {'evaluations': ['old']}
+
+        @datastore_cache()
+        def evaluations(request):
+            return JsonResponse(served)
+        evaluations(RequestFactory().get('/api/evaluations'))
+        self.assertTrue(get_writer().flush(timeout=5))
+
+        # Another instance commits an edit, clears the cache and shares its version
+        get_backend().clear('evaluations')
+        get_backend().set_version('evaluations', data_version('evaluations') + 1)
+        # Before this one polls, it writes back what it still has
+        evaluations(RequestFactory().get('/api/evaluations'))
+        self.assertTrue(get_writer().flush(timeout=5))
+
+        sync_data_versions()
+        served['evaluations'] = ['new']
+        response = evaluations(RequestFactory().get('/api/evaluations'))
+        self.assertEqual(json.loads(response.content), {'evaluations': ['new']})
+        self.assertEqual(
+            metrics.counter('cache_requests', view='evaluations', tier='memory', result='stale'),
+            1)
+
+    def test_poller_syncs_periodically(self):
+        elsewhere = data_version('evaluations') + 1
+        get_backend().set_version('evaluations', elsewhere)
+        poller = VersionPoller(interval=0.01)
+        poller.start()
+        try:
+            for _ in range(500):
+                if data_version('evaluations') == elsewhere:
+                    break
+                time.sleep(0.01)
+        finally:
+            poller.stop()
+        self.assertEqual(data_version('evaluations'), elsewhere)
+
+class FailingBackend(InMemoryBackend):
+    '''Fails every call once failing is set, or takes delay seconds over it'''
+    failing = False
+    delay = 0
+
+    def get(self, view_name, key):
+        time.sleep(self.delay)
+        if self.failing:
+            raise RuntimeError('Datastore is down')
+        return super().get(view_name, key)
+
+    def set_many(self, entries):
+        time.sleep(self.delay)
+        if self.failing:
+            raise RuntimeError('Datastore is down')
+        super().set_many(entries)
+
+    def clear(self, view_name=None):
+        if self.failing:
+            raise RuntimeError('Datastore is down')
+        return super().clear(view_name)
+
+    def prune(self, now, batch_size=None):
+        if self.failing:
+            raise RuntimeError('Datastore is down')
+        return super().prune(now, batch_size)
+
+CIRCUIT_BREAKER = {'FAILURE_THRESHOLD': 2, 'SLOW_CALL_SECONDS': 0.05, 'RESET_SECONDS': 60}
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        # Per test rather than per class, for a new backend and breakers each time
+        overridden = override_settings(
+            API_CACHE_BACKEND={'BACKEND': 'api.tests.FailingBackend'},
+            API_CACHE_CIRCUIT_BREAKER=CIRCUIT_BREAKER)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        # Every test changes state, which is logged
+        logs = self.assertLogs('api.circuit_breaker', 'WARNING')
+        logs.__enter__()
+        self.addCleanup(logs.__exit__, None, None, None)
+        metrics.reset()
+        self.calls = 0
+
+        @datastore_cache()
+        def evaluations(request):
+            self.calls += 1
+            return JsonResponse({'evaluations': []})
+        self.view = evaluations
+        self.backend = get_backend()
+
+    def get(self):
+        response = self.view(RequestFactory().get('/api/evaluations'))
+        get_writer().flush()
+        return response
+
+    def test_failing_backend_is_bypassed_then_probed(self):
+        self.backend.failing = True
+        with self.assertLogs('api', 'ERROR') as logs:
+            self.assertEqual(self.get().status_code, 200)
+        # The read failed, and then so did writing the response
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(metrics.counter(
+            'cache_requests', view='evaluations', tier='memory', result='error'), 1)
+        self.assertEqual(metrics.gauge('cache_circuit_state', tier='memory'), 1)
+
+        # Open: no calls to the backend at all, reads or writes
+        self.backend.failing = False
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(metrics.counter(
+            'cache_requests', view='evaluations', tier='memory', result='bypass'), 1)
+        self.assertEqual(self.backend.entries, {})
+        self.assertEqual(metrics.counter('cache_writes_dropped', reason='circuit_open'), 1)
+
+        # Once RESET_SECONDS have passed, a probe succeeds and closes it again
+        breaker = get_breaker('memory')
+        breaker.opened_at -= 60
+        self.get()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(metrics.gauge('cache_circuit_state', tier='memory'), 0)
+        self.get()
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(metrics.counter(
+            'cache_requests', view='evaluations', tier='memory', result='hit'), 1)
+        self.assertEqual(metrics.counter('cache_circuit_transitions', tier='memory',
+                                         state='half_open'), 1)
+
+    def test_slow_calls_open_the_circuit(self):
+        self.backend.delay = 0.06
+        self.get()
+        self.assertEqual(get_breaker('memory').state, 'open')
+
+    def test_failed_probe_reopens(self):
+        breaker = get_breaker('memory')
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            breaker.record(0, failed=True)
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        # Only one probe at a time
+        self.assertFalse(breaker.allow())
+        breaker.record(0, failed=True)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_failed_writes_count_too(self):
+        self.backend.failing = True
+        writer = CacheWriter(queue_size=10, batch_size=1, max_batch_bytes=10 ** 6)
+        entry = {'response': '[]', 'view_name': 'evaluations', 'expires': time.time() + 60}
+        with self.assertLogs('api.cache_writer', 'ERROR'):
+            for key in ('a', 'b'):
+                writer.submit(self.backend, key, dict(entry), data_version('evaluations'))
+                writer.flush()
+        self.assertEqual(get_breaker('memory').state, 'open')
+
+    @mock.patch('api.cache._seeded', True)
+    def test_clearing_and_pruning_go_through_the_breaker(self):
+        self.get()
+        self.backend.failing = True
+        with self.assertLogs('api.cache', 'ERROR'):
+            clear_cache('evaluations')
+            with self.assertRaises(RuntimeError):
+                prune_cache()
+        self.assertEqual(metrics.counter(
+            'cache_clear_failures', view='evaluations', tier='memory'), 1)
+        self.assertEqual(get_breaker('memory').state, 'open')
+
+        # Open: the entry is left where it is, but taken as stale all the same
+        self.backend.failing = False
+        version = data_version('evaluations')
+        clear_cache('evaluations')
+        self.assertGreater(data_version('evaluations'), version)
+        self.assertEqual(list(self.backend.entries), [cache_key(
+            'evaluations', RequestFactory().get('/api/evaluations'))])
+        self.assertEqual(metrics.counter(
+            'cache_clears_skipped', view='evaluations', tier='memory'), 1)
+        with self.assertRaises(CircuitOpen):
+            prune_cache()
+
+        get_breaker('memory').opened_at -= 60
+        self.get()
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(metrics.counter(
+            'cache_requests', view='evaluations', tier='memory', result='stale'), 1)
+
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class TelemetryTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+        @datastore_cache()
+        def evaluations(request):
+            return JsonResponse({'evaluations': []})
+        self.view = evaluations
+        get_writer().flush()
+        get_backend().clear()
+
+    def test_lookups_are_counted_timed_and_logged(self):
+        with self.assertLogs('api.telemetry', 'INFO') as logs:
+            self.view(RequestFactory().get('/api/evaluations'))
+            get_writer().flush()
+            self.view(RequestFactory().get('/api/evaluations'))
+            with freeze_time(timezone.now() + timedelta(days=2)):
+                self.view(RequestFactory().get('/api/evaluations'))
+        for result in ('miss', 'hit', 'stale'):
+            self.assertEqual(metrics.counter(
+                'cache_requests', view='evaluations', tier='memory', result=result), 1)
+        self.assertEqual(metrics.histogram(
+            'cache_get_seconds', view='evaluations', tier='memory')['count'], 3)
+        self.assertEqual(metrics.histogram('view_compute_seconds', view='evaluations')['count'], 2)
+        self.assertEqual(metrics.histogram('cache_set_seconds', tier='memory')['count'], 1)
+        lines = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual([line['result'] for line in lines], ['miss', 'hit', 'stale'])
+        self.assertIn('compute_ms', lines[0])
+        self.assertNotIn('compute_ms', lines[1])
+
+    def test_cleared_entries_are_counted(self):
+        self.view(RequestFactory().get('/api/evaluations'))
+        self.view(RequestFactory().get('/api/evaluations?currency=EUR'))
+        get_writer().flush()
+        clear_cache('evaluations')
+        self.assertEqual(metrics.counter(
+            'cache_entries_cleared', view='evaluations', tier='memory'), 2)
+        self.assertEqual(metrics.histogram(
+            'cache_clear_seconds', view='evaluations', tier='memory')['count'], 1)
+
+    def test_prometheus_text(self):
+        metrics.increment('cache_requests', view='evaluations', tier='memory', result='hit')
+        metrics.observe('cache_get_seconds', 0.003, view='evaluations', tier='memory')
+        text = metrics.prometheus_text()
+        self.assertIn('# TYPE impact_api_cache_requests_total counter\n', text)
+        self.assertIn('impact_api_cache_requests_total'
+                      '{result="hit",tier="memory",view="evaluations"} 1\n', text)
+        self.assertIn('impact_api_cache_get_seconds_bucket'
+                      '{tier="memory",view="evaluations",le="0.0025"} 0\n', text)
+        self.assertIn('impact_api_cache_get_seconds_bucket'
+                      '{tier="memory",view="evaluations",le="0.005"} 1\n', text)
+        self.assertIn('impact_api_cache_get_seconds_bucket'
+                      '{tier="memory",view="evaluations",le="+Inf"} 1\n', text)
+        self.assertIn('impact_api_cache_get_seconds_count'
+                      '{tier="memory",view="evaluations"} 1\n', text)
+
+    def test_stats_endpoint_is_for_staff_only(self):
+        metrics.increment('cache_requests', view='evaluations', tier='memory', result='hit')
+        response = self.client.get('/api/_stats')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/admin/login/', response['Location'])
+
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        response = self.client.get('/api/_stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'impact_api_cache_requests_total', response.content)
+        content = json.loads(self.client.get('/api/_stats?format=json').content)
+        self.assertIn({'name': 'cache_requests', 'value': 1, 'labels': {
+            'view': 'evaluations', 'tier': 'memory', 'result': 'hit'}}, content['counters'])
+
+@freeze_time("2022-08-23")
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE)
+class ServerTimingTests(TestCase):
+    def setUp(self):
+        create_evaluation()
+        get_writer().flush()
+        get_backend().clear()
+
+    def stages(self, response) -> dict:
+        return {entry.split(';')[0]: entry for entry in response['Server-Timing'].split(', ')}
+
+    def test_api_responses_report_each_stage(self):
+        stages = self.stages(self.client.get(reverse('evaluations') + '?currency=EUR'))
+        for name in ('validate', 'cache', 'view', 'db', 'serialize', 'convert', 'encode',
+                     'compress', 'total'):
+            self.assertIn(name, stages)
+        self.assertRegex(stages['total'], r'^total;dur=\d+\.\d\d$')
+        self.assertRegex(stages['db'], r'desc="\d+x"')
+
+        get_writer().flush()
+        stages = self.stages(self.client.get(reverse('evaluations') + '?currency=EUR'))
+        self.assertEqual(set(stages), {'validate', 'cache', 'total'})
+
+    def test_reads_routed_to_another_database_are_timed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'replica.sqlite3')
+        read_snapshot.export(path)
+        add_database(self, 'replica', path)
+        with self.settings(API_READ_MODEL=False,
+                           API_DB_REPLICA={'ALIAS': 'replica', 'STICKY_SECONDS': 0}), \
+                mock.patch.object(replica, 'reads_primary', return_value=False), \
+                CaptureQueriesContext(connections['replica']) as replica_queries, \
+                CaptureQueriesContext(connections['default']) as primary_queries:
+            stages = self.stages(self.client.get(reverse('evaluations')))
+        self.assertTrue(replica_queries)
+        self.assertFalse([query for query in primary_queries
+                          if 'api_evaluation' in query['sql']])
+        self.assertIn('db', stages)
+
+    def test_other_routes_are_not_timed(self):
+        self.assertNotIn('Server-Timing', self.client.get('/admin/login/'))
+
+    def test_sampled_requests_are_traced(self):
+        with self.settings(SERVER_TIMING={'ENABLED': True, 'TRACE_SAMPLE_RATE': 1}):
+            with self.assertLogs('api.telemetry', 'INFO') as logs:
+                self.client.get(reverse('evaluations'))
+        trace = [json.loads(record.getMessage()) for record in logs.records
+                 if json.loads(record.getMessage())['event'] == 'api_trace'][0]
+        self.assertEqual(trace['path'], '/api/evaluations')
+        self.assertEqual(trace['status'], 200)
+        self.assertIn('serialize', trace['stages'])
+
+    def test_stages_outside_a_request_are_ignored(self):
+        with timing.stage('serialize'):
+            pass
+        self.assertIsNone(timing.current())
+
+    def test_async_requests_are_timed(self):
+        async def view(request):
+            with timing.stage('view'):
+                await asyncio.sleep(0)
+            return HttpResponse()
+        middleware = ServerTimingMiddleware(view)
+        response = async_to_sync(middleware)(AsyncRequestFactory().get('/api/evaluations'))
+        self.assertEqual(set(self.stages(response)), {'view', 'total'})
+
+PROFILING = {'TOKEN': 'secret', 'SAMPLE_RATE': 0, 'KEEP': 100}
+
+@freeze_time("2022-08-23")
+@override_settings(API_CACHE_BACKEND=IN_MEMORY_CACHE, PROFILING=PROFILING)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        create_evaluation()
+        get_writer().flush()
+        get_backend().clear()
+
+    def test_requests_with_the_token_are_profiled(self):
+        response = self.client.get(reverse('evaluations'), HTTP_X_PROFILE_TOKEN='secret')
+        profile = RequestProfile.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual(profile.path, '/api/evaluations')
+        self.assertEqual(profile.trigger, 'header')
+        self.assertEqual(profile.status_code, 200)
+        self.assertIn('cumulative', profile.profile)
+        # views._construct_response, or read_model.construct_response
+        self.assertIn('construct_response', profile.profile)
+        self.assertTrue(any('api_evaluation' in query['sql'] for query in profile.queries))
+
+    def test_other_requests_are_not_profiled(self):
+        for headers in ({}, {'HTTP_X_PROFILE_TOKEN': 'wrong'}):
+            self.assertNotIn('X-Profile-Id', self.client.get(reverse('evaluations'), **headers))
+        with self.settings(PROFILING=dict(PROFILING, TOKEN=None)):
+            self.client.get(reverse('evaluations'), HTTP_X_PROFILE_TOKEN='')
+        self.client.get('/admin/login/', HTTP_X_PROFILE_TOKEN='secret')
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_sampled_requests_are_profiled_and_only_the_latest_kept(self):
+        with self.settings(PROFILING=dict(PROFILING, SAMPLE_RATE=1, KEEP=2)):
+            for year in (2010, 2011, 2012):
+                self.client.get(reverse('evaluations') + f'?start_year={year}')
+        self.assertEqual(
+            list(RequestProfile.objects.values_list('path', 'trigger')),
+            [('/api/evaluations?start_year=2012', 'sample'),
+             ('/api/evaluations?start_year=2011', 'sample')])
+
+    def test_profiles_are_shown_in_the_admin(self):
+        response = self.client.get(reverse('evaluations'), HTTP_X_PROFILE_TOKEN='secret')
+        self.client.force_login(User.objects.create_superuser('admin'))
+        self.assertContains(self.client.get('/admin/'), 'Request profiles')
+        self.assertContains(self.client.get('/admin/api/requestprofile/'), '/api/evaluations')
+        detail = self.client.get(
+            f'/admin/api/requestprofile/{response["X-Profile-Id"]}/change/')
+        self.assertContains(detail, 'api_evaluation')
+
+class KeepAliveServer(BaseHTTPRequestHandler):
+    '''Answers every GET with a small JSON body, keeping the connection open.
+    Chunked if the path asks for it.'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"evaluations": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'chunked' in self.path:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body))
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class BenchCommandTests(TestCase):
+    @freeze_time('2022-08-23')
+    def test_benchmarks_every_endpoint_and_rolls_back_its_data(self):
+        from api.management.commands import bench_api
+        # Already in a test database and environment
+        creation = bench_api.connection.creation
+        for target, name in ((bench_api, 'setup_test_environment'),
+                             (bench_api, 'teardown_test_environment'),
+                             (creation, 'create_test_db'), (creation, 'destroy_test_db')):
+            patcher = mock.patch.object(target, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        output = io.StringIO()
+        call_command('bench_api', charities=[2], evaluations=4, grants=2, allotments=2,
+                     cold_runs=1, warm_runs=1, stdout=output, stderr=io.StringIO())
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual(len(results), len(bench_api.ENDPOINTS) * len(bench_api.SHAPES))
+        for result in results:
+            self.assertEqual(result['status'], 200)
+            self.assertGreater(result['queries'], 0)
+        for model in (Charity, Intervention, Evaluation, MaxImpactFundGrant,
+                      AllGrantsFundGrant, Allotment):
+            self.assertFalse(model.objects.exists())
+
+    def test_concurrency_benchmark_runs_requests_over_kept_alive_connections(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveServer)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        for query in ('', '?chunked'):
+            with self.subTest(query=query):
+                output = io.StringIO()
+                call_command('bench_concurrency',
+                             f'http://127.0.0.1:{server.server_port}/api/evaluations{query}',
+                             connections=2, requests=6, timeout=5, json=True, stdout=output)
+                results = json.loads(output.getvalue())
+                self.assertEqual(results['requests'], 6)
+                self.assertEqual(results['errors'], 0)
+                self.assertEqual(results['statuses'], {'200': 6})
@@ -0,0 +1,103 @@
+'''Per-stage timings of an API request, reported in its Server-Timing header
+by ServerTimingMiddleware. Stages nest (db and convert happen during serialize,
+which happens during view), so they don't add up to the total.'''
+import contextvars
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+_timings = contextvars.ContextVar('api_request_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        # Stage name: [seconds, times entered], in the order first entered
+        self.stages = {}
+        # Set to a list to also collect each query's SQL and duration
+        self.queries = None
+
+    def record(self, name, seconds) -> None:
+        stage = self.stages.setdefault(name, [0.0, 0])
+        stage[0] += seconds
+        stage[1] += 1
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def header(self) -> str:
+        '''The Server-Timing header value, durations in milliseconds'''
+        entries = [f'{name};dur={seconds * 1000:.2f}' + (f';desc="{count}x"' if count > 1 else '')
+                   for name, (seconds, count) in self.stages.items()]
+        entries.append(f'total;dur={self.total() * 1000:.2f}')
+        return ', '.join(entries)
+
+    def as_dict(self) -> dict:
+        return {'total_ms': round(self.total() * 1000, 2), 'stages': {
+            name: {'ms': round(seconds * 1000, 2), 'count': count}
+            for name, (seconds, count) in self.stages.items()}}
+
+
+def start():
+    '''Start timing the current request, returning its timings and a token for finish'''
+    timings = RequestTimings()
+    return timings, _timings.set(timings)
+
+
+def finish(token) -> None:
+    _timings.reset(token)
+
+
+def current():
+    '''The timings of the request being handled, or None outside one'''
+    return _timings.get()
+
+
+def record(name, seconds) -> None:
+    '''Add an already measured duration to the current request's timings'''
+    timings = _timings.get()
+    if timings is not None:
+        timings.record(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    '''Time the with block as a stage of the current request, if there is one'''
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.record(name, time.perf_counter() - start_time)
+
+
+def _time_query(execute, sql, params, many, context):
+    start_time = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start_time
+        timings = _timings.get()
+        if timings is not None:
+            timings.record('db', seconds)
+            if timings.queries is not None:
+                timings.queries.append({'sql': sql, 'ms': round(seconds * 1000, 3)})
+
+
+@contextmanager
+def database_queries():
+    '''Time every query this thread's connections run in the with block as 'db',
+    whichever database the routers send them to. Installed around the view's work
+    rather than the whole request, as an async request's ORM calls run on
+    another thread's connections.'''
+    if _timings.get() is None:
+        yield
+        return
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(_time_query))
+        yield
@@ -1,9 +1,15 @@
+from django.conf import settings
 from django.urls import path
 
-from . import views
+from . import async_views, views
+
+# Under an ASGI server the async views don't tie up a thread while waiting on the cache
+api_views = async_views if settings.ASYNC_API_VIEWS else views
 
 urlpatterns = [
-    path('evaluations', views.evaluations, name='evaluations'),
-    path('max_impact_fund_grants', views.max_impact_fund_grants, name='max_impact_fund_grants'),
-    path('all_grants_fund_grants', views.all_grants_fund_grants, name='all_grants_fund_grants')
+    path('evaluations', api_views.evaluations, name='evaluations'),
+    path('max_impact_fund_grants', api_views.max_impact_fund_grants, name='max_impact_fund_grants'),
+    path('all_grants_fund_grants', api_views.all_grants_fund_grants, name='all_grants_fund_grants'),
+    path('changes', views.changes, name='changes'),
+    path('_stats', views.stats, name='stats'),
 ]
@@ -1,14 +1,44 @@
 from collections import namedtuple
 from datetime import date
 from typing import Callable
-from django.http import JsonResponse
-from django.db.models import Q
-from .models import Evaluation, MaxImpactFundGrant, Charity, AllGrantsFundGrant
-from .serializers import EvaluationSerializer, MaxImpactFundGrantSerializer, AllGrantsFundGrantSerializer
-from .cache import datastore_cache
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.cache import never_cache
+from django.http import HttpResponse, JsonResponse
+from django.db.models import Prefetch, Q
+from .models import Allotment, Evaluation, MaxImpactFundGrant, Charity, AllGrantsFundGrant
+from . import metrics, read_model, sparse_fields, timing
+from .cache import conditional_get, datastore_cache
+from .changes import InvalidToken, changes_since, decode_token
+from .edge import edge_cache, surrogate_keys
+from .read_snapshot import api_reads
 # Before any of the views are called, the code in middleware.py will run
+# The serializers pull in Django REST framework, which a cache hit never needs,
+# so each view imports them only once it has missed the cache. With
+# settings.API_READ_MODEL, misses are answered from read_model.py instead.
 
-@datastore_cache(timeout_days=1)
+CACHE_TIMEOUT_DAYS = 1
+
+@staff_member_required
+def stats(request):
+    '''This instance's cache and view metrics, in Prometheus' text format, or as
+    JSON given format=json. Each instance counts for itself.'''
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(metrics.snapshot().items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(metrics.gauge_snapshot().items())],
+            'histograms': [{'name': name, 'labels': dict(labels), **histogram}
+                           for (name, labels), histogram
+                           in sorted(metrics.histogram_snapshot().items())],
+            'buckets': metrics.BUCKETS})
+    return HttpResponse(metrics.prometheus_text(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@edge_cache
+@conditional_get
+@datastore_cache(timeout_days=CACHE_TIMEOUT_DAYS)
 def evaluations(request):
     '''Returns a Json response describing evaluations meeting parameters
     supplied as query strings. If any of the parameters are unspecified, it
@@ -31,8 +61,14 @@ def evaluations(request):
     ascii characters)
     language=<i18n country code>
     currency=<ISO 4217 code>
+    fields=<comma-separated fields of each evaluation to return, with a nested
+    record's named by path, like charity.abbreviation (see sparse_fields.py)>
     '''
     query_strings = request.GET
+    if settings.API_READ_MODEL:
+        return _json_response(read_model.construct_response(
+            'evaluations', _get_lookup_dates(query_strings), query_strings), 'evaluations')
+    from .serializers import EvaluationSerializer
     charities_query = Q(
         charity__abbreviation__in=_charity_abbreviations(query_strings))
     response = _construct_response(
@@ -42,9 +78,11 @@ def evaluations(request):
         serializer=EvaluationSerializer,
         fetch_by_donation_func=_evaluations_by_donation_date,
         extra_queries=charities_query)
-    return JsonResponse(response)
+    return _json_response(response, 'evaluations')
 
-@datastore_cache(timeout_days=1)
+@edge_cache
+@conditional_get
+@datastore_cache(timeout_days=CACHE_TIMEOUT_DAYS)
 def max_impact_fund_grants(request):
     '''Returns a Json response describing grants meeting parameters
     supplied as query strings. If any of the parameters are unspecified, it
@@ -65,88 +103,150 @@ def max_impact_fund_grants(request):
     doesn't match we'll decrement by day until it does>
     language=<i18n country code>
     currency=<ISO 4217 code>
+    fields=<comma-separated fields of each grant to return, with a nested
+    record's named by path, like allotment_set.converted_sum (see sparse_fields.py)>
     '''
     query_strings = request.GET
+    if settings.API_READ_MODEL:
+        return _json_response(read_model.construct_response(
+            'max_impact_fund_grants', _get_lookup_dates(query_strings), query_strings),
+            'max_impact_fund_grants')
+    from .serializers import MaxImpactFundGrantSerializer
     response = _construct_response(
         query_strings=query_strings,
         model=MaxImpactFundGrant,
         model_description='max_impact_fund_grants',
         serializer=MaxImpactFundGrantSerializer,
         fetch_by_donation_func=_grant_by_donation_date)
-    return JsonResponse(response)
+    return _json_response(response, 'max_impact_fund_grants')
 
-@datastore_cache(timeout_days=1)
+@edge_cache
+@conditional_get
+@datastore_cache(timeout_days=CACHE_TIMEOUT_DAYS)
 def all_grants_fund_grants(request):
     '''Returns a Json response describing grants meeting parameters
     supplied as query strings. Parameters and behaviour are same as for max_impact_fund_grants
     '''
     query_strings = request.GET
+    if settings.API_READ_MODEL:
+        return _json_response(read_model.construct_response(
+            'all_grants_fund_grants', _get_lookup_dates(query_strings), query_strings),
+            'all_grants_fund_grants')
+    from .serializers import AllGrantsFundGrantSerializer
     response = _construct_response(
         query_strings=query_strings,
         model=AllGrantsFundGrant,
         model_description='all_grants_fund_grants',
         serializer=AllGrantsFundGrantSerializer,
         fetch_by_donation_func=_grant_by_donation_date)
-    return JsonResponse(response)
+    return _json_response(response, 'all_grants_fund_grants')
+
+@never_cache
+def changes(request):
+    '''Returns a Json response with the records (of every kind) saved and deleted
+    since a previous call, for mirroring the data without downloading all of it
+    each time. Records are as stored, with their foreign keys as ids.
+
+    Query strings of the following form are parsed:
+    since=<the next token from the previous response. Without one, every record is
+    returned, with a token to pass next time>
+    '''
+    since = request.GET.get('since')
+    try:
+        since = decode_token(since) if since else None
+    except InvalidToken:
+        return JsonResponse({'errors': ['since must be a token from a previous response']})
+    with timing.database_queries(), api_reads():
+        response = changes_since(since)
+    with timing.stage('encode'):
+        return JsonResponse(response)
 
 def _construct_response(query_strings, model: type, model_description: str, serializer: type,
                         fetch_by_donation_func: Callable, extra_queries=Q()) -> dict:
-    lookup_dates = _get_lookup_dates(query_strings)
-    if lookup_dates.donation_year:
-        records = fetch_by_donation_func(model, lookup_dates, query_strings)
-    else:
-        records = _records(model, lookup_dates, extra_queries)
-
-    response = {model_description: [
-        serializer(record, context=query_strings).data for record in records]}
-    if not records:
-        response['warnings'] = [
-            f'No {model_description} found with those parameters']
+    fields = sparse_fields.requested(query_strings, model_description)
+    with timing.database_queries(), api_reads():
+        lookup_dates = _get_lookup_dates(query_strings)
+        queryset = _selecting(model.objects.all(), model_description, fields)
+        if lookup_dates.donation_year:
+            records = fetch_by_donation_func(queryset, lookup_dates, query_strings)
+        else:
+            records = _records(queryset, lookup_dates, extra_queries)
+
+        with timing.stage('serialize'):
+            response = {model_description: [
+                serializer(record, context=query_strings, sparse_fields=fields).data
+                for record in records]}
+        if not records:
+            response['warnings'] = [
+                f'No {model_description} found with those parameters']
     return response
 
 
+def _json_response(response: dict, model_description: str) -> JsonResponse:
+    with timing.stage('encode'):
+        json_response = JsonResponse(response)
+    json_response['Surrogate-Key'] = ' '.join(
+        surrogate_keys(model_description, response[model_description]))
+    return json_response
+
+
 def _get_lookup_dates(query_strings) -> namedtuple:
     Dates = namedtuple(
         'Dates',
         'start_year start_month end_year end_month donation_year donation_month donation_day')
+    # QueriesMiddleware has already checked that these are integers in range
+    donation_year = query_strings.get('donation_year')
     return Dates(
-        query_strings.get('start_year') or 2000,
-        query_strings.get('start_month') or 1,
-        query_strings.get('end_year') or date.today().year,
-        query_strings.get('end_month') or 12,
-        query_strings.get('donation_year'),
-        query_strings.get('donation_month', 1),
-        query_strings.get('donation_day', 1))
+        int(query_strings.get('start_year') or 2000),
+        int(query_strings.get('start_month') or 1),
+        int(query_strings.get('end_year') or date.today().year),
+        int(query_strings.get('end_month') or 12),
+        int(donation_year) if donation_year else None,
+        int(query_strings.get('donation_month') or 1),
+        int(query_strings.get('donation_day') or 1))
+
+
+def _selecting(queryset, model_description, fields):
+    '''queryset, reading only the columns that the fields need, given any. The
+    read model is built from every column, so this is for the ORM path only.'''
+    if fields is None:
+        return queryset
+    queryset = queryset.only(*sparse_fields.columns(model_description, fields))
+    if 'allotment_set' in fields:
+        allotment_fields = fields['allotment_set'] or sparse_fields.ALLOTMENT_FIELDS
+        queryset = queryset.prefetch_related(Prefetch('allotment_set', Allotment.objects.only(
+            *sparse_fields.allotment_columns(allotment_fields))))
+    return queryset
 
 
-def _evaluations_by_donation_date(model, dates, query_strings) -> list:
+def _evaluations_by_donation_date(queryset, dates, query_strings) -> list:
     records = []
 
     for abbreviation in _charity_abbreviations(query_strings):
         single_charity_query = Q(charity__abbreviation=abbreviation)
-        record = _record_by_donation_date(model, dates, single_charity_query)
+        record = _record_by_donation_date(queryset, dates, single_charity_query)
         records += record
     return records
 
 
-def _grant_by_donation_date(model, dates, _query_strings):
-    return _record_by_donation_date(model, dates)
+def _grant_by_donation_date(queryset, dates, _query_strings):
+    return _record_by_donation_date(queryset, dates)
 
 
-def _record_by_donation_date(model, dates, q3=Q()) -> list:
+def _record_by_donation_date(queryset, dates, q3=Q()) -> list:
     try:
         q1 = Q(start_year=dates.donation_year,
                start_month__lte=dates.donation_month)
         q2 = Q(start_year__lt=dates.donation_year)
-        result = [model.objects.filter((q1 | q2) & q3).order_by(
+        result = [queryset.filter((q1 | q2) & q3).order_by(
             '-start_year', '-start_month')[0]]
         return result
     except IndexError:
         return []
 
 
-def _records(model, dates, extra_queries):
-    return model.objects.filter(
+def _records(queryset, dates, extra_queries):
+    return queryset.filter(
         extra_queries,
         start_year__gte=dates.start_year,
         start_month__gte=dates.start_month,
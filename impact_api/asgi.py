@@ -12,5 +12,18 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'impact_api.settings')
+# Run with e.g. gunicorn -k uvicorn.workers.UvicornWorker impact_api.asgi
+os.environ.setdefault('ASYNC_API_VIEWS', 'true')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from api.events import EVENTS_PATH, stream_events  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # The change stream's connections stay open, idle, for as long as the
+    # clients like, so they skip Django's request handling (and its thread per
+    # sync middleware) altogether
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH and scope['method'] == 'GET':
+        return await stream_events(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -43,27 +43,37 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     # 'cachalot',
-    # 'silk',
     "corsheaders",
 ]
 
 MIDDLEWARE = [
+    # First, so that its total covers the rest
+    'api.middleware.ServerTimingMiddleware',
+    # Saves a cProfile report of requested or sampled API requests to the admin
+    'api.middleware.ProfilingMiddleware',
+    # Read-your-writes for the admin when the API reads from a replica
+    'api.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    # 'silk.middleware.SilkyMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.common.CommonMiddleware',
+    # Runs ADMIN_MIDDLEWARE below, except on the public api/ routes
+    'api.middleware.AdminMiddleware',
+    'django.middleware.locale.LocaleMiddleware',
+    'api.middleware.QueriesMiddleware'
+]
+
+ADMIN_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.locale.LocaleMiddleware',
-    'api.middleware.QueriesMiddleware'
 ]
 
-#SILKY_PYTHON_PROFILER = True
-#SILKY_PYTHON_PROFILER_BINARY = True
+# The admin checks look for the session, auth and messages middleware in
+# MIDDLEWARE, and can't see them inside AdminMiddleware
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
 
 ROOT_URLCONF = 'impact_api.urls'
 CORS_ALLOW_ALL_ORIGINS = True
@@ -85,6 +95,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'impact_api.wsgi.application'
+
+# Serve the API with async views. impact_api/asgi.py turns this on.
+ASYNC_API_VIEWS = os.getenv('ASYNC_API_VIEWS') == 'true'
 SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
 
 CACHES = {
@@ -94,6 +107,107 @@ CACHES = {
     }
 }
 
+# Where the API's responses are cached (see api/cache_backends.py): Datastore in
+# production, CACHES['default'] elsewhere, so that running locally or the tests
+# needs no Google credentials. API_CACHE_BACKEND picks another backend class.
+if os.getenv('API_CACHE_BACKEND'):
+    API_CACHE_BACKEND = {'BACKEND': os.getenv('API_CACHE_BACKEND')}
+elif os.getenv('DJANGO_SECRET') != None:
+    API_CACHE_BACKEND = {'BACKEND': 'api.cache_backends.DatastoreBackend'}
+else:
+    API_CACHE_BACKEND = {'BACKEND': 'api.cache_backends.DjangoCacheBackend', 'ALIAS': 'default'}
+
+# Cache-Control for successful public API responses: max_age for browsers and
+# widgets, s_maxage and stale_while_revalidate for a CDN in front of us
+API_CACHE_CONTROL = {
+    'public': True,
+    'max_age': int(os.getenv('API_MAX_AGE', 60)),
+    's_maxage': int(os.getenv('API_S_MAXAGE', 3600)),
+    'stale_while_revalidate': int(os.getenv('API_STALE_WHILE_REVALIDATE', 600)),
+}
+
+# The background thread that saves cache misses to the backend. Entries beyond
+# QUEUE_SIZE are dropped; a batch stops at BATCH_SIZE entries or once it passes
+# MAX_BATCH_BYTES, as a Datastore commit is limited to 10 MiB.
+API_CACHE_WRITER = {
+    'QUEUE_SIZE': int(os.getenv('API_CACHE_WRITER_QUEUE_SIZE', 200)),
+    'BATCH_SIZE': 25,
+    'MAX_BATCH_BYTES': 4 * 1024 * 1024,
+}
+
+# Answer the API's cache misses from an in-memory snapshot of the whole dataset
+# (see api/read_model.py) rather than with ORM queries and REST framework
+API_READ_MODEL = os.getenv('API_READ_MODEL', 'true') == 'true'
+
+# How far back each /api/changes token reaches before the response it came
+# with, to cover saves still committing then (see api/changes.py)
+API_CHANGES_OVERLAP_SECONDS = int(os.getenv('API_CHANGES_OVERLAP_SECONDS', 60))
+# How long deletions are kept for /api/changes to report. prune_api_cache deletes
+# older ones, and a token from before then gets every record again to resync from.
+API_CHANGES_RETENTION_DAYS = int(os.getenv('API_CHANGES_RETENTION_DAYS', 90))
+
+# How often each instance picks up the data changes made on the others (see
+# api/coherence.py). Only needed with more than one instance, so off locally.
+API_DATA_VERSION_POLL_SECONDS = float(os.getenv(
+    'API_DATA_VERSION_POLL_SECONDS', 5 if os.getenv('DJANGO_SECRET') != None else 0))
+
+# The change stream at /api/events (see api/events.py), served under ASGI only.
+# Each stream gets a comment every HEARTBEAT_SECONDS while idle, and clients
+# are told to reconnect after RETRY_MILLISECONDS. Beyond MAX_CONNECTIONS at
+# once, an instance answers 503.
+API_EVENTS = {
+    'HEARTBEAT_SECONDS': float(os.getenv('API_EVENTS_HEARTBEAT_SECONDS', 25)),
+    'RETRY_MILLISECONDS': 5000,
+    'MAX_CONNECTIONS': int(os.getenv('API_EVENTS_MAX_CONNECTIONS', 5000)),
+}
+
+# After FAILURE_THRESHOLD failed (or slower than SLOW_CALL_SECONDS) cache calls
+# in a row, requests skip the cache for RESET_SECONDS, then probe it again.
+API_CACHE_CIRCUIT_BREAKER = {
+    'FAILURE_THRESHOLD': int(os.getenv('API_CACHE_CIRCUIT_FAILURE_THRESHOLD', 5)),
+    'SLOW_CALL_SECONDS': float(os.getenv('API_CACHE_CIRCUIT_SLOW_CALL_SECONDS', 0.5)),
+    'RESET_SECONDS': float(os.getenv('API_CACHE_CIRCUIT_RESET_SECONDS', 30)),
+}
+
+# Deletes expired cache entries every INTERVAL seconds (0 to leave it to the
+# prune_api_cache command), up to BATCH_SIZE per Datastore call
+API_CACHE_SWEEPER = {
+    'INTERVAL': int(os.getenv('API_CACHE_SWEEPER_INTERVAL', 0)),
+    'BATCH_SIZE': 500,
+}
+
+# Saves and deletes clear the caches once their transaction commits (see
+# api/invalidation.py). In the background, the admin needn't wait for the
+# Datastore and CDN, but the API may serve the old data for a moment longer.
+API_INVALIDATION_BACKGROUND = os.getenv('API_INVALIDATION_BACKGROUND', 'false') == 'true'
+
+# A Server-Timing header on every API response, with the time spent in each
+# stage (see api/timing.py). TRACE_SAMPLE_RATE of them also get logged in full.
+SERVER_TIMING = {
+    'ENABLED': os.getenv('SERVER_TIMING', 'true') == 'true',
+    'TRACE_SAMPLE_RATE': float(os.getenv('SERVER_TIMING_TRACE_SAMPLE_RATE', 0.01)),
+}
+
+# Profile API requests sending TOKEN in an X-Profile-Token header, and a random
+# SAMPLE_RATE of the rest. Reports are saved as RequestProfiles, keeping the
+# latest KEEP. Without a TOKEN only sampling can trigger a profile.
+PROFILING = {
+    'TOKEN': os.getenv('PROFILING_TOKEN'),
+    'SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', 0)),
+    'KEEP': int(os.getenv('PROFILING_KEEP', 100)),
+}
+
+# Called with the affected Surrogate-Keys whenever the data changes
+if os.getenv('EDGE_PURGE_URL'):
+    EDGE_PURGE = {
+        'BACKEND': 'api.edge.HttpPurgeBackend',
+        'URL': os.getenv('EDGE_PURGE_URL'),
+        'HEADERS': ({'Authorization': 'Bearer ' + os.getenv('EDGE_PURGE_TOKEN')}
+                    if os.getenv('EDGE_PURGE_TOKEN') else {}),
+    }
+else:
+    EDGE_PURGE = {'BACKEND': 'api.edge.NullPurgeBackend'}
+
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
@@ -110,6 +224,13 @@ if os.getenv("CLOUD_SQL_CONNECTION_NAME"):
             'USER': os.getenv("DB_USER"),
             'PASSWORD': os.getenv("DB_PASS"),
             'HOST': '/cloudsql/' + os.getenv("CLOUD_SQL_CONNECTION_NAME"),
+            # Keep each gunicorn thread's connection open between requests
+            # rather than reconnecting over the socket every time. 0 restores
+            # Django's default of a new connection per request.
+            'CONN_MAX_AGE': int(os.getenv("DB_CONN_MAX_AGE", 300)),
+            # Native from Django 4.1; api.db.check_connection_health covers
+            # older versions.
+            'CONN_HEALTH_CHECKS': True,
         }
     }
 else:
@@ -120,6 +241,43 @@ else:
         }
     }
 
+# A read replica for the API's reads (see api/replica.py): a Cloud SQL read
+# replica in production or, locally, a second SQLite file (a copy of
+# db.sqlite3, say). For STICKY_SECONDS
+# after a change the API reads the primary, to cover the replica's lag.
+API_DB_REPLICA = {
+    'ALIAS': os.getenv('DB_REPLICA_ALIAS', 'replica'),
+    'STICKY_SECONDS': float(os.getenv('DB_REPLICA_STICKY_SECONDS', 5)),
+}
+if os.getenv("CLOUD_SQL_REPLICA_CONNECTION_NAME"):
+    DATABASES[API_DB_REPLICA['ALIAS']] = dict(
+        DATABASES['default'],
+        HOST='/cloudsql/' + os.getenv("CLOUD_SQL_REPLICA_CONNECTION_NAME"),
+        TEST={'MIRROR': 'default'})
+elif os.getenv("DB_REPLICA_NAME"):
+    DATABASES[API_DB_REPLICA['ALIAS']] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv("DB_REPLICA_NAME"),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# A read-only SQLite copy of the public data, written by the export_read_snapshot
+# command and shipped in the image. While it's present and no change has been
+# made since the export, the API's reads go to it rather than to MySQL (see
+# api/read_snapshot.py and api/routers.py).
+API_READ_SNAPSHOT = os.getenv('API_READ_SNAPSHOT', str(BASE_DIR / 'read_snapshot.sqlite3'))
+if os.path.exists(API_READ_SNAPSHOT):
+    DATABASES['read_snapshot'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        # immutable: nothing can change the file while it's open, so SQLite
+        # skips locking and change detection altogether
+        'NAME': Path(API_READ_SNAPSHOT).resolve().as_uri() + '?mode=ro&immutable=1',
+        # Tests read the default database through this alias
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['api.routers.ReadSnapshotRouter', 'api.routers.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -187,6 +345,9 @@ LOGGING = {
         'simple': {
             'format': '%(levelname)s %(message)s'
         },
+        'message': {
+            'format': '%(message)s'
+        },
     },
     'handlers': {
         'file': {
@@ -195,6 +356,12 @@ LOGGING = {
             'filename': 'mysite.log',
             'formatter': 'verbose'
         },
+        # Cloud Run turns JSON lines on stdout into structured log entries
+        'telemetry': {
+            'class': 'logging.StreamHandler',
+            'stream': 'ext://sys.stdout',
+            'formatter': 'message',
+        },
     },
     'loggers': {
         'django': {
@@ -206,5 +373,12 @@ LOGGING = {
             'handlers': ['file'],
             'level': 'DEBUG',
         },
+        # A JSON line per API cache lookup and clear (see api/cache.py)
+        'api.telemetry': {
+            'handlers': ['telemetry'],
+            'level': os.getenv('API_TELEMETRY_LOG_LEVEL',
+                               'INFO' if os.getenv('DJANGO_SECRET') != None else 'WARNING'),
+            'propagate': False,
+        },
     }
 }
@@ -19,5 +19,4 @@ from api.admin_reordering import admin_site
 urlpatterns = [
     path('api/', include('api.urls')),
     path('admin/', admin_site.urls),
-    #path('silk/', include('silk.urls', namespace='silk'))
 ]
@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'impact_api.settings')
 
 application = get_wsgi_application()
+
+# With gunicorn's --preload this runs once, in the master process, before workers fork.
+from api.cache import seed_data_versions  # noqa: E402
+from api.cache_backends import forget_client  # noqa: E402
+from api.db import warm_up_connections  # noqa: E402
+from api.read_model import warm_up as warm_up_read_model  # noqa: E402
+seed_data_versions()
+warm_up_read_model()
+warm_up_connections()
+forget_client()